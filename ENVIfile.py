@@ -6,7 +6,8 @@
 # Irish Earth Observation (IEO) Python Module
 # version 1.5
 
-import os, sys, shutil, datetime
+import os, sys, shutil, datetime, re, threading, numpy
+from collections import OrderedDict
 from osgeo import osr
 from pkg_resources import resource_stream, resource_string, resource_filename, Requirement
 if sys.version_info[0] == 2:
@@ -40,6 +41,28 @@ else:
 prj = osr.SpatialReference()
 prj.ImportFromEPSG(prjval) # "EPSG:2157"
 
+def makemapinfostr(prj):
+    # This function returns the map info header line for a projection, with {} placeholders for the upper left corner and pixel sizes of a raster
+    projname = prj.GetAttrValue('projcs') or prj.GetAttrValue('geogcs')
+    projstr = ''
+    if ' UTM ' in projname:
+        if projname[-1:] == 'N':
+            UTMnorth = 'North'
+        else: 
+            UTMnorth = 'South'
+        i = projname.rfind(' ') + 1
+        UTMzone = projname[i:-1]
+        projstr += ', {}, {}'.format(UTMzone, UTMnorth)
+    unitval = prj.GetAttrValue('unit')
+    if unitval.lower() == 'metre':
+        unitval = 'Meters'
+    projstr += ', {}, units={}'.format(prj.GetAttrValue('datum'), unitval)
+    return 'map info = {{' + projname + ', 1, 1, {}, {}, {}, {}' + projstr + '}}\n'
+
+# Header lines for the local projection, which are formatted once rather than for every file
+mapinfostr = makemapinfostr(prj)
+gcsstring = 'coordinate system string = {' + prj.ExportToWkt() + '}\n'
+
 # Shamelessly copied from http://pydoc.net/Python/spectral/0.17/spectral.io.envi/
 # import numpy as np
 # dtype_map = [('1', 'uint8'),                   # unsigned byte
@@ -68,6 +91,7 @@ dtype_to_envi = {
     'int64': '14',                  # 64-bit int
     'uint64': '15'                 # 64-bit unsigned int
     }
+envi_to_dtype = {v: k for k, v in dtype_to_envi.items()}
 
 
 headerfields = 'acquisition time,band names,bands,bbl,byte order,class lookup,class names,class values,classes,cloud cover,complex function,coordinate system string,data gain values,data ignore value,data offset values,data reflectance gain values,data reflectance offset values,data type,default bands,default stretch,dem band,dem file,description,file type,fwhm,geo points,header offset,interleave,lines,map info,pixel size,product type,projection info,read procedures,reflectance scale factor,rpc info,samples,security tag,sensor type,solar irradiance,spectra names,sun azimuth,sun elevation,wavelength,wavelength units,x start,y start,z plot average,z plot range,z plot titles'.split(',')
@@ -319,6 +343,45 @@ headerdict['Landsat'] = {'LE7': 'Landsat ETM+',
     
 ## General functions
 
+hdrfieldre = re.compile(r'^[ \t]*([^=;\n]+?)[ \t]*=[ \t]*(\{[^}]*\}|[^\n]*?)[ \t]*$', re.M) # key = value, or key = { value, ... } spanning several lines. Lines starting with ; are comments
+hdrcachesize = 1024 # Maximum number of parsed ENVI headers kept in memory
+hdrcache = OrderedDict() # parsed headers, keyed by path: ((modification time, size, inode), fields)
+hdrcachelock = threading.Lock()
+headerlines = {'interleave': 'interleave', 'lines': 'lines', 'samples': 'samples', 'bands': 'bands', 'data type': 'datatype', 'byte order': 'byteorder', 
+               'header offset': 'headeroffset', 'map info': 'mapinfo', 'projection info': 'projinfo', 'coordinate system string': 'gcsstring', 
+               'acquisition time': 'acquisitiontime'} # header fields that ENVIfile keeps as they are when it rewrites an existing header, and their ENVIheaderdata attributes
+
+def parseenvihdr(hdr):
+    # This function parses an ENVI header in a single pass, returning a dictionary of its fields. Values in braces are returned as lists of strings, 
+    # except for the description. Parsed headers are cached until the file changes, so the returned dictionary must not be modified. 
+    # Raises OSError if the header does not exist.
+    st = os.stat(hdr)
+    stamp = (st.st_mtime_ns, st.st_size, st.st_ino) # headers are replaced rather than rewritten in place by ENVIfile.WriteHeader()
+    key = os.path.abspath(hdr)
+    with hdrcachelock:
+        entry = hdrcache.get(key)
+        if entry and entry[0] == stamp:
+            hdrcache.move_to_end(key)
+            return entry[1]
+    with open(hdr, 'r') as lines:
+        text = lines.read()
+    fields = {}
+    for key_, val in hdrfieldre.findall(text):
+        if val.startswith('{'):
+            val = val[1:-1] if val.endswith('}') else val[1:]
+            if key_ == 'description':
+                fields[key_] = val.strip()
+            else:
+                fields[key_] = [x.strip() for x in val.split(',')]
+        else:
+            fields[key_] = val
+    with hdrcachelock:
+        hdrcache[key] = (stamp, fields)
+        hdrcache.move_to_end(key)
+        while len(hdrcache) > hdrcachesize:
+            hdrcache.popitem(last = False)
+    return fields
+
 def readenvihdr(hdr, *args, **kwargs):
     # started on 16 July 2019
     # this function will read data from an ENVI header into a local headerdict
@@ -334,35 +397,10 @@ def readenvihdr(hdr, *args, **kwargs):
             logerror(hdr, 'Error, rastertype "{}" is not in the recognised rastertypes of headerdict. Using default settings.'.format(rastertype))
             rastertype = 'default'
         hdict = headerdict[rastertype].copy()
-        with open(hdr, 'r') as lines:
-            for line in lines:
-                line = line.strip()
-                if line.find('=') == -1: continue
-                if line[0] == ';': continue
-    
-                (key, sep, val) = line.partition('=')
-                key = key.strip()
-#                if not key.islower():
-#                    have_nonlowercase_param = True
-#                    if not support_nonlowercase_params:
-#                        key = key.lower()
-                val = val.strip()
-                if val and val[0] == '{':
-                    str = val.strip()
-                    while str[-1] != '}':
-                        line = lines.pop(0)
-                        if line[0] == ';': continue
-    
-                        str += '\n' + line.strip()
-                    if key == 'description':
-                        hdict[key] = str.strip('{}').strip()
-                    else:
-                        vals = str[1:-1].split(',')
-                        for j in range(len(vals)):
-                            vals[j] = vals[j].strip()
-                        hdict[key] = vals
-                else:
-                    hdict[key] = val
+        for key, val in parseenvihdr(hdr).items():
+            if isinstance(val, list):
+                val = list(val) # callers may modify the lists, e.g. parent rasters
+            hdict[key] = val
     return hdict
 
 def isenvifile(f):
@@ -379,14 +417,120 @@ def isenvifile(f):
     else:
         return None
 
+def envigeotrans(hdict):
+    # This function returns the GDAL geotransform of an ENVI raster from the 'map info' of a readenvihdr() header dictionary, or None if it has no map info
+    # map info = {projection, reference x, reference y, easting, northing, x pixel size, y pixel size, ..., rotation=angle}
+    mapinfo = hdict.get('map info')
+    if not isinstance(mapinfo, list) or len(mapinfo) < 7:
+        return None
+    refx, refy, easting, northing, xsize, ysize = [float(x) for x in mapinfo[1:7]]
+    rotation = 0.0
+    for x in mapinfo[7:]:
+        if x.startswith('rotation='):
+            rotation = float(x[9:])
+    if rotation == 0.0:
+        xrot, yrot = 0.0, 0.0
+    else:
+        theta = numpy.radians(rotation)
+        xrot, yrot = ysize * numpy.sin(theta), xsize * numpy.sin(theta)
+        xsize, ysize = xsize * numpy.cos(theta), ysize * numpy.cos(theta)
+    ulx = easting - (refx - 1) * xsize - (refy - 1) * xrot # reference pixel coordinates are 1-based
+    uly = northing - (refx - 1) * yrot + (refy - 1) * ysize
+    return (ulx, xsize, xrot, uly, yrot, -ysize)
+
+def openenvi(f, *args, **kwargs):
+    # This function opens an ENVI raster as a numpy.memmap, so that only the parts of the file which are used are read from disk.
+    # Data always have the shape (bands, lines, samples). BIL and BIP files are returned as transposed views of the file.
+    # mode is passed to numpy.memmap: 'r' for read-only or 'r+' to update the file in place. A header dictionary from readenvihdr() can be passed as hdict.
+    # Returns (data, geoTrans), or (None, None) if the file or its header are missing or unreadable.
+    mode = kwargs.get('mode', 'r')
+    hdict = kwargs.get('hdict', None)
+    if not hdict:
+        hdr = isenvifile(f)
+        if not hdr or not os.path.isfile(f):
+            print('Error: {} is not an ENVI file.'.format(f))
+            return None, None
+        hdict = readenvihdr(hdr)
+    try:
+        samples, lines = int(hdict['samples']), int(hdict['lines'])
+        bands = int(hdict.get('bands') or 1)
+        dt = numpy.dtype(envi_to_dtype[str(hdict['data type']).strip()])
+    except (KeyError, TypeError, ValueError):
+        print('Error: the header of {} is missing its dimensions or data type.'.format(f))
+        return None, None
+    if int(hdict.get('byte order') or 0) == 1:
+        dt = dt.newbyteorder('>')
+    else:
+        dt = dt.newbyteorder('<')
+    offset = int(hdict.get('header offset') or 0)
+    interleave = (hdict.get('interleave') or 'bsq').lower()
+    if interleave == 'bil':
+        data = numpy.memmap(f, dtype = dt, mode = mode, offset = offset, shape = (lines, bands, samples)).transpose(1, 0, 2)
+    elif interleave == 'bip':
+        data = numpy.memmap(f, dtype = dt, mode = mode, offset = offset, shape = (lines, samples, bands)).transpose(2, 0, 1)
+    else:
+        data = numpy.memmap(f, dtype = dt, mode = mode, offset = offset, shape = (bands, lines, samples))
+    return data, envigeotrans(hdict)
+
+class ENVIfiledata(object):
+    # Raster data and output file name of an ENVIfile
+    __slots__ = ('data', 'outfilename')
+    
+    def __init__(self):
+        self.data = None
+        self.outfilename = None
+
+class ENVIheaderdata(object):
+    # Header of an ENVIfile. Header lines are stored as complete lines, ending in a newline, or None if they are not written.
+    __slots__ = ('hdr', 'dict', 'headerstr', 'description', 'samples', 'lines', 'bands', 'datatype', 'datatypeval', 'interleave', 
+                 'headeroffset', 'byteorder', 'mapinfo', 'projinfo', 'gcsstring', 'bandnames', 'dataignorevalue', 'classes', 'classnames', 
+                 'classvalues', 'classlookup', 'classlookuptable', 'classname', 'wavelength', 'fwhm', 'wavelengthunits', 'solarirradiance', 
+                 'defaultbands', 'sensortype', 'acqtime', 'acquisitiontime', 'parentrasters', 'geoTrans', 'landsat')
+    
+    def __init__(self):
+        for x in self.__slots__:
+            setattr(self, x, None)
+
+class ENVIheadertemplate(object):
+    # Header lines which only depend on a headerdict entry. These are formatted once per raster type and shared by all ENVIfile instances of that type.
+    __slots__ = ('description', 'bandnames', 'classes', 'classnames', 'classlookup', 'wavelength', 'fwhm', 'wavelengthunits', 'solarirradiance', 'dataignore')
+    
+    def __init__(self, d):
+        self.description = d['description'] # may contain %s for the SceneID
+        self.bandnames = self.classes = self.classnames = self.classlookup = None
+        self.wavelength = self.fwhm = self.wavelengthunits = self.solarirradiance = None
+        self.dataignore = d['data ignore value'] # formatted according to the data type of each file
+        if d['band names']:
+            self.bandnames = 'band names = {%s}\n'%''.join([', %s'%b for b in d['band names']])[1:]
+        if d['classes']:
+            self.classes = 'classes = %d\n'%d['classes']
+            self.classnames = 'class names = { %s}\n'%''.join([' %s,'%x for x in d['class names']])[:-1]
+            self.classlookup = 'class lookup = { %s}\n'%''.join([' %d,'%j for i in d['class lookup'] for j in i])[:-1]
+        if d['wavelength']:
+            self.wavelength = 'wavelength = {%s}\n'%''.join([', %f'%b for b in d['wavelength']])[1:]
+        if d['fwhm']:
+            self.fwhm = 'fwhm = {%s}\n'%''.join([', %f'%b for b in d['fwhm']])[1:]
+        if d['wavelength units']:
+            self.wavelengthunits = 'wavelength units= {%s}\n'%d['wavelength units']
+        if d['solar irradiance']:
+            self.solarirradiance = 'solar irradiance = {%s}\n'%''.join([', %f'%b for b in d['solar irradiance']])[1:]
+
+headertemplates = {} # ENVIheadertemplate for each raster type in headerdict
+
+def getheadertemplate(rastertype):
+    # This function returns the header template for a raster type, creating it on first use
+    template = headertemplates.get(rastertype)
+    if not template:
+        template = ENVIheadertemplate(headerdict[rastertype])
+        headertemplates[rastertype] = template
+    return template
+
 class ENVIfile(object):
+    __slots__ = ('file', 'header', 'outdir', 'SceneID', 'ProductID', 'rastertype', 'tilename', 'year', 'startyear', 'endyear', 'observationtype', 'mask')
     
     def __init__(self, data, rastertype, *args, **kwargs):
-        subclasses = self._subclass_container()
-        self.file = subclasses["file"]
-        self.header = subclasses["header"]
-        self.colorfile= subclasses["colorfile"]
-        del subclasses
+        self.file = ENVIfiledata()
+        self.header = ENVIheaderdata()
         
         # The variable 'data' can either be raster data or a string containing a file path. In the case of a file, it only prepares an ENVI file and possibly a colorfile.
         if sys.version_info.major == 2: # tests for cases where only a .hdr file and possibly a .clr need to be processed.
@@ -495,30 +639,14 @@ class ENVIfile(object):
         
         if not headeronly:
             self.header.interleave = 'interleave = bsq\n'
-            self.header.gcsstring = 'coordinate system string = {' + prj.ExportToWkt() + '}\n'
-            self.header.mapinfo = 'map info = {'
-            projname = prj.GetAttrValue('projcs')
-            self.header.mapinfo += '{}, 1, 1'.format(projname)
-            self.header.mapinfo += ', {}, {}, {}, {}'.format(self.header.geoTrans[0], self.header.geoTrans[3], abs(self.header.geoTrans[1]), abs(self.header.geoTrans[5]))
-            if ' UTM ' in projname:
-                if projname[-1:] == 'N':
-                    UTMnorth = 'North'
-                else: 
-                    UTMnorth = 'South'
-                i = projname.rfind(' ') + 1
-                UTMzone = projname[i:-1]
-                self.header.mapinfo += ', {}, {}'.format(UTMzone, UTMnorth)
-            unitval = prj.GetAttrValue('unit')
-            if unitval.lower() == 'metre':
-                unitval = 'Meters'
-            self.header.mapinfo += ', {}, units={}'.format(prj.GetAttrValue('datum'), unitval)
-            self.header.mapinfo += '}\n'
+            self.header.gcsstring = gcsstring
+            self.header.mapinfo = mapinfostr.format(self.header.geoTrans[0], self.header.geoTrans[3], abs(self.header.geoTrans[1]), abs(self.header.geoTrans[5]))
             self.header.projinfo = None
-            self.file.datadims(self)
+            self.datadims()
             self.getdictdata()
             self.header.hdr = self.file.outfilename.replace('.dat', '.hdr')
         else:
-            self.header.readheader(self)
+            self.readheader()
     
     def checkparentrasters(self, prdata): # this isn't currently implemented
         prtdata = prdata
@@ -536,45 +664,29 @@ class ENVIfile(object):
             self.header.parentrasters = 'parent rasters = {  }\n' # creates empty tag if improperly formatted data are sent
     
     def getdictdata(self):
-        # print('rastertype = %s'%self.rastertype)
-        # if self.rastertype in ['BT', 'ref'] and (self.SceneID.startswith('L') or self.landsat):
-        #     if self.rastertype == 'BT':
-        #         if int(self.landsat) == 8:
-        #             rtype = 'Landsat TIR'
-        #         else:
-        #             rtype = 'Landsat Band6'
-        #     elif self.SceneID.startswith('LC8') or self.SceneID.startswith('LO8'):
-        #         rtype = 'Landsat OLI'
-        #     else:
-        #         rtype = headerdict['Landsat'][self.SceneID[:3]]
-        #     print('headerdict: %s'%rtype)
-        #     d = headerdict[rtype].copy()
-        # else:
-        #     print('headerdict: %s'%self.rastertype)
+        # Fills in the header lines that come from the raster type's headerdict entry, or from a dictionary passed as headerdict
         ready = False
         if not self.header.dict:
-            if self.rastertype in headerdict.keys():
-                self.header.dict = headerdict[self.rastertype].copy()
-            else:
-                self.header.dict = headerdict['default'].copy()
-        elif 'ready' in self.header.dict.keys():
-            if self.header.dict['ready']:
-                ready = self.header.dict['ready']
+            rastertype = self.rastertype if self.rastertype in headerdict.keys() else 'default'
+            self.header.dict = headerdict[rastertype] # shared by all instances, so it is not modified
+            template = getheadertemplate(rastertype)
+        else:
+            template = ENVIheadertemplate(self.header.dict)
+            if 'ready' in self.header.dict.keys():
+                if self.header.dict['ready']:
+                    ready = self.header.dict['ready']
         
         if not self.header.description:
             if ready:
                 self.header.description = 'description = { %s}\n'%self.header.dict['description']
-            elif self.header.dict['description']:
-                self.header.description = 'description = { %s}\n'%(self.header.dict['description']%(self.SceneID))
+            elif template.description:
+                self.header.description = 'description = { %s}\n'%(template.description%(self.SceneID))
             else:
                 self.header.description = 'description = { Raster data}\n'
         
         if not self.header.bandnames:
-            if self.header.dict['band names']:
-                bnames = ''
-                for b in self.header.dict['band names']:
-                    bnames += ', %s'%b
-                self.header.bandnames = 'band names = {%s}\n'% bnames[1:]
+            if template.bandnames:
+                self.header.bandnames = template.bandnames
             else:
                 bnames = ''
                 if self.header.bands > 0:
@@ -585,58 +697,22 @@ class ENVIfile(object):
         if not self.file.outfilename:
             if ready:
                 self.file.outfilename = os.path.join(self.outdir,self.header.dict['defaultbasefilename'])
-            # print(self.header.dict['defaultbasefilename'])
             else:
                 self.file.outfilename = os.path.join(self.outdir,self.header.dict['defaultbasefilename']%self.SceneID)
         
         if not self.header.classes:
-            if self.header.dict['classes']:
-                self.header.classes = 'classes = %d\n'%self.header.dict['classes']
-                outstr=''
-                for x in self.header.dict['class names']:
-                    outstr+=' %s,'%x
-                self.header.classnames = 'class names = { %s}\n'%outstr[:-1]
-                outstr=''
-                for i in self.header.dict['class lookup']:
-                    for j in i:
-                        outstr+=' %d,'%j
-                self.header.classlookup = 'class lookup = { %s}\n'%outstr[:-1]
-            else:
-                self.header.classes = self.header.classnames = self.header.classlookup = None
-        
-        if self.header.dict['wavelength']:
-            wavelengths = ''
-            for b in self.header.dict['wavelength']:
-                wavelengths += ', %f'%b
-            self.header.wavelength = 'wavelength = {%s}\n'% wavelengths[1:]
-        else:
-            self.header.wavelength = None
-        
-        if self.header.dict['fwhm']:
-            fwhm = ''
-            for b in self.header.dict['fwhm']:
-                fwhm += ', %f'%b
-            self.header.fwhm = 'fwhm = {%s}\n'% fwhm[1:]
-        else:
-            self.header.fwhm = None
-        
-        if self.header.dict['wavelength units']:
-            wavelengths = ''
-            self.header.wavelengthunits = 'wavelength units= {%s}\n'% self.header.dict['wavelength units']
-        else:
-            self.header.wavelengthunits = None
+            self.header.classes = template.classes
+            self.header.classnames = template.classnames
+            self.header.classlookup = template.classlookup
         
-        if self.header.dict['solar irradiance']:
-            solarirradiance = ''
-            for b in self.header.dict['solar irradiance']:
-                solarirradiance += ', %f'%b
-            self.header.solarirradiance = 'solar irradiance = {%s}\n'% solarirradiance[1:]
-        else:
-            self.header.solarirradiance = None
+        self.header.wavelength = template.wavelength
+        self.header.fwhm = template.fwhm
+        self.header.wavelengthunits = template.wavelengthunits
+        self.header.solarirradiance = template.solarirradiance
         
         dataignore = None
-        if not self.header.dataignorevalue and self.header.dict['data ignore value']:
-            dataignore = self.header.dict['data ignore value']
+        if not self.header.dataignorevalue and template.dataignore:
+            dataignore = template.dataignore
         if dataignore:
             if self.header.datatypeval >= 4 and self.header.datatypeval <= 9:
                 if isinstance(dataignore, str):
@@ -694,158 +770,152 @@ class ENVIfile(object):
             bufsize = self.file.data.shape[0] * self.file.data.shape[1] * self.file.data.dtype.itemsize
         else:
             bufsize = self.file.data.shape[1] * self.file.data.shape[2] * self.file.data.dtype.itemsize
-        with open(self.file.outfilename, 'wb', bufsize) as fout:
-            fout.write(self.file.data.tostring())
+        # The data are written to a hidden temporary file which then replaces the output file, so other processes never see a partly written file
+        tmpfile = os.path.join(os.path.dirname(self.file.outfilename), '.{}.{}.tmp'.format(os.path.basename(self.file.outfilename), os.getpid()))
+        with open(tmpfile, 'wb', bufsize) as fout:
+            if self.file.data.flags.c_contiguous:
+                self.file.data.tofile(fout) # written straight from the array buffer, without a copy
+            else:
+                bands = self.file.data if len(self.file.data.shape) == 3 else [self.file.data]
+                for band in bands: # only one band at a time is copied
+                    numpy.ascontiguousarray(band).tofile(fout)
+        os.replace(tmpfile, self.file.outfilename)
         self.WriteHeader()
         print('%s has been written to disk.'%os.path.basename(self.file.outfilename))
         self.file.data = None
     
     def WriteHeader(self):
         # Shamelessly adapted from http://pydoc.net/Python/spectral/0.17/spectral.io.envi/
-        self.header.prepheader(self)
+        self.prepheader()
         if os.path.exists(self.header.hdr):
             now = datetime.datetime.now()
             bak = '%s.%s.bak'%(self.header.hdr, now.strftime('%Y%m%d_%H%M%S'))
-            shutil.move(self.header.hdr,bak)
-        with open(self.header.hdr,'w') as output:
+            shutil.copy2(self.header.hdr,bak)
+        tmpfile = os.path.join(os.path.dirname(self.header.hdr), '.{}.{}.tmp'.format(os.path.basename(self.header.hdr), os.getpid()))
+        with open(tmpfile,'w') as output:
             output.write(self.header.headerstr)
+        os.replace(tmpfile, self.header.hdr)
         if self.header.classes:
-            self.colorfile.writeclr(self)
+            self.writeclr()
     
-    def _subclass_container(self):
-        _parent_class = self # Create access to parent class.
+    def datadims(self):
+        dims = self.file.data.shape
+        
+        if len(dims) == 3:
+            self.header.bands = 'bands = %d\n'%dims[0]
+            self.header.lines = 'lines = %d\n'%dims[1]
+            self.header.samples = 'samples = %d\n'%dims[2]
+        else:
+            self.header.lines = 'lines = %d\n'%dims[0]
+            self.header.samples = 'samples = %d\n'%dims[1]
+            self.header.bands = 'bands = 1\n'
+        self.header.datatypeval = int(dtype_to_envi[str(self.file.data.dtype)])
+        self.header.datatype = 'data type = %d\n'%self.header.datatypeval
+        return
     
-        class file:
-            def __init__(self):
-                self._parent_class = _parent_class # Easy access from self.
-                # self.data = None
-                # self.outfilename = None
+    def readheader(self):
+        if not os.path.exists(self.header.hdr):
+            print("Error, header file missing: %s"%self.header.hdr)
             
-            def datadims(self):
-                dims = self.file.data.shape
-                
-                if len(dims) == 3:
-                    self.header.bands = 'bands = %d\n'%dims[0]
-                    self.header.lines = 'lines = %d\n'%dims[1]
-                    self.header.samples = 'samples = %d\n'%dims[2]
-                else:
-                    self.header.lines = 'lines = %d\n'%dims[0]
-                    self.header.samples = 'samples = %d\n'%dims[1]
-                    self.header.bands = 'bands = 1\n'
-                # print(self.data.dtype)
-                self.header.datatypeval = int(dtype_to_envi[str(self.file.data.dtype)])
-                self.header.datatype = 'data type = %d\n'%self.header.datatypeval
-                return
-   
-        class header:
-            def __init__(self):
-                self._parent_class = _parent_class # Easy access from self.
-                        
-            def readheader(self):
-                if not os.path.exists(self.header.hdr):
-                    print("Error, header file missing: %s"%self.header.hdr)
-                    
-                    return
-                with open(self.header.hdr,'r') as inhdrlines:
-                    openline = False
-                    for line in inhdrlines:
-                        if not line.startswith('ENVI'):
-                            if not openline:
-                                i = line.find(' = ')
-                                if i > 0:
-                                    if line.startswith('interleave'):
-                                        self.header.interleave = line
-                                    elif line.startswith('lines'):
-                                        self.header.lines = line
-                                    elif line.startswith('samples'):
-                                        self.header.samples = line
-                                    elif line.startswith('bands'):
-                                        self.header.bands = line
-                                    elif line.startswith('data type'):
-                                        self.header.datatype = line
-                                        i = line.find('=') + 1
-                                        self.header.datatypeval = int(line[i:])
-                                    elif line.startswith('byte order'):
-                                        self.header.byteorder = line
-                                    elif line.startswith('header offset'):
-                                        self.header.headeroffset = line
-                                    elif line.startswith('map info'):
-                                        self.header.mapinfo = line
-                                    elif line.startswith('projection info'):
-                                        self.header.projinfo = line
-                                    elif line.startswith('coordinate system string'):
-                                        self.header.gcsstring = line
-                                    elif line.startswith('acquisition time'):
-                                        self.header.acquisitiontime = line
-                            
-                self.getdictdata()
-                
-                return 
-            
-            def prepheader(self):
-                self.header.headerstr = 'ENVI\n'
-                for x in [self.header.description, self.header.samples, self.header.lines, self.header.bands, self.header.datatype, self.header.interleave]:
-                    self.header.headerstr += x
-                if self.header.classes:
-                    self.header.headerstr += 'file type = ENVI Classification\n'
-                elif self.mask:
-                    self.header.headerstr += 'file type = ENVI Mask\n'
-                else:
-                    self.header.headerstr += 'file type = ENVI Standard\n'
-                for x in [self.header.headeroffset, self.header.byteorder, self.header.mapinfo, self.header.projinfo, self.header.gcsstring, self.header.bandnames]:
-                    if x:
-                        self.header.headerstr += x
-                if self.header.dataignorevalue:
-                    self.header.headerstr += self.header.dataignorevalue
-                if self.header.classes:
-                    for x in [self.header.classes, self.header.classnames, self.header.classlookup]:
-                        self.header.headerstr += x
-                if self.header.wavelength:
-                    self.header.headerstr += self.header.wavelength
-                if self.header.fwhm:
-                    self.header.headerstr += self.header.fwhm
-                if self.header.wavelengthunits:
-                    self.header.headerstr += self.header.wavelengthunits       
-                if self.header.solarirradiance:
-                    self.header.headerstr += self.header.solarirradiance
-                if self.header.defaultbands:
-                    self.header.headerstr += self.header.defaultbands
-                if self.header.sensortype:
-                    self.header.headerstr += 'sensor type = %s\n'%self.header.sensortype
-                if self.header.acquisitiontime:
-                    self.header.headerstr += self.header.acquisitiontime
-                if self.header.parentrasters:
-                    if isinstance(self.header.parentrasters, list):
-                        if len(self.header.parentrasters) > 0:
-                            parentrasterstr = 'parent rasters = { '
-                            for item in self.header.parentrasters:
-                                if self.header.parentrasters.index(item) > 0:
-                                    parentrasterstr += ', '
-                                parentrasterstr += item
-                                parentrasterstr += ' }\n'
-                        else:
-                            parentrasterstr = ''
-                        self.header.parentrasters = parentrasterstr
-                        
-                    self.header.headerstr += self.header.parentrasters
-                return 
-                
-                        
-        class colorfile:
-            def __init__(self):
-                self._parent_class = _parent_class # Easy access from self.
-                
-            def writeclr(self): # creates a colorfile
-                if self.file.outfilename:
-                    clr = self.file.outfilename.replace('.dat','.clr')
-                else:
-                    clr = self.header.hdr.replace('.hdr','.clr')
-                if not 'class values' in self.header.dict.keys():
-                    self.header.dict['class values'] = list(range(len(self.header.dict['class lookup'])))
-                elif not self.header.dict['class values']:
-                    self.header.dict['class values'] = list(range(len(self.header.dict['class lookup'])))
-                with open(clr,'w') as output:
-                    for i, rgb in zip(self.header.dict['class values'], self.header.dict['class lookup']):
-                        output.write('%d %d %d %d\n'%(i,rgb[0],rgb[1],rgb[2]))
+            return
+        with open(self.header.hdr,'r') as inhdr:
+            text = inhdr.read()
+        for m in hdrfieldre.finditer(text): # the lines are kept as they are
+            if m.group(1) in headerlines:
+                setattr(self.header, headerlines[m.group(1)], '%s\n'%m.group(0).lstrip())
+                if m.group(1) == 'data type':
+                    self.header.datatypeval = int(m.group(2))
         
-        return {"file": file, "header": header, "colorfile": colorfile} 
\ No newline at end of file
+        self.getdictdata()
+        
+        return 
+    
+    def prepheader(self):
+        # The header is assembled from its lines in a single join
+        if self.header.classes:
+            filetype = 'file type = ENVI Classification\n'
+            classlines = [self.header.classes, self.header.classnames, self.header.classlookup]
+        elif self.mask:
+            filetype = 'file type = ENVI Mask\n'
+            classlines = []
+        else:
+            filetype = 'file type = ENVI Standard\n'
+            classlines = []
+        if self.header.sensortype:
+            sensortype = 'sensor type = %s\n'%self.header.sensortype
+        else:
+            sensortype = None
+        if isinstance(self.header.parentrasters, list):
+            if len(self.header.parentrasters) > 0:
+                self.header.parentrasters = 'parent rasters = { %s }\n'%', '.join(self.header.parentrasters)
+            else:
+                self.header.parentrasters = ''
+        lines = ['ENVI\n', self.header.description, self.header.samples, self.header.lines, self.header.bands, self.header.datatype, self.header.interleave, filetype, 
+                 self.header.headeroffset, self.header.byteorder, self.header.mapinfo, self.header.projinfo, self.header.gcsstring, self.header.bandnames, 
+                 self.header.dataignorevalue] + classlines + [self.header.wavelength, self.header.fwhm, self.header.wavelengthunits, self.header.solarirradiance, 
+                 self.header.defaultbands, sensortype, self.header.acquisitiontime, self.header.parentrasters]
+        self.header.headerstr = ''.join([x for x in lines if x])
+        return 
+    
+    def writeclr(self): # creates a colorfile
+        if self.file.outfilename:
+            clr = self.file.outfilename.replace('.dat','.clr')
+        else:
+            clr = self.header.hdr.replace('.hdr','.clr')
+        classvalues = self.header.dict.get('class values')
+        if not classvalues:
+            classvalues = list(range(len(self.header.dict['class lookup'])))
+        with open(clr,'w') as output:
+            for i, rgb in zip(classvalues, self.header.dict['class lookup']):
+                output.write('%d %d %d %d\n'%(i,rgb[0],rgb[1],rgb[2]))
+
+class ENVIstream(object):
+    # Writes a BSQ ENVI file one band, or one block of rows, at a time, so the whole raster never has to be held in memory.
+    # Takes the shape (bands, lines, samples) or (lines, samples) and data type of the raster followed by the ENVIfile() arguments, e.g.:
+    # with ENVIstream((bands, rows, cols), 'int16', 'ref', outfilename = outfile, geoTrans = geoTrans) as out:
+    #     for band in bandlist:
+    #         out.write(band)
+    # Data must be written in file order. As with ENVIfile.Save(), the data go to a hidden temporary file which replaces the output file when closed.
+    def __init__(self, shape, dtype, rastertype, *args, **kwargs):
+        self.dtype = numpy.dtype(dtype)
+        self.envi = ENVIfile(numpy.broadcast_to(numpy.zeros(1, dtype = self.dtype), shape), rastertype, *args, **kwargs) # only the shape and data type are used for the header
+        self.envi.file.data = None
+        self.outfilename = self.envi.file.outfilename
+        self.nbytes = int(numpy.prod(shape)) * self.dtype.itemsize
+        self.written = 0
+        self.tmpfile = os.path.join(os.path.dirname(self.outfilename), '.{}.{}.tmp'.format(os.path.basename(self.outfilename), os.getpid()))
+        print('Writing raster to disk: %s'%self.outfilename)
+        self.fout = open(self.tmpfile, 'wb')
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+        return False
+    
+    def write(self, data):
+        # Appends a band or a block of rows to the file
+        data = numpy.ascontiguousarray(data, dtype = self.dtype) # no copy unless the data type or layout differ
+        if self.written + data.nbytes > self.nbytes:
+            raise ValueError('Too much data written to %s.'%self.outfilename)
+        data.tofile(self.fout)
+        self.written += data.nbytes
+    
+    def close(self):
+        self.fout.close()
+        if self.written != self.nbytes:
+            os.remove(self.tmpfile)
+            raise ValueError('Only %d of %d bytes were written to %s.'%(self.written, self.nbytes, self.outfilename))
+        os.replace(self.tmpfile, self.outfilename)
+        self.envi.WriteHeader()
+        print('%s has been written to disk.'%os.path.basename(self.outfilename))
+    
+    def abort(self):
+        # Discards the temporary file, leaving any existing output file as it was
+        self.fout.close()
+        if os.path.isfile(self.tmpfile):
+            os.remove(self.tmpfile)
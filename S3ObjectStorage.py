@@ -17,7 +17,7 @@
 # the appropriate submodules, with this one being used solely to interface 
 # with S3 object storage
 
-import os, sys, boto3, datetime # , argparse, glob
+import os, sys, boto3, datetime, threading # , argparse, glob
 # from subprocess import Popen
 from pkg_resources import resource_stream, resource_string, resource_filename, Requirement
 # from pkg_resources import resource_stream, resource_string, resource_filename, Requirement
@@ -311,6 +311,14 @@ def s3client():
     s3cli = boto3.client('s3', endpoint_url = url)
     return s3cli
 
+def getthreadresource():
+    # boto3 resources are not thread safe, so threads other than the main thread each get their own
+    if threading.current_thread() is threading.main_thread():
+        return s3res
+    if not hasattr(threadlocal, 's3res'):
+        threadlocal.s3res = s3resource()
+    return threadlocal.s3res
+
 # def getlocalbuckets(s3res, *args, **kwargs):
 #     localbuckets = []
 #     for bucket in s3res.buckets.all():
@@ -358,7 +366,7 @@ def download_s3_folder(bucket_name, s3_folder, local_dir):
         local_dir: a relative or absolute directory path in the local file system
         shamelessly borrowed from: https://stackoverflow.com/questions/49772151/download-a-folder-from-s3-using-boto3
     """
-    bucket = s3res.Bucket(bucket_name)
+    bucket = getthreadresource().Bucket(bucket_name)
     for obj in bucket.objects.filter(Prefix = s3_folder):
         target = obj.key if local_dir is None \
             else os.path.join(local_dir, os.path.relpath(obj.key, s3_folder))
@@ -538,11 +546,13 @@ def movefile(f, inbucket, outbucket, outf, *args, **kwargs):
                     'Bucket': inbucket,
                     'Key': f
                 }
+    s3res = getthreadresource()
     s3res.meta.client.copy(copy_source, outbucket, outf)
     s3res.Object(inbucket, f).delete()
     
 s3cli = s3client()
 s3res = s3resource()         
+threadlocal = threading.local()
 
 # def openS3(credentials, url):
 #     # bucketurl = '{}/{}'.format(url, bucket)
@@ -9,10 +9,18 @@
 
 # This contains code borrowed from the Python GDAL/OGR Cookbook: https://pcjericks.github.io/py-gdalogr-cookbook/
 
-import os, datetime, time, shutil, sys, glob, csv, ENVIfile, numpy, numexpr
+import os, datetime, time, shutil, sys, glob, csv, threading, hashlib, atexit, ENVIfile, numpy, numexpr
+from collections import OrderedDict
+from contextlib import ExitStack
 from subprocess import Popen
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pkg_resources import resource_stream, resource_string, resource_filename, Requirement
 from ENVIfile import *
+try: # file locks for tiles shared between processes
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 # Import GDAL
 # if not 'linux' in sys.platform: # this way I can use the same library for processing on multiple systems
@@ -66,6 +74,7 @@ nbrdir = config['Landsat']['nbrdir']
 catdir = config['DEFAULT']['catdir']
 archdir = config['DEFAULT']['archdir']
 logdir = config['DEFAULT']['logdir']
+tilelockdir = os.path.join(logdir, 'tilelocks') # Lock files for tiles being written. All processes ingesting into the same tiles must share this directory
 useProductID = config['Landsat']['useProductID']
 prjstr = config['Projection']['proj']
 projacronym = config['Projection']['projacronym']
@@ -131,6 +140,16 @@ qausemedcloud = False # Allow medium confidence cloud pixels to be treated as cl
 qausemedcirrus = True # Allow medium confidence cirrus pixels to be treated as clear
 qausehighcirrus = True # Allow high confidence cirrus pixels to be treated as clear
 qauseterrainocclusion = False # Allow terrain-occluded pixels to be treated as clear
+qamaskcachemb = 512 # Maximum size in MB of the cache of decoded QA masks shared by all products of a scene. Set to 0 to disable the cache
+usegdalcalc = False # Calibrate Landsat Collection 2 bands with gdal_calc.py subprocesses and intermediate files rather than through VRT scale and offset
+warpmemorylimit = 512 # Working memory in MB used by gdal.Warp when reprojecting scenes
+warpthreads = 'ALL_CPUS' # Number of threads used by gdal.Warp when reprojecting scenes, as an integer or 'ALL_CPUS'
+tilecachemb = 0 # Maximum size in MB of the write-back cache of tiles being merged in memory during a batch run. 0 disables the cache. See settilecache()
+catalogbusytimeout = 60000 # Time in ms that a process waits for another process to release its write lock on the catalog GeoPackage
+tileformat = 'ENVI' # Format in which tiles are stored in S3 object storage: 'ENVI' (.dat and .hdr files) or 'COG' (compressed cloud-optimised GeoTIFF). Tiles are always processed locally as ENVI files
+cogcompression = 'DEFLATE' # Compression of COG tiles: 'DEFLATE', 'ZSTD', or 'LZW'
+coglevel = 6 # DEFLATE or ZSTD compression level of COG tiles
+s2bandworkers = 4 # Number of threads used to extract Sentinel-2 bands concurrently. The remaining CPUs are shared between the JPEG2000 decoders
 
 if ':' in prjstr:
     i = prjstr.find(':') + 1
@@ -341,46 +360,114 @@ def makegrid(*args, **kwargs):
     inDataSource = None
 
 
+class TileRecord(object):
+    # Lightweight stand-in for a tile polygon feature. It supports GetField() and GetGeometryRef(), so it can be used wherever 
+    # an OGR tile feature was previously used, and unlike OGR features it can be passed to worker processes.
+    def __init__(self, fields, wkb, fieldname = 'Tile'):
+        self.fields = fields
+        self.wkb = wkb
+        self.name = fields[fieldname]
+        self.geom = None
+        self.envelope = self.GetGeometryRef().GetEnvelope() # minX, maxX, minY, maxY
+        self.windows = {}
+    
+    def GetField(self, fieldname):
+        return self.fields[fieldname]
+    
+    def GetGeometryRef(self):
+        if not self.geom:
+            self.geom = ogr.CreateGeometryFromWkb(self.wkb)
+        return self.geom
+    
+    def gridwindow(self, pixelsize):
+        # Returns the geotransform, columns, and rows of the tile for a given pixel size
+        if not pixelsize in self.windows.keys():
+            minX, maxX, minY, maxY = self.envelope
+            geoTrans = (minX, pixelsize, 0.0, maxY, 0.0, -pixelsize)
+            cols = int(round((maxX - minX) / pixelsize))
+            rows = int(round((maxY - minY) / pixelsize))
+            self.windows[pixelsize] = (geoTrans, cols, rows)
+        return self.windows[pixelsize]
+    
+    def __getstate__(self): # OGR geometries cannot be pickled, so they are rebuilt from WKB when needed
+        state = self.__dict__.copy()
+        state['geom'] = None
+        return state
+
+class TileIndex(object):
+    # In-memory index of a tile polygon layer. The layer is read once, and envelope tests are done on a numpy array before exact 
+    # intersection tests are run on the remaining candidates. Tiles are kept in layer order.
+    def __init__(self, layername = NTS, *args, **kwargs):
+        self.layername = layername
+        if layername == Sen2tiles:
+            self.fieldname = 'TILE_ID'
+        else:
+            self.fieldname = 'Tile'
+        if usePostGIS:
+            tile_ds = ogr.Open(ieogpkg, 0)
+        else:
+            driver = ogr.GetDriverByName("GPKG")
+            tile_ds = driver.Open(ieogpkg, 0)
+        tilelayer = tile_ds.GetLayer(layername)
+        self.records = []
+        for tile in tilelayer:
+            self.records.append(TileRecord(tile.items(), bytes(tile.GetGeometryRef().ExportToWkb()), fieldname = self.fieldname))
+        del tile_ds
+        self.tiledict = {r.name : r for r in self.records}
+        self.envelopes = numpy.array([r.envelope for r in self.records], dtype = numpy.float64).reshape(-1, 4)
+    
+    def __len__(self):
+        return len(self.records)
+    
+    def __iter__(self):
+        return iter(self.records)
+    
+    def __getitem__(self, tilename):
+        return self.tiledict[tilename]
+    
+    def names(self):
+        return [r.name for r in self.records]
+    
+    def intersecting(self, geom, *args, **kwargs):
+        # Returns the tiles which intersect an OGR geometry, optionally limited to those in tilelist
+        tilelist = kwargs.get('tilelist', None)
+        minX, maxX, minY, maxY = geom.GetEnvelope()
+        e = self.envelopes
+        candidates = numpy.flatnonzero((e[:, 0] <= maxX) & (e[:, 1] >= minX) & (e[:, 2] <= maxY) & (e[:, 3] >= minY))
+        tiles = []
+        for i in candidates:
+            tile = self.records[i]
+            if tilelist and not tile.name in tilelist:
+                continue
+            if tile.GetGeometryRef().Intersect(geom):
+                tiles.append(tile)
+        return tiles
+
+tileindexes = {} # TileIndex objects, loaded once per process for each tile layer
+
+def gettileindex(layername = NTS):
+    # Returns the cached TileIndex for a tile layer, loading it on first use
+    if not layername in tileindexes.keys():
+        tileindexes[layername] = TileIndex(layername)
+    return tileindexes[layername]
+
 def getfeaturesdict(*args, **kwargs):
+    # Returns a dictionary of TileRecord objects, keyed by tile name
     tiletype = kwargs.get('tiletype', None)
-    featuredict = {}
-    if usePostGIS:
-        tile_ds = ogr.Open(ieogpkg, 0)
-    else:
-        driver = ogr.GetDriverByName("GPKG")
-        tile_ds = driver.Open(ieogpkg, 0)
     if tiletype.lower() == 'sentinel2':
         tilelayername = Sen2tiles
-        fname = 'TILE_ID'
     else:
         tilelayername = NTS
-        fname = 'Tile'
-    tilelayer = tile_ds.GetLayer(tilelayername)
-    for tile in tilelayer:
-        featuredict[tile.GetField(fname)] = tile
-    del tile_ds
-    return featuredict
+    return gettileindex(tilelayername).tiledict.copy()
 
 
 def gettilelist(*args, **kwargs):
     tiletype = kwargs.get('tiletype', 'NTS')
-    tilelist = []
-    if usePostGIS:
-        tile_ds = ogr.Open(ieogpkg, 0)
-    else:
-        driver = ogr.GetDriverByName("GPKG")
-        tile_ds = driver.Open(ieogpkg, 0)
     if tiletype.lower() == 'sentinel2':
         tilelayername = Sen2tiles
-        fname = 'TILE_ID'
     else:
         tilelayername = NTS
-        fname = 'Tile'
-    tilelayer = tile_ds.GetLayer(tilelayername)
-    for tile in tilelayer:
-        tilelist.append(tile.GetField(fname))
-    del tile_ds
-    return tilelist
+    return gettileindex(tilelayername).names()
 
 def reproject(in_raster, out_raster, *args, **kwargs): # Converts raster to local projection
     rastertype = kwargs.get('rastertype', None)
@@ -389,17 +476,39 @@ def reproject(in_raster, out_raster, *args, **kwargs): # Converts raster to loca
     outdir = kwargs.get('outdir', None)
     rewriteheader = kwargs.get('rewriteheader', True)
     parentrasters = kwargs.get('parentrasters', None)
-    if os.access(in_raster, os.F_OK):
+    outformat = kwargs.get('outformat', 'ENVI') # GDAL output format. Any other format, e.g., 'VRT', or 'GTiff' with a /vsimem/ path, returns the open output dataset, which can be passed directly to converttotiles()
+    multithread = kwargs.get('multithread', True) # warp and read data in separate threads
+    warpMemoryLimit = kwargs.get('warpMemoryLimit', warpmemorylimit) # working memory of the warper in MB
+    numthreads = kwargs.get('numthreads', warpthreads) # number of warper threads, as an integer or 'ALL_CPUS'
+    if isinputfile(in_raster):
         src_ds = gdal.Open(in_raster)
         gt = src_ds.GetGeoTransform()
+        options = gdal.WarpOptions(format = outformat, dstSRS = prjstr, xRes = abs(gt[1]), yRes = abs(gt[5]), \
+                                   multithread = multithread, warpMemoryLimit = warpMemoryLimit, \
+                                   warpOptions = ['NUM_THREADS={}'.format(numthreads)])
+        out_ds = gdal.Warp(out_raster, src_ds, options = options)
         # Close datasets
         src_ds = None
-        p = Popen(['gdalwarp', '-t_srs', prjstr, '-tr', str(abs(gt[1])), str(abs(gt[5])), '-of', 'ENVI', in_raster, out_raster])
-        print(p.communicate())
+        if not out_ds:
+            print('Error, could not reproject {}.'.format(os.path.basename(in_raster)))
+            logerror(in_raster, 'Could not reproject file: {}'.format(gdal.GetLastErrorMsg()))
+            return None
+        if outformat != 'ENVI':
+            out_ds.FlushCache()
+            return out_ds
+        out_ds = None
         if rewriteheader:
             if isinstance(parentrasters, list):
                 parentrasters = makeparentrastersstring(parentrasters)
             ENVIfile(out_raster, rastertype, SceneID = sceneid, outdir = outdir, parentrasters = parentrasters).WriteHeader()
+        return out_raster
+
+def isinputfile(path):
+    # Checks whether an input file exists, including files on GDAL virtual file systems such as /vsitar/ and /vsizip/
+    if path.startswith('/vsi'):
+        return gdal.VSIStatL(path) != None
+    else:
+        return os.access(path, os.F_OK)
 
 def makeparentrastersstring(parentrasters):
     outline = 'parent rasters = { '
@@ -560,6 +669,215 @@ def pixel2world(geoMatrix, pixel, line):
   y = yDist * float(line) + ulY
   return (x, y)
 
+def getdataignorevalue(rastertype, SceneID):
+    # This function returns the header type and data ignore value used for tiles of a given raster type
+    if rastertype == 'ref': #, 'Landsat TIR', 'Landsat Band6']:
+        if SceneID[2:3] in ['8', '9']: # and not (rastertype in ['Landsat TIR', 'Landsat Band6']):
+            hdtype = headerdict['Landsat'][SceneID[:3]][rastertype]
+        else:
+            hdtype = headerdict['Landsat'][SceneID[:3]]
+    else:
+        hdtype = rastertype
+    ndval = headerdict[hdtype]['data ignore value']
+    if not ndval:
+        ndval = 0
+    return hdtype, ndval
+
+def gettilepixelsize(outbasename):
+    # Landsat tiles are 30 m, everything else (Sentinel-2) is 10 m
+    if outbasename.startswith('L'):
+        return 30
+    else:
+        return 10
+
+def warptotilegrid(src_ds, extent, pixelsize, ndval):
+    # This function warps a raster once onto the national tile grid. extent = [minX, minY, maxX, maxY] and must be aligned to the tile grid.
+    # The output is a MEM dataset from which individual tiles can be cut using readgridwindow()
+    cols = int(round((extent[2] - extent[0]) / pixelsize))
+    rows = int(round((extent[3] - extent[1]) / pixelsize))
+    return gdal.Warp('', src_ds, 
+                      outputBounds = extent,
+                      height = rows, width = cols, 
+                      dstSRS = prj, 
+                      dstNodata = ndval,
+                      format = "MEM")
+
+def isgridaligned(ds, geoTrans):
+    # This function determines whether a raster is on the same grid as a tile: same projection, no rotation, same pixel size, 
+    # and pixel edges that coincide with those of the tile. If so, tile data can be read directly from the raster without warping.
+    gt = ds.GetGeoTransform()
+    if gt[2] != 0 or gt[4] != 0 or abs(gt[1] - geoTrans[1]) > 1e-6 or abs(gt[5] - geoTrans[5]) > 1e-6:
+        return False
+    xoff = (geoTrans[0] - gt[0]) / gt[1]
+    yoff = (geoTrans[3] - gt[3]) / gt[5]
+    if abs(xoff - round(xoff)) > 1e-6 or abs(yoff - round(yoff)) > 1e-6:
+        return False
+    wkt = ds.GetProjection()
+    if not wkt:
+        return False
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(wkt)
+    return bool(srs.IsSame(prj))
+
+def openenvitile(outfile, hdict, rows, cols, bands, dt, *args, **kwargs):
+    # This function opens an existing ENVI tile as a numpy.memmap with shape (bands, rows, cols) so that it can be updated in place. 
+    # hdict is the output of readenvihdr(). Returns None if the file is not a headerless BSQ file of the expected dimensions and data type.
+    mode = kwargs.get('mode', 'r+')
+    interleave = hdict.get('interleave') or 'bsq'
+    if interleave.lower() != 'bsq' or int(hdict.get('header offset') or 0) != 0:
+        return None
+    if int(hdict.get('samples') or 0) != cols or int(hdict.get('lines') or 0) != rows or int(hdict.get('bands') or 1) != bands:
+        return None
+    if envi_to_dtype.get(str(hdict.get('data type')).strip()) != dt:
+        return None
+    if os.path.getsize(outfile) != bands * rows * cols * numpy.dtype(dt).itemsize:
+        return None
+    return openenvi(outfile, mode = mode, hdict = hdict)[0]
+
+envistructfields = ['samples', 'lines', 'bands', 'data type', 'interleave', 'header offset', 'byte order', 'file type', 'map info', 'projection info', 'coordinate system string'] # ENVI header fields stored in the GeoTIFF structure of COG tiles
+
+def envitocog(f, *args, **kwargs):
+    # This function converts an ENVI tile to an internally tiled, compressed cloud-optimised GeoTIFF with overviews. The other ENVI header fields
+    # are kept as GDAL metadata items with an ENVI_ prefix, e.g. ENVI_parent_rasters, so that cogtoenvi() can restore the header. Returns the COG file name.
+    outfile = kwargs.get('outfile', os.path.splitext(f)[0] + '.tif')
+    compression = kwargs.get('compression', cogcompression)
+    resampling = kwargs.get('resampling', 'NEAREST') # overview resampling. NEAREST keeps QA bit flags and classes intact
+    metadata = []
+    for key, val in parseenvihdr(os.path.splitext(f)[0] + '.hdr').items():
+        if val and not key in envistructfields:
+            if isinstance(val, list):
+                val = '{%s}' % ', '.join(val)
+            metadata.append('ENVI_{}={}'.format(key.replace(' ', '_'), val.replace('\n', ' ')))
+    options = ['COMPRESS={}'.format(compression), 'PREDICTOR=YES', 'BLOCKSIZE=512', 'OVERVIEWS=AUTO', 'RESAMPLING={}'.format(resampling), 'NUM_THREADS=ALL_CPUS']
+    if compression in ['DEFLATE', 'ZSTD']:
+        options.append('LEVEL={}'.format(coglevel))
+    print('Converting {} to COG: {}'.format(os.path.basename(f), os.path.basename(outfile)))
+    out_ds = gdal.Translate(outfile, f, format = 'COG', creationOptions = options, metadataOptions = metadata)
+    out_ds = None
+    return outfile
+
+def cogtoenvi(f, *args, **kwargs):
+    # This function converts a COG tile written by envitocog() back to an ENVI tile, restoring the ENVI header fields kept in its metadata.
+    # Returns the ENVI file name.
+    outfile = kwargs.get('outfile', os.path.splitext(f)[0] + '.dat')
+    src_ds = gdal.Open(f)
+    fields = OrderedDict()
+    for key, val in src_ds.GetMetadata().items():
+        if key.startswith('ENVI_'):
+            fields[key[5:].replace('_', ' ')] = val
+    print('Converting COG {} to ENVI: {}'.format(os.path.basename(f), os.path.basename(outfile)))
+    out_ds = gdal.Translate(outfile, src_ds, options = gdal.TranslateOptions(options = ['-nomd'], format = 'ENVI'))
+    out_ds = None
+    src_ds = None
+    hdr = os.path.splitext(outfile)[0] + '.hdr'
+    with open(hdr, 'r') as lines:
+        text = lines.read()
+    headerstr = 'ENVI\n'
+    for m in hdrfieldre.finditer(text): # fields written by GDAL, unless they are in the metadata
+        if not m.group(1) in fields:
+            headerstr += '{}\n'.format(m.group(0).strip())
+    for key, val in fields.items():
+        if key == 'description':
+            val = '{ %s}' % val
+        headerstr += '{} = {}\n'.format(key, val)
+    tmpfile = os.path.join(os.path.dirname(hdr), '.{}.{}.tmp'.format(os.path.basename(hdr), os.getpid()))
+    with open(tmpfile, 'w') as output:
+        output.write(headerstr)
+    os.replace(tmpfile, hdr)
+    if os.path.isfile(outfile + '.aux.xml'):
+        os.remove(outfile + '.aux.xml')
+    return outfile
+
+def gettileuploadlist(filelist):
+    # This function returns the files to upload to S3 object storage for a list of local tile files, according to tileformat.
+    # For COG tiles, ENVI .dat files are converted to COGs, which replace the .dat and .hdr files in the list.
+    if tileformat != 'COG':
+        return filelist
+    outlist = []
+    for f in filelist:
+        if f.endswith('.dat'):
+            outlist.append(envitocog(f))
+        elif not (f.endswith('.hdr') or f.endswith('.tif')):
+            outlist.append(f)
+    return outlist
+
+def downloadtilefile(outdir, bucket, s3_object):
+    # This function downloads a tile file from S3 object storage. COG tiles are converted to local ENVI files, whatever the setting of tileformat.
+    # Returns the local file name.
+    import S3ObjectStorage # also used by scripts when useS3 is not set in the configuration
+    S3ObjectStorage.downloadfile(outdir, bucket, s3_object)
+    localfile = os.path.join(outdir, os.path.basename(s3_object))
+    if localfile.endswith('.tif'):
+        tiffile = localfile
+        localfile = cogtoenvi(tiffile)
+        os.remove(tiffile)
+    return localfile
+
+def readgridwindow(ds, bandnum, geoTrans, cols, rows, ndval, dt):
+    # This function reads the part of a raster band that covers a tile, where the raster is on the same grid as the tile.
+    # geoTrans, cols, and rows describe the tile. Tile pixels falling outside of the raster, or equal to the band's no data value, are set to ndval.
+    gt = ds.GetGeoTransform()
+    band = ds.GetRasterBand(bandnum)
+    xoff = int(round((geoTrans[0] - gt[0]) / gt[1]))
+    yoff = int(round((geoTrans[3] - gt[3]) / gt[5]))
+    x0, y0 = max(xoff, 0), max(yoff, 0)
+    x1, y1 = min(xoff + cols, ds.RasterXSize), min(yoff + rows, ds.RasterYSize)
+    if x0 == xoff and y0 == yoff and x1 - x0 == cols and y1 - y0 == rows:
+        data = band.ReadAsArray(xoff, yoff, cols, rows)
+    else:
+        data = numpy.full((rows, cols), ndval, dtype = dt)
+        if x1 > x0 and y1 > y0:
+            data[y0 - yoff : y1 - yoff, x0 - xoff : x1 - xoff] = band.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+    srcndval = band.GetNoDataValue()
+    if srcndval is not None and srcndval != ndval:
+        data[data == srcndval] = ndval
+    return data
+
+
+def gettilefieldnamedict(rastertype, *args, **kwargs):
+    # This function returns the dictionary of catalog fields which list the tiles for each product type
+    CalcVIs = kwargs.get('CalcVIs', False)
+    CalcNDVI = kwargs.get('CalcNDVI', True)
+    CalcEVI = kwargs.get('CalcEVI', True)
+    CalcNBR = kwargs.get('CalcNBR', True)
+    CalcNDTI = kwargs.get('CalcNDTI', True)
+    fieldnamedict = {#'Fmask' : 'Fmask_tiles',
+        'ref' : {'tiles' : '', 'fieldname' : 'Surface_reflectance_tiles', }
+        }
+    if not rastertype in ['Sentinel2', 'S2TM', 'S2OLI']:
+        appendict = {
+                     'pixel_qa' : {'tiles' : '', 'fieldname' : 'Pixel_QA_tiles'},
+                    'QA_RADSAT' : {'tiles' : '', 'fieldname' : 'Radsat_QA_tiles'},
+                    'SR_QA_AEROSOL' : {'tiles' : '', 'fieldname' : 'Aerosol_QA_tiles'},
+                    'Landsat ST' : {'tiles' : '', 'fieldname' : 'Surface_temperature_tiles',},}
+        for key in appendict.keys():
+            fieldnamedict[key] = appendict[key]
+        # 'Landsat TIR' : 'Brightness_temperature_tiles', #[, 'Landsat Band6'],
+        # 'Landsat Band6' : 'Brightness_temperature_tiles', #[, ],
+        # 'ref' : 'Surface_reflectance_tiles', #['Landsat TM', 'Landsat ETM+', 'Landsat OLI', 'Sentinel-2'],
+        if CalcVIs:
+            if CalcNDVI: fieldnamedict['NDVI'] = {'tiles' : '', 'fieldname' : 'NDVI_tiles'}
+            if CalcEVI: fieldnamedict['EVI'] = {'tiles' : '', 'fieldname' : 'EVI_tiles'}
+            if CalcNDTI: fieldnamedict['NDTI'] = {'tiles' : '', 'fieldname' : 'NDTI_tiles'}
+            if CalcNBR: fieldnamedict['NBR'] = {'tiles' : '', 'fieldname' : 'NBR_tiles'}
+    return fieldnamedict
+
+def getrastergeometry(ds):
+    # This function returns the footprint of a raster as an OGR polygon
+    gt = ds.GetGeoTransform()
+    minX = gt[0]
+    maxY = gt[3]
+    maxX = gt[0] + gt[1] * ds.RasterXSize
+    minY = gt[3] + gt[5] * ds.RasterYSize
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    ring.AddPoint(minX, maxY)
+    ring.AddPoint(maxX, maxY)
+    ring.AddPoint(maxX, minY)
+    ring.AddPoint(minX, minY)
+    ring.AddPoint(minX, maxY)
+    rasterGeometry = ogr.Geometry(ogr.wkbPolygon)
+    rasterGeometry.AddGeometry(ring)
+    return rasterGeometry
 
 def converttotiles(infile, outdir, rastertype, *args, **kwargs):
     # This function converts existing data to NTS tiles
@@ -585,26 +903,43 @@ def converttotiles(infile, outdir, rastertype, *args, **kwargs):
     CalcNBR = kwargs.get('CalcNBR', True)
     CalcNDTI = kwargs.get('CalcNDTI', True)
     tilelist = kwargs.get('tilelist', None)
+    warponce = kwargs.get('warponce', False) # Warp the scene once onto the tile grid and cut all tiles out of it, rather than warping once per tile
+    workers = kwargs.get('workers', 1) # Number of processes used to generate tiles. Values greater than 1 will use a process pool
+    blockrows = kwargs.get('blockrows', None) # If set, tiles are warped, merged, and written in strips of this many rows to limit memory use
     
     outtilelist = []
     acqtime = None
     sceneids = []
+    if isinstance(infile, gdal.Dataset): # e.g., a VRT or /vsimem/ dataset returned by reproject()
+        src_ds = infile
+        infile = src_ds.GetDescription()
+        if workers > 1 and not os.path.isfile(infile):
+            print('Warning: the input dataset is not on disk and cannot be opened by worker processes, tiles will be generated in a single process.')
+            workers = 1
+    else:
+        src_ds = None
     indir, inbasename = os.path.split(infile)
     
     if timestr:
         acqtime = f'acquisition time = {timestr}'
     elif datestr:
         acqtime = 'acquisition time = {}-{}-{}T10:30:00Z\n'.format(datestr[:4], datestr[4:6], datestr[6:])
-    elif infile.endswith('.vrt'):
-        with open(infile, 'r') as lines:
-            for line in lines:
-                if 'SourceFilename' in line:
-                    i = line.find('>') + 1
-                    j = line.rfind('<')
-                    fname = line[i:j]
-                    sceneids.append(os.path.basename(fname)[:21])
-                    if not acqtime:
-                        acqtime = envihdracqtime(line[i:j].replace('.dat', '.hdr'))
+    elif infile.endswith('.vrt') or (src_ds and src_ds.GetDriver().ShortName == 'VRT'):
+        if src_ds and src_ds.GetDriver().ShortName == 'VRT': # the dataset may only exist in memory
+            lines = src_ds.GetMetadata('xml:VRT')[0].splitlines()
+        else:
+            with open(infile, 'r') as vrtfile:
+                lines = vrtfile.read().splitlines()
+        for line in lines:
+            if 'SourceFilename' in line or 'SourceDataset' in line: # warped VRTs use SourceDataset
+                i = line.find('>') + 1
+                j = line.rfind('<')
+                fname = line[i:j]
+                if 'relativeToVRT="1"' in line:
+                    fname = os.path.join(indir, fname)
+                sceneids.append(os.path.basename(fname)[:21])
+                if not acqtime:
+                    acqtime = envihdracqtime(fname.replace('.dat', '.hdr'))
                     
     else:
         try:
@@ -633,13 +968,7 @@ def converttotiles(infile, outdir, rastertype, *args, **kwargs):
         outbasename = f'{satellite}_{datestr}'
     else: 
         datetuple = datetime.datetime.strptime(datestr, '%Y%m%d')
-    print('Opening tile layer.')
-    if usePostGIS:
-        tile_ds = ogr.Open(ieogpkg, 0)
-    else:
-        tile_ds = driver.Open(ieogpkg, 0)
-    tilelayer = tile_ds.GetLayer(tileshp)
-    print('Tile layer opened.')
+    tileindex = gettileindex(tileshp)
 #    hdr = isenvifile(infile)
 #    if hdr:
 #        headerdict = readenvihdr(hdr)
@@ -647,26 +976,16 @@ def converttotiles(infile, outdir, rastertype, *args, **kwargs):
 #        headerdict = None
 #    
 #    headerdict['ready'] = True
-    print(f'Opening input file: {infile}')
-    src_ds = gdal.Open(infile)
+    if not src_ds:
+        print(f'Opening input file: {infile}')
+        src_ds = gdal.Open(infile)
     gt = src_ds.GetGeoTransform()
     print('Getting scene geometry.')
     # if feature:
     #     rasterGeometry = feature.GetGeometryRef() # Sentinel-2, will also become default for Landsat in next version
     # elif not satellite: # Landsat only
         # create scene geometry polygon
-    minX = gt[0]
-    maxY = gt[3]
-    maxX = gt[0] + gt[1] * src_ds.RasterXSize
-    minY = gt[3] + gt[5] * src_ds.RasterYSize
-    ring = ogr.Geometry(ogr.wkbLinearRing)
-    ring.AddPoint(minX, maxY)
-    ring.AddPoint(maxX, maxY)
-    ring.AddPoint(maxX, minY)
-    ring.AddPoint(minX, minY)
-    ring.AddPoint(minX, maxY)
-    rasterGeometry = ogr.Geometry(ogr.wkbPolygon)
-    rasterGeometry.AddGeometry(ring)
+    rasterGeometry = getrastergeometry(src_ds)
     # else:
     #     rasterGeometry = feature.GetGeometryRef() # Sentinel-2, will also become default for Landsat in next version
     
@@ -676,25 +995,7 @@ def converttotiles(infile, outdir, rastertype, *args, **kwargs):
 #        'Surface_reflectance_tiles' : ['ref'], #['Landsat TM', 'Landsat ETM+', 'Landsat OLI', 'Sentinel-2'],
 #        'NDVI_tiles' : ['NDVI'],
 #        'EVI_tiles' : ['EVI']}
-    fieldnamedict = {#'Fmask' : 'Fmask_tiles',
-        'ref' : {'tiles' : '', 'fieldname' : 'Surface_reflectance_tiles', }
-        }
-    if not rastertype in ['Sentinel2', 'S2TM', 'S2OLI']:
-        appendict = {
-                     'pixel_qa' : {'tiles' : '', 'fieldname' : 'Pixel_QA_tiles'},
-                    'QA_RADSAT' : {'tiles' : '', 'fieldname' : 'Radsat_QA_tiles'},
-                    'SR_QA_AEROSOL' : {'tiles' : '', 'fieldname' : 'Aerosol_QA_tiles'},
-                    'Landsat ST' : {'tiles' : '', 'fieldname' : 'Surface_temperature_tiles',},}
-        for key in appendict.keys():
-            fieldnamedict[key] = appendict[key]
-        # 'Landsat TIR' : 'Brightness_temperature_tiles', #[, 'Landsat Band6'],
-        # 'Landsat Band6' : 'Brightness_temperature_tiles', #[, ],
-        # 'ref' : 'Surface_reflectance_tiles', #['Landsat TM', 'Landsat ETM+', 'Landsat OLI', 'Sentinel-2'],
-        if CalcVIs:
-            if CalcNDVI: fieldnamedict['NDVI'] = {'tiles' : '', 'fieldname' : 'NDVI_tiles'}
-            if CalcEVI: fieldnamedict['EVI'] = {'tiles' : '', 'fieldname' : 'EVI_tiles'}
-            if CalcNDTI: fieldnamedict['NDTI'] = {'tiles' : '', 'fieldname' : 'NDTI_tiles'}
-            if CalcNBR: fieldnamedict['NBR'] = {'tiles' : '', 'fieldname' : 'NBR_tiles'}
+    fieldnamedict = gettilefieldnamedict(rastertype, CalcVIs = CalcVIs, CalcNDVI = CalcNDVI, CalcEVI = CalcEVI, CalcNDTI = CalcNDTI, CalcNBR = CalcNBR)
     fieldname = None
     if rastertype in fieldnamedict.keys():
          fieldname = fieldnamedict[rastertype]['fieldname']
@@ -743,46 +1044,39 @@ def converttotiles(infile, outdir, rastertype, *args, **kwargs):
             fieldnamedict[key]['tiles'] = value
         else:
             fieldnamedict[key]['tiles'] = None
-    # tilelayer.StartTransaction()
-    # tilelayer.SetSpatialFilter(rasterGeometry)
-    if tilelist:
-        if len(tilelist) > 0:
-            for t in tilelist:
-                if tilelist.index(t) == 0:
-                    tileSQL = f'("Tile" = \'{t}\')'
-                else:
-                    tileSQL += f' OR ("Tile" = \'{t}\')'
-            tilelayer.SetAttributeFilter(tileSQL)
-    numtiles = tilelayer.GetFeatureCount()
+    tiles = tileindex.intersecting(rasterGeometry, tilelist = tilelist) # and not sceneid[9:16] in getbadlist():
+    numtiles = len(tiles)
     print(f'{numtiles} tiles intersect scene {sid}.')
+    warpedds = None
+    pooltiles = [] # tiles to be processed by the process pool, in layer order
+    if workers > 1 and warponce:
+        print('Warning: warponce is not used when workers > 1, as each worker process warps its own tiles.')
+        warponce = False
     if numtiles > 0:
-        for tile in tilelayer:
-            tilegeom = tile.GetGeometryRef()
-            tilename = tile.GetField('Tile')
-    #                print(tilename)
-    #                print(tilegeom.Intersect(featgeom))
-            if tilegeom.Intersect(rasterGeometry): # and not sceneid[9:16] in getbadlist():
-                # intersect = tilegeom.Intersection(rasterGeometry)
-                if pixelqa:
-                    basedir = os.path.dirname(outdir)
-                    tileqafile = os.path.join(os.path.join(basedir, 'pixel_qa'), '{}_{}.dat'.format(outbasename, tilename))
-                    tileradsatfile = os.path.join(os.path.join(basedir, 'radsat_qa'), '{}_{}.dat'.format(outbasename, tilename))
-                    pixelqadata = gettileqamask(tileqafile, tileradsatfile, sid, land = True, water = True, snowice = True, usemedcloud = True, usehighcirrus = True, useterrainocclusion = True)
-                else: 
-                    pixelqadata = None
-                print('Now creating tile {} of type {} for SceneID {}.'.format(tilename, rastertype, sid))
-    #                    print(headerdict['description'])
+        if warponce and isgridaligned(src_ds, tiles[0].gridwindow(gettilepixelsize(outbasename))[0]):
+            print('Input raster is aligned with the tile grid, no warping is required.')
+        elif warponce:
+            envelopes = [tile.envelope for tile in tiles] # minX, maxX, minY, maxY
+            gridextent = [min(e[0] for e in envelopes), min(e[2] for e in envelopes), max(e[1] for e in envelopes), max(e[3] for e in envelopes)]
+            hdtype, ndval = getdataignorevalue(rastertype, sid)
+            print('Warping scene to tile grid.')
+            warpedds = warptotilegrid(src_ds, gridextent, gettilepixelsize(outbasename), ndval)
+        for tile in tiles:
+            tilename = tile.name
+            # intersect = tilegeom.Intersection(rasterGeometry)
+            if workers > 1:
+                pooltiles.append(tile)
+                continue
     #            try:
-                result = makerastertile(tile, src_ds, gt, outdir, outbasename, \
-                                        infile, rastertype, \
-                                        pixelqadata = pixelqadata, SceneID = sid, \
-                                        rewriteheader = rewriteheader, \
-                                        acqtime = acqtime, noupdate = noupdate, \
-                                        overwrite = overwrite, \
-                                        ProductID = ProductID, \
-                                          CalcVIs = CalcVIs, CalcNDVI = CalcNDVI, \
-                                          CalcEVI = CalcEVI, CalcNDTI = CalcNDTI, \
-                                          CalcNBR = CalcNBR)
+            result = maketile(tile, src_ds, gt, outdir, outbasename, \
+                                    infile, rastertype, sid, pixelqa, \
+                                    rewriteheader = rewriteheader, \
+                                    acqtime = acqtime, noupdate = noupdate, \
+                                    overwrite = overwrite, \
+                                    ProductID = ProductID, \
+                                      CalcVIs = CalcVIs, CalcNDVI = CalcNDVI, \
+                                      CalcEVI = CalcEVI, CalcNDTI = CalcNDTI, \
+                                      CalcNBR = CalcNBR, warpedds = warpedds, blockrows = blockrows)
     #            except Exception as e:
     #                logerror(outbasename, e)
     #                print('ERROR: {}: {}'.format(outbasename, e))
@@ -792,33 +1086,27 @@ def converttotiles(infile, outdir, rastertype, *args, **kwargs):
     #                print(e)
     ##                logerror(f, '{} {} {}'.format(exc_type, fname, exc_tb.tb_lineno))
     #                result = False
+            if result:
+                outtilelist.append(tilename)
+                if (layer or feature):  
+                    fieldnamestr, tilebaseset = updatetilefields(feature, fieldnamedict, fieldnamestr, tilename, outbasename, tilebasestr, tilebaseset)
+    if len(pooltiles) > 0:
+        # Each worker opens its own source dataset, as GDAL datasets cannot be passed between processes.
+        # Results are returned in submission order, so catalog fields are updated in the same order as the serial path.
+        print('Processing {} tiles using {} worker processes.'.format(len(pooltiles), workers))
+        tilekwargs = {'rewriteheader' : rewriteheader, 'acqtime' : acqtime, 'noupdate' : noupdate, 
+                      'overwrite' : overwrite, 'ProductID' : ProductID, 'CalcVIs' : CalcVIs, 
+                      'CalcNDVI' : CalcNDVI, 'CalcEVI' : CalcEVI, 'CalcNDTI' : CalcNDTI, 'CalcNBR' : CalcNBR, 
+                      'blockrows' : blockrows}
+        # Worker processes merge into the tiles on disk, so cached copies of these tiles are written first, as they would otherwise overwrite the workers' tiles later
+        flushtilecache(*[os.path.join(outdir, '{}_{}.dat'.format(outbasename, tile.name)) for tile in pooltiles])
+        jobs = [(infile, tile, outdir, outbasename, rastertype, sid, pixelqa, tilekwargs) for tile in pooltiles]
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            for tilename, result in executor.map(maketileworker, jobs):
                 if result:
                     outtilelist.append(tilename)
-                    if (layer or feature):  
-                    
-    #                        tilestr = feat.GetField('tiles')
-    #                tilestr = feat.GetField(fieldname)
-    #                if not tilestr:
-    #                    tilestr = tilename
-    #                else:
-    #                    tilestr += ',{}'.format(tilename)
-    #                feat.SetField(fieldname, tilestr)
-                        if not tilebasestr == outbasename and not tilebaseset:
-                            feature.SetField('Tile_filename_base', outbasename)
-                            tilebaseset = True
-                        for key in fieldnamedict.keys():
-                            if fieldnamedict[key]['tiles'] and not fieldnamestr:
-                                fieldnamestr = fieldnamedict[key]['tiles']
-                            fieldname = fieldnamedict[key]['fieldname']
-                            if not fieldnamestr:
-                                fieldnamestr = ''
-                            if not tilename in fieldnamestr:
-                                if len(fieldnamestr) == 0:
-                                    fieldnamestr = tilename
-                                else:
-                                    fieldnamestr += ',{}'.format(tilename)
-                                # setfieldnamestr = True
-                            feature.SetField(fieldname, fieldnamestr)
+                    if (layer or feature):
+                        fieldnamestr, tilebaseset = updatetilefields(feature, fieldnamedict, fieldnamestr, tilename, outbasename, tilebasestr, tilebaseset)
                 
                
                     
@@ -830,7 +1118,7 @@ def converttotiles(infile, outdir, rastertype, *args, **kwargs):
     if closeinfunc and layer:
         layer.SetFeature(feature)
     
-    del tile_ds
+    warpedds = None
     # if satellite:
     #     return outtilelist
     if len(outtilelist) > 0 and not feature:
@@ -841,11 +1129,166 @@ def converttotiles(infile, outdir, rastertype, *args, **kwargs):
         return outtilelist
     else:
         del src_ds        
-        del pixelqadata
         del data_source
         return None
 
 
+def convertscenetotiles(products, feature, *args, **kwargs):
+    # This function converts all of the products of a Landsat scene to tiles in a single pass, as an alternative to calling 
+    # converttotiles() once per product. products is a list of dicts with the keys 'infile', 'outdir', 'rastertype', and 'pixelqa', 
+    # in processing order. The pixel QA product must come before any product with 'pixelqa' set to True.
+    # Tile intersections are computed once per product, all products are then written tile by tile, and the QA mask for each tile 
+    # is decoded once and shared by all products through qamaskcache. Returns the updated catalog feature.
+    tileshp = kwargs.get('tileshp', NTS) 
+    rewriteheader = kwargs.get('rewriteheader', True)
+    overwrite = kwargs.get('overwrite', False) # overwrite existing files without updating, deleting any tiles first.
+    noupdate = kwargs.get('noupdate', False) # if set to True, will not update existing tiles with new data.
+    CalcVIs = kwargs.get('CalcVIs', False) # Calculate vegetation indices at time of tile generation
+    CalcNDVI = kwargs.get('CalcNDVI', True)
+    CalcEVI = kwargs.get('CalcEVI', True)
+    CalcNBR = kwargs.get('CalcNBR', True)
+    CalcNDTI = kwargs.get('CalcNDTI', True)
+    blockrows = kwargs.get('blockrows', None) # If set, tiles are warped, merged, and written in strips of this many rows to limit memory use
+    
+    tileindex = gettileindex(tileshp)
+    for product in products:
+        infile = product['infile']
+        inbasename = os.path.basename(infile)
+        product['sid'] = inbasename[:21] # optimised now for Landsat. Must change for IEO 2.0
+        datetuple = datetime.datetime.strptime(product['sid'][9:16], '%Y%j')
+        product['outbasename'] = '{}_{}'.format(inbasename[:3], datetuple.strftime('%Y%m%d'))
+        try:
+            product['acqtime'] = envihdracqtime(infile.replace('.dat', '.hdr'))
+        except:
+            product['acqtime'] = None
+        print(f'Opening input file: {infile}')
+        product['src_ds'] = gdal.Open(infile)
+        product['gt'] = product['src_ds'].GetGeoTransform()
+        product['tiles'] = [tile.name for tile in tileindex.intersecting(getrastergeometry(product['src_ds']))]
+        product['outtilelist'] = []
+        print('{} tiles intersect {} data for scene {}.'.format(len(product['tiles']), product['rastertype'], product['sid']))
+    
+    fieldnamedict = gettilefieldnamedict(products[0]['rastertype'], CalcVIs = CalcVIs, CalcNDVI = CalcNDVI, CalcEVI = CalcEVI, CalcNDTI = CalcNDTI, CalcNBR = CalcNBR)
+    for key in fieldnamedict.keys():
+        value = feature.GetField(fieldnamedict[key]['fieldname'])
+        if value:
+            fieldnamedict[key]['tiles'] = value
+        else:
+            fieldnamedict[key]['tiles'] = None
+    tilebasestr = feature.GetField('Tile_filename_base')
+    tilebaseset = False
+    fieldnamestr = feature.GetField(fieldnamedict[products[0]['rastertype']]['fieldname'])
+    
+    for tile in tileindex:
+        for product in products:
+            if not tile.name in product['tiles']:
+                continue
+            result = maketile(tile, product['src_ds'], product['gt'], product['outdir'], product['outbasename'], \
+                                    product['infile'], product['rastertype'], product['sid'], product['pixelqa'], \
+                                    rewriteheader = rewriteheader, \
+                                    acqtime = product['acqtime'], noupdate = noupdate, \
+                                    overwrite = overwrite, \
+                                      CalcVIs = CalcVIs, CalcNDVI = CalcNDVI, \
+                                      CalcEVI = CalcEVI, CalcNDTI = CalcNDTI, \
+                                      CalcNBR = CalcNBR, blockrows = blockrows)
+            if result:
+                product['outtilelist'].append(tile.name)
+                fieldnamestr, tilebaseset = updatetilefields(feature, fieldnamedict, fieldnamestr, tile.name, product['outbasename'], tilebasestr, tilebaseset)
+    
+    for product in products:
+        product['src_ds'] = None
+    return feature
+
+def updatetilefields(feature, fieldnamedict, fieldnamestr, tilename, outbasename, tilebasestr, tilebaseset):
+    # This function adds a newly written tile to the tile fields of a catalog feature. Returns updated fieldnamestr and tilebaseset values.
+    if not tilebasestr == outbasename and not tilebaseset:
+        feature.SetField('Tile_filename_base', outbasename)
+        tilebaseset = True
+    for key in fieldnamedict.keys():
+        if fieldnamedict[key]['tiles'] and not fieldnamestr:
+            fieldnamestr = fieldnamedict[key]['tiles']
+        fieldname = fieldnamedict[key]['fieldname']
+        if not fieldnamestr:
+            fieldnamestr = ''
+        if not tilename in fieldnamestr:
+            if len(fieldnamestr) == 0:
+                fieldnamestr = tilename
+            else:
+                fieldnamestr += ',{}'.format(tilename)
+            # setfieldnamestr = True
+        feature.SetField(fieldname, fieldnamestr)
+    return fieldnamestr, tilebaseset
+
+class TileLock(object):
+    # Exclusive lock on an output tile, held by a process while it reads, merges, and writes the tile and its vegetation indices.
+    # Scenes ingested in parallel processes thus only wait for each other on the tiles that they share.
+    # Lock files are kept in tilelockdir rather than next to the tiles, so they are not picked up by tile file searches.
+    def __init__(self, outfile):
+        if not os.path.isdir(tilelockdir):
+            os.makedirs(tilelockdir, exist_ok = True)
+        dirhash = hashlib.md5(os.path.abspath(os.path.dirname(outfile)).encode('utf-8')).hexdigest()[:8]
+        self.lockfile = os.path.join(tilelockdir, '{}_{}.lock'.format(os.path.basename(outfile), dirhash))
+        self.fh = None
+    
+    def __enter__(self):
+        self.fh = open(self.lockfile, 'a+')
+        if fcntl:
+            fcntl.flock(self.fh.fileno(), fcntl.LOCK_EX)
+        else:
+            self.fh.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self.fh.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError: # LK_LOCK gives up after 10 seconds
+                    pass
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl:
+            fcntl.flock(self.fh.fileno(), fcntl.LOCK_UN)
+        else:
+            self.fh.seek(0)
+            msvcrt.locking(self.fh.fileno(), msvcrt.LK_UNLCK, 1)
+        self.fh.close()
+        self.fh = None
+        return False
+
+def maketile(tile, src_ds, gt, outdir, outbasename, infile, rastertype, sid, pixelqa, *args, **kwargs):
+    # This function gets the QA mask for a tile, if required, and then creates the tile using makerastertile()
+    tilename = tile.GetField('Tile')
+    if pixelqa:
+        basedir = os.path.dirname(outdir)
+        tileqafile = os.path.join(os.path.join(basedir, 'pixel_qa'), '{}_{}.dat'.format(outbasename, tilename))
+        tileradsatfile = os.path.join(os.path.join(basedir, 'radsat_qa'), '{}_{}.dat'.format(outbasename, tilename))
+        flushtilecache(tileqafile, tileradsatfile) # QA tiles are read from disk
+        pixelqadata = gettileqamask(tileqafile, tileradsatfile, sid, land = True, water = True, snowice = True, usemedcloud = True, usehighcirrus = True, useterrainocclusion = True)
+    else: 
+        pixelqadata = None
+    print('Now creating tile {} of type {} for SceneID {}.'.format(tilename, rastertype, sid))
+#                    print(headerdict['description'])
+    with TileLock(os.path.join(outdir, '{}_{}.dat'.format(outbasename, tilename))):
+        return makerastertile(tile, src_ds, gt, outdir, outbasename, \
+                                infile, rastertype, \
+                                pixelqadata = pixelqadata, SceneID = sid, **kwargs)
+
+def maketileworker(job):
+    # Process pool worker used by converttotiles(workers > 1). Opens its own copy of the source raster, and returns (tilename, result).
+    # Errors are logged and re-raised, so that converttotiles() fails as it does when tiles are made in a single process.
+    infile, tile, outdir, outbasename, rastertype, sid, pixelqa, tilekwargs = job
+    tilename = tile.name
+    src_ds = gdal.Open(infile)
+    gt = src_ds.GetGeoTransform()
+    try:
+        result = maketile(tile, src_ds, gt, outdir, outbasename, infile, rastertype, sid, pixelqa, usetilecache = False, **tilekwargs)
+    except Exception as e:
+        print('ERROR: {}: {}'.format(tilename, e))
+        logerror(infile, 'Error creating tile {}: {}'.format(tilename, e))
+        raise
+    finally:
+        src_ds = None
+    return tilename, result
+
 def makerastertile(tile, src_ds, gt, outdir, outbasename, inrastername, rastertype, *args, **kwargs):
     # Adapted from IForDEO code starting on 9 July 2019
     # This function only processes individual tiles, and should be called from another function
@@ -861,20 +1304,22 @@ def makerastertile(tile, src_ds, gt, outdir, outbasename, inrastername, rasterty
     rewriteheader = kwargs.get('rewriteheader', True)
     bucket = kwargs.get('bucket', 'landsat')
     acqtime = kwargs.get('acqtime', None)
+    warpedds = kwargs.get('warpedds', None) # scene already warped onto the tile grid by converttotiles(warponce = True)
+    blockrows = kwargs.get('blockrows', None) # number of rows per strip when streaming the tile to disk
+    usetilecache = kwargs.get('usetilecache', tilecache.maxbytes > 0) # merge the tile in the write-back tile cache rather than on disk. blockrows is not used with the cache
     # intersect = kwargs.get('intersect', None)
     # noupdate = kwargs.get('noupdate', False) # This will prevent the function from updating the tile with new data
     # overwrite = kwargs.get('overwrite', False) # This will delete any existing tile data
     CalcVIs = kwargs.get('CalcVIs', False) # Calculate vegetation indices at time of tile generation
-    if CalcVIs:
-        CalcNDVI = kwargs.get('CalcNDVI', True)
-        CalcEVI = kwargs.get('CalcEVI', True)
-        CalcNBR = kwargs.get('CalcNBR', True)
-        CalcNDTI = kwargs.get('CalcNDTI', True)
+    CalcNDVI = kwargs.get('CalcNDVI', True)
+    CalcEVI = kwargs.get('CalcEVI', True)
+    CalcNBR = kwargs.get('CalcNBR', True)
+    CalcNDTI = kwargs.get('CalcNDTI', True)
     tilename = tile.GetField('Tile')
     tilegeom = tile.GetGeometryRef()
     outfile = os.path.join(outdir, '{}_{}.dat'.format(outbasename, tilename))
     parentrasters = [inrastername]
-    if useS3 and not overwrite:
+    if useS3 and not overwrite and not (os.path.isfile(outfile) and os.path.isfile(outfile.replace('.dat', '.hdr'))): # a local tile is at least as recent as the S3 copy, as it is only uploaded once a scene is complete. makerastertile() is called under TileLock by maketile()
         parts = outbasename.split('_')
         print(f'outbasename = {outbasename}')
         # if outbasename.startswith('S'):
@@ -882,33 +1327,24 @@ def makerastertile(tile, src_ds, gt, outdir, outbasename, inrastername, rasterty
         # else:
         #     prefix = '{}/{}/{}'.format(os.path.basename(outdir), tilename, parts[1][:4])
         s3flist = S3.getbucketfoldercontents(bucket, prefix, '')
-        for ext in ['dat', 'hdr']:
-            s3_object = '{}{}.{}'.format(prefix, outbasename, ext)
-            if s3_object in s3flist:
-                S3.downloadfile(outdir, bucket, s3_object)
-    if rastertype == 'ref': #, 'Landsat TIR', 'Landsat Band6']:
-        print('SceneID = {}'.format(SceneID))
-        if SceneID[2:3] in ['8', '9']: # and not (rastertype in ['Landsat TIR', 'Landsat Band6']):
-            hdtype = headerdict['Landsat'][SceneID[:3]][rastertype]
+        tilebasename = os.path.splitext(os.path.basename(outfile))[0]
+        if '{}{}.tif'.format(prefix, tilebasename) in s3flist: # COG tile
+            downloadtilefile(outdir, bucket, '{}{}.tif'.format(prefix, tilebasename))
         else:
-            hdtype = headerdict['Landsat'][SceneID[:3]]
-    else:
-        hdtype = rastertype
-    ndval = headerdict[hdtype]['data ignore value']
-    if not ndval:
-        ndval = 0
+            for ext in ['dat', 'hdr']:
+                s3_object = '{}{}.{}'.format(prefix, tilebasename, ext)
+                if s3_object in s3flist:
+                    downloadtilefile(outdir, bucket, s3_object)
+    if rastertype == 'ref':
+        print('SceneID = {}'.format(SceneID))
+    hdtype, ndval = getdataignorevalue(rastertype, SceneID)
     print('hdtype = {}, data ignore value = {}'.format(hdtype, ndval))
     if (os.path.isfile(outfile)) and (not overwrite) and (not update): # skips this tile if the tile is not to be overwritten or updated.
         print('The tile {} exists already on disk, and both overwrite and update flags are set to False. Skipping this tile,'.format(os.path.basename(tilename)))
         return False
     minX, maxX, minY, maxY = tilegeom.GetEnvelope()
-    if outbasename.startswith('L'):
-        pixelsize = 30
-    else:
-        pixelsize = 10
-    geoTrans = (minX, pixelsize, 0.0, maxY, 0.0, -pixelsize)
-    cols = int((maxX - minX) / pixelsize) # number of samples or columns
-    rows = int((maxY - minY) / pixelsize) # number of lines or rows
+    pixelsize = gettilepixelsize(outbasename)
+    geoTrans, cols, rows = tile.gridwindow(pixelsize) # cols = number of samples or columns, rows = number of lines or rows
     bands = src_ds.RasterCount
     print('Processing tile: {}'.format(tilename))
     dims = [minX, maxY, maxX, minY]
@@ -1022,9 +1458,25 @@ def makerastertile(tile, src_ds, gt, outdir, outbasename, inrastername, rasterty
     #        else:
         shape = (rows, cols)
         
-        outtile = numpy.full(shape, ndval, dtype = dt)
+        outtile = None
+        tilemm = None # existing or new tile opened as a numpy.memmap for in-place updates
+        tmpfile = None # temporary file that a new tile is streamed to, renamed to outfile once written
+        newtile = False
+        cacheentry = None
+        if usetilecache:
+            cacheentry = tilecache.get(outfile)
+        if os.path.isfile(outfile) and not os.path.isfile(outfile.replace('.dat', '.hdr')): # left behind by an interrupted write, as the header is written last
+            print('Warning: tile {} has no header file, deleting it and rebuilding the tile.'.format(os.path.basename(outfile)))
+            logerror(outfile, 'Tile data file without a header file, rebuilding tile.')
+            os.remove(outfile)
         
-        if os.path.isfile(outfile):
+        if cacheentry:
+            if os.path.basename(inrastername) in cacheentry['parentrasters']:
+                print('This scene has already been ingested into the tile. Skipping.')
+                return True
+            print('Merging into cached tile: {}'.format(os.path.basename(outfile)))
+            cacheentry['parentrasters'].append(os.path.basename(inrastername))
+        elif os.path.isfile(outfile):
             if not update:
                 print('update has been set to False, skipping file.')
                 return False
@@ -1032,7 +1484,6 @@ def makerastertile(tile, src_ds, gt, outdir, outbasename, inrastername, rasterty
                 print('Deleting existing tile.')
                 os.remove(outfile)
             else:
-                out_ds = gdal.Open(outfile)
                 outheaderdict = readenvihdr(outfile.replace('.dat', '.hdr'))
                 parentrasters = outheaderdict['parent rasters']
                 if len(parentrasters) > 0:
@@ -1044,62 +1495,180 @@ def makerastertile(tile, src_ds, gt, outdir, outbasename, inrastername, rasterty
                 else:
                     print('This scene has already been ingested into the tile. Skipping.')
                     return True
+                if not usetilecache: # updated in place under the TileLock held by maketile(), so only pages with new pixels are written
+                    tilemm = openenvitile(outfile, outheaderdict, rows, cols, bands, dt)
+                if not isinstance(tilemm, numpy.ndarray):
+                    out_ds = gdal.Open(outfile)
     #        else:
     #            outheaderdict = headerdict['default'].copy()
         else:
             parentrasters = makeparentrastersstring([os.path.basename(inrastername)])
         
-        tempDs = gdal.Warp('', src_ds, #xRes = geoTrans[1],
-                      # yRes = geoTrans[5], 
-                      outputBounds = tileextent,
-                      height = rows, width = cols, 
-                      dstSRS = prj, 
-                      dstNodata = ndval,#cutline = tile,
-                      # cropToCutline = True, cutlineLayer = tile,# resampleAlg = resample_alg,
-                      format = "MEM")
+        if blockrows and not usetilecache and not os.path.isfile(outfile):
+            tmpfile = os.path.join(os.path.dirname(outfile), '.{}.{}.tmp'.format(os.path.basename(outfile), os.getpid())) # renamed to outfile once all strips are written
+            tilemm = numpy.memmap(tmpfile, dtype = dt, mode = 'w+', shape = (bands, rows, cols))
+            newtile = True
+        elif blockrows and not isinstance(tilemm, numpy.ndarray):
+            print('Existing tile cannot be memory mapped, processing the whole tile in memory.')
+        
+        if warpedds:
+            tempDs = warpedds
+        elif isgridaligned(src_ds, geoTrans):
+            print('Input raster is aligned with the tile grid, reading tile data directly.')
+            tempDs = src_ds
+        elif isinstance(tilemm, numpy.ndarray) and blockrows:
+            tempDs = None # warped strip by strip below
+        else:
+            tempDs = gdal.Warp('', src_ds, #xRes = geoTrans[1],
+                          # yRes = geoTrans[5], 
+                          outputBounds = tileextent,
+                          height = rows, width = cols, 
+                          dstSRS = prj, 
+                          dstNodata = ndval,#cutline = tile,
+                          # cropToCutline = True, cutlineLayer = tile,# resampleAlg = resample_alg,
+                          format = "MEM")
         
-        for i in range(bands):
-            if os.path.isfile(outfile):
-                band = out_ds.GetRasterBand(i + 1).ReadAsArray()
+        if isinstance(tilemm, numpy.ndarray):
+            # Only pixels with new valid data are written to the tile file. If blockrows is set, this is done in strips of 
+            # blockrows rows, so that memory use is bounded by the strip size rather than the tile size.
+            if newtile:
+                print('Writing tile to disk in strips of {} rows: {}'.format(blockrows, outfile))
             else:
-                band = numpy.full((rows, cols), ndval, dtype = dt)
-            # tiledata = numpy.full((rows, cols), ndval, dtype = dt)
-            tiledata = tempDs.GetRasterBand(i + 1).ReadAsArray() # [py:ply, px:plx], ulx, uly, lrx, lry
+                print('Updating existing tile in place: {}'.format(outfile))
+            if blockrows:
+                step = blockrows
+            else:
+                step = rows
+            try:
+                for y0 in range(0, rows, step):
+                    y1 = min(y0 + step, rows)
+                    stripgt = (geoTrans[0], geoTrans[1], 0.0, geoTrans[3] + y0 * geoTrans[5], 0.0, geoTrans[5])
+                    if tempDs:
+                        stripDs = tempDs
+                    else:
+                        stripDs = warptotilegrid(src_ds, [stripgt[0], geoTrans[3] + y1 * geoTrans[5], tileextent[2], stripgt[3]], pixelsize, ndval)
+                    qastrip = pixelqatile[y0:y1]
+                    if newtile:
+                        tilemm[:, y0:y1, :] = ndval
+                    for i in range(bands):
+                        tiledata = readgridwindow(stripDs, i + 1, stripgt, cols, y1 - y0, ndval, dt)
+                        mask = numexpr.evaluate("((qastrip == 1) & (tiledata != ndval))")
+                        tilemm[i, y0:y1][mask] = tiledata[mask]
+                        tiledata = None
+                        mask = None
+                    stripDs = None
+                    qastrip = None
+                tilemm.flush()
+            except:
+                tilemm = None
+                if tmpfile and os.path.isfile(tmpfile):
+                    os.remove(tmpfile)
+                raise
+            tilemm = None
+            # The data are written before the header. A crash in between leaves either a header-less new tile, which is rebuilt on the 
+            # next run, or some merged pixels under the old header, which does not list the scene yet, so it is merged again on the next run.
+            if newtile:
+                os.replace(tmpfile, outfile)
+            vidata = numpy.memmap(outfile, dtype = dt, mode = 'r', shape = (bands, rows, cols))
+            if newtile: # ENVIfile only needs the shape and data type of the data to write the header
+                if bands > 1:
+                    outshape = (bands, rows, cols)
+                else:
+                    outshape = (rows, cols)
+                ENVIfile(numpy.broadcast_to(numpy.zeros(1, dtype = dt), outshape), rastertype, geoTrans = geoTrans, outfilename = outfile, parentrasters = parentrasters, SceneID = SceneID, acqtime = acqtime, ProductID = ProductID).WriteHeader()
+            else:
+                parentrasters = makeparentrastersstring(parentrasters)
+                ENVIfile(outfile, rastertype, parentrasters = parentrasters, SceneID = SceneID, acqtime = acqtime, ProductID = ProductID).WriteHeader()
+        else:
+            outstream = None
+            vibands = None # bands used by the vegetation indices, kept in memory while the tile is streamed so that they are not read back from disk
+            if bands > 1 and not usetilecache: # bands are streamed to disk as they are merged rather than stacked in memory
+                if isinstance(parentrasters, list):
+                    parentrasters = makeparentrastersstring(parentrasters)
+                outstream = ENVIstream((bands, rows, cols), dt, rastertype, geoTrans = geoTrans, outfilename = outfile, parentrasters = parentrasters, SceneID = SceneID, acqtime = acqtime, ProductID = ProductID)
+                if CalcVIs:
+                    bandnums = getvibandnumbers(os.path.basename(outfile), rastertype)
+                    vibandnums = [bandnums[b] for index, calc in [('NDVI', CalcNDVI), ('EVI', CalcEVI), ('NDTI', CalcNDTI), ('NBR', CalcNBR)] if calc for b in viformulas[index][0]]
+                    vibands = {}
+            try:
+                for i in range(bands):
+                    if cacheentry:
+                        band = cacheentry['data'][i] # merged in place
+                    elif os.path.isfile(outfile):
+                        band = out_ds.GetRasterBand(i + 1).ReadAsArray()
+                    else:
+                        band = numpy.full((rows, cols), ndval, dtype = dt)
+                    # tiledata = numpy.full((rows, cols), ndval, dtype = dt)
+                    tiledata = readgridwindow(tempDs, i + 1, geoTrans, cols, rows, ndval, dt) # [py:ply, px:plx], ulx, uly, lrx, lry
     #            print('pixelqatile shape:')
     #            print(pixelqatile.shape)
     #            print('tiledata shape:')
     #            print(tiledata.shape)
-            band[numexpr.evaluate("((pixelqatile == 1) & (tiledata != ndval))")] = tiledata[numexpr.evaluate("((pixelqatile == 1) & (tiledata != ndval))")]
-            if bands > 1:
-                bandarr.append(band)
-            else:
-                outtile = band
+                    band[numexpr.evaluate("((pixelqatile == 1) & (tiledata != ndval))")] = tiledata[numexpr.evaluate("((pixelqatile == 1) & (tiledata != ndval))")]
+                    if outstream:
+                        outstream.write(band)
+                        if vibands != None and i + 1 in vibandnums:
+                            vibands[i + 1] = band
+                    elif bands > 1:
+                        bandarr.append(band)
+                    else:
+                        outtile = band
             
-            band = None   
+                    band = None   
     #                indata = None
-            tiledata = None             
+                    tiledata = None             
+            except:
+                if outstream:
+                    outstream.abort() # leaves any existing tile as it was
+                raise
         
-        if bands > 1:
-            outtile = numpy.stack(bandarr)
-            bandarr = None
-        out_ds = None # close tile before it gets overwritten, if open
+            if cacheentry or outstream:
+                bandarr = None
+            elif bands > 1:
+                outtile = numpy.stack(bandarr)
+                bandarr = None
+            out_ds = None # close tile before it gets overwritten, if open
     #    if not inrastername in headerdict['parent rasters']:
     #        headerdict['parent rasters'].append(inrastername)
-        print('Writing to disk: {}'.format(outfile))
-        if isinstance(parentrasters, list):
-            pr = parentrasters[0]
-            if len(parentrasters) > 0:
-                for i in range(1, len(parentrasters)):
-                    pr += ',{}'.format(parentrasters[i])
-            parentrasters = pr
-#        print(outtile.shape)
-        ENVIfile(outtile, rastertype, geoTrans = geoTrans, outfilename = outfile, parentrasters = parentrasters, SceneID = SceneID, acqtime = acqtime, ProductID = ProductID).Save()
+            if usetilecache and (cacheentry or outtile.nbytes <= tilecache.maxbytes): # tiles larger than the cache are written directly
+                if not cacheentry:
+                    if not isinstance(parentrasters, list):
+                        parentrasters = [os.path.basename(inrastername)]
+                    data = outtile.reshape((bands, rows, cols))
+                    cacheentry = {'data' : data, 'rastertype' : rastertype, 'geoTrans' : geoTrans, 
+                                  'parentrasters' : parentrasters, 'SceneID' : SceneID, 'acqtime' : acqtime, 'ProductID' : ProductID, 
+                                  'CalcVIs' : CalcVIs, 'CalcNDVI' : CalcNDVI, 'CalcEVI' : CalcEVI, 'CalcNDTI' : CalcNDTI, 'CalcNBR' : CalcNBR}
+                    print('Caching tile in memory: {}'.format(os.path.basename(outfile)))
+                    tilecache.put(outfile, cacheentry, data.nbytes)
+                cacheentry = None
+                outtile = None
+                print('Tile has been merged in the tile cache.')
+                return True # the tile and its vegetation indices are written by writecachedtile()
+            if outstream:
+                outstream.close()
+                outstream = None
+                vidata = vibands
+                vibands = None
+            else:
+                print('Writing to disk: {}'.format(outfile))
+                if isinstance(parentrasters, list):
+                    pr = parentrasters[0]
+                    if len(parentrasters) > 0:
+                        for i in range(1, len(parentrasters)):
+                            pr += ',{}'.format(parentrasters[i])
+                    parentrasters = pr
+#            print(outtile.shape)
+                vidata = outtile
+                ENVIfile(outtile, rastertype, geoTrans = geoTrans, outfilename = outfile, parentrasters = parentrasters, SceneID = SceneID, acqtime = acqtime, ProductID = ProductID).Save()
         if CalcVIs:
             print('Calculating vegetation indices.')
             calcvis(outfile, qafile = None, useqamask = False, useTile = True, \
                           CalcNDVI = CalcNDVI, \
                           CalcEVI = CalcEVI, CalcNDTI = CalcNDTI, \
-                          CalcNBR = CalcNBR, inrastertype = rastertype)
+                          CalcNBR = CalcNBR, inrastertype = rastertype, \
+                          data = vidata, geoTrans = geoTrans, acqtime = acqtime, \
+                          parentrasters = envihdrparentrasterslist(outfile.replace('.dat', '.hdr'))) # the scenes merged into the tile, from the header just written
+        vidata = None
     #    p = Popen(['gdal_translate', '-projwin', extent[0], extent[1], extent[2], extent[3], '-of', 'ENVI', in_raster, out_raster])
     #    print(p.communicate())
     #    if rewriteheader:
@@ -1118,35 +1687,158 @@ def makerastertile(tile, src_ds, gt, outdir, outbasename, inrastername, rasterty
     
 ## Landsat import and VI calculation functions
 
+def gettileheader(f):
+    # This function returns the ENVI header fields of a tile: from the .hdr file of an ENVI tile, or from the ENVI_ metadata of a COG tile made by envitocog()
+    if not f.endswith('.tif'):
+        return parseenvihdr(os.path.splitext(f)[0] + '.hdr')
+    src_ds = gdal.Open(f)
+    if not src_ds:
+        raise OSError('Unable to open tile: {}'.format(f))
+    fields = {}
+    for key, val in src_ds.GetMetadata().items():
+        if key.startswith('ENVI_'):
+            if val.startswith('{') and val.endswith('}') and key != 'ENVI_description':
+                val = [x.strip() for x in val[1:-1].split(',')]
+            fields[key[5:].replace('_', ' ')] = val
+    src_ds = None
+    return fields
+
 def envihdrparentrasters(hdr):
-    # This function extracts the acquisition time from an ENVI header file
-    parentrasters = None
-    with open(hdr, 'r') as lines:
-        for line in lines:
-            if line.startswith('parent rasters'):
-                parentrasters = line
-    return parentrasters
+    # This function returns the parent rasters line of an ENVI header file
+    parentrasters = gettileheader(hdr).get('parent rasters')
+    if isinstance(parentrasters, list):
+        return makeparentrastersstring(parentrasters)
+    elif parentrasters:
+        return 'parent rasters = {}\n'.format(parentrasters)
+    return None
 
 def envihdrparentrasterslist(hdr):
-    # This function extracts the acquisition time from an ENVI header file
-    parentrasters = envihdrparentrasters(hdr)
-    if isinstance(parentrasters, str):
-        if '{' in parentrasters:
-            i = parentrasters.find('{') + 1
-            j = parentrasters.find('}')
-            parentrasters = parentrasters[i:j].strip().split(',')
-            if len(parentrasters) > 0:
-                return parentrasters
+    # This function returns the parent rasters of an ENVI header file as a list
+    parentrasters = gettileheader(hdr).get('parent rasters')
+    if isinstance(parentrasters, list) and len(parentrasters) > 0:
+        return list(parentrasters)
     return None
 
 def envihdracqtime(hdr):
     # This function extracts the acquisition time from an ENVI header file
-    acqtime = None
-    with open(hdr, 'r') as lines:
-        for line in lines:
-            if line.startswith('acquisition time'):
-                acqtime = line
-    return acqtime
+    acqtime = gettileheader(hdr).get('acquisition time')
+    if acqtime:
+        return 'acquisition time = {}\n'.format(acqtime)
+    return None
+
+class LRUCache(object):
+    # Least recently used cache with a size limit in bytes. Entries are evicted, oldest first, when the limit is exceeded. 
+    # If set, onevict(key, value) is called for each entry removed by eviction or flush().
+    def __init__(self, maxbytes, *args, **kwargs):
+        self.maxbytes = maxbytes
+        self.onevict = kwargs.get('onevict', None)
+        self.entries = OrderedDict() # key: (value, nbytes)
+        self.nbytes = 0
+        self.lock = threading.RLock()
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def __contains__(self, key):
+        return key in self.entries
+    
+    def keys(self):
+        with self.lock:
+            return list(self.entries.keys())
+    
+    def get(self, key, default = None):
+        with self.lock:
+            if not key in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+    
+    def put(self, key, value, nbytes):
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            if nbytes > self.maxbytes:
+                if self.onevict:
+                    self.onevict(key, value)
+                return
+            self.entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.maxbytes:
+                oldkey, (oldvalue, oldnbytes) = self.entries.popitem(last = False)
+                self.nbytes -= oldnbytes
+                if self.onevict:
+                    self.onevict(oldkey, oldvalue)
+    
+    def pop(self, key, default = None):
+        # Removes an entry without calling onevict
+        with self.lock:
+            if not key in self.entries:
+                return default
+            value, nbytes = self.entries.pop(key)
+            self.nbytes -= nbytes
+            return value
+    
+    def flush(self):
+        # Removes all entries, calling onevict for each
+        with self.lock:
+            while len(self.entries) > 0:
+                key, (value, nbytes) = self.entries.popitem(last = False)
+                self.nbytes -= nbytes
+                if self.onevict:
+                    self.onevict(key, value)
+
+qamaskcache = LRUCache(qamaskcachemb * 1024 * 1024) # decoded QA masks, keyed by scene, QA tile, and mask settings
+
+def writecachedtile(outfile, entry):
+    # Writes a tile held in tilecache to disk, along with its vegetation indices. Called when the tile is evicted or the cache is flushed.
+    print('Writing cached tile to disk: {}'.format(outfile))
+    data = entry['data']
+    if data.shape[0] == 1:
+        data = data[0]
+    with TileLock(outfile):
+        ENVIfile(data, entry['rastertype'], geoTrans = entry['geoTrans'], outfilename = outfile, parentrasters = makeparentrastersstring(entry['parentrasters']), SceneID = entry['SceneID'], acqtime = entry['acqtime'], ProductID = entry['ProductID']).Save()
+        if entry['CalcVIs']:
+            print('Calculating vegetation indices.')
+            calcvis(outfile, qafile = None, useqamask = False, useTile = True, \
+                          CalcNDVI = entry['CalcNDVI'], \
+                          CalcEVI = entry['CalcEVI'], CalcNDTI = entry['CalcNDTI'], \
+                          CalcNBR = entry['CalcNBR'], inrastertype = entry['rastertype'], \
+                          data = entry['data'], geoTrans = entry['geoTrans'], acqtime = entry['acqtime'], \
+                          parentrasters = entry['parentrasters'])
+
+tilecache = LRUCache(tilecachemb * 1024 * 1024, onevict = writecachedtile) # tiles being merged in memory, keyed by output file path
+
+def settilecache(maxmb):
+    # Sets the size of the write-back tile cache used by makerastertile(). With the cache enabled, tiles hit by several scenes in a batch are merged
+    # in memory and written to disk, with their vegetation indices, once when they are evicted or flushtilecache() is called at the end of the batch.
+    # The cache is per process, so it must not be used when other processes write to the same tiles at the same time. It has no effect with 
+    # converttotiles(workers > 1), whose tiles are made by worker processes, or in S3 mode, where importespatotiles() flushes it to upload each scene.
+    tilecache.maxbytes = maxmb * 1024 * 1024
+    if maxmb > 0:
+        atexit.register(flushtilecache) # in case the batch ends without flushing
+
+def flushtilecache(*args):
+    # Writes cached tiles to disk. If file names are given, only those tiles are written, otherwise the whole cache is flushed.
+    if len(args) == 0:
+        tilecache.flush()
+    else:
+        for outfile in args:
+            entry = tilecache.pop(outfile)
+            if entry:
+                writecachedtile(outfile, entry)
+
+qaluts = {} # lookup tables used by maskfromqa_c2(), keyed by the bit mask of the QA bits to be masked out
+
+def qalookuptable(includevals):
+    # This function returns a lookup table mapping every possible 16-bit QA value to 1 (good pixel) or 0 (pixel has one or more of the bits in includevals set). 
+    # Tables are built once per bit configuration and reused for all subsequent tiles and scenes.
+    bitmask = 0
+    for val in includevals:
+        bitmask |= (1 << val)
+    if not bitmask in qaluts.keys():
+        qavals = numpy.arange(65536, dtype = numpy.uint32)
+        qaluts[bitmask] = ((qavals & bitmask) == 0).astype(numpy.uint8)
+    return qaluts[bitmask]
 
 def maskfromqa_c2(qafile, tafile, landsat, sceneid, *args, **kwargs):
     # Added in version 1.5. This recreates a processing mask layer to memory using the pixel_qa layer for Landsat Collection 2. It does not save to disk.
@@ -1199,21 +1891,12 @@ def maskfromqa_c2(qafile, tafile, landsat, sceneid, *args, **kwargs):
     ns = qaobj.RasterXSize
     nl = qaobj.RasterYSize
 
-    # Create mask of zero values
-    mask = numpy.ones((nl, ns), dtype = numpy.uint8)
-    if len(includevals) > 0: # mask for clouds, shadows, etc.
-        for val in includevals:
-            m0 = qalayer & (1 << val)
-            maskvals = numexpr.evaluate('(m0 != 0)')
-            mask[maskvals] = 0
-            if val == 9 and not usemedcloud:
-                m1 = qalayer & (1 << 8)
-                maskvals = numexpr.evaluate('(m0 != 0) & (m1 == 0')
-                mask[maskvals] = 0
-                del m1
-            del m0
-
-    maskvals = None
+    # Create mask using a lookup table of all possible QA values. Pixels with any of the includevals bits set are masked out.
+    # Medium confidence cloud (bit 9 without bit 8) is a subset of bit 9, so it is masked regardless of usemedcloud.
+    lut = qalookuptable(includevals)
+    mask = numpy.take(lut, qalayer.astype(numpy.uint16, copy = False))
+
+    lut = None
     qalayer = None
     qaobj = None
     
@@ -1271,10 +1954,44 @@ def gettileqamask(f, tamask, sceneid, *args, **kwargs):
             print('Error: Pixel QA/ cloud mask file missing. Skipping scene.')
             logerror(f, 'Error: Pixel QA/ cloud mask file missing. Skipping scene.')
             return None
-    print('Now creating good pixel mask using cloud mask file: {}'.format(f))
-    return maskfromqa_c2(f, tamask, int(os.path.basename(f)[2:3]), sceneid, land = land, water = water, snowice = snow, usemedcloud = usemedcloud, usemedcirrus = usemedcirrus, usehighcirrus = usehighcirrus, useterrainocclusion = useterrainocclusion, shadow = shadow) #
+    # Masks are cached so that every product of a scene reuses the same decoded mask. The QA tile's modification time and size are 
+    # included in the key, as QA tiles are updated when more than one scene is acquired on the same date.
+    # The QA tiles are locked while they are read, so that a tile being merged by another process is never read half written
+    with ExitStack() as locks:
+        for x in [f, tamask]:
+            if x:
+                locks.enter_context(TileLock(x))
+        fstat = os.stat(f)
+        key = (sceneid, f, fstat.st_mtime_ns, fstat.st_size, land, water, snow, shadow, usemedcloud, usemedcirrus, usehighcirrus, useterrainocclusion)
+        mask = qamaskcache.get(key)
+        if isinstance(mask, numpy.ndarray):
+            print('Using cached good pixel mask for cloud mask file: {}'.format(f))
+            return mask
+        print('Now creating good pixel mask using cloud mask file: {}'.format(f))
+        mask = maskfromqa_c2(f, tamask, int(os.path.basename(f)[2:3]), sceneid, land = land, water = water, snowice = snow, usemedcloud = usemedcloud, usemedcirrus = usemedcirrus, usehighcirrus = usehighcirrus, useterrainocclusion = useterrainocclusion, shadow = shadow) #
+    mask.flags.writeable = False # cached masks are shared between products, and must not be changed
+    qamaskcache.put(key, mask, mask.nbytes)
+    return mask
 
 
+def getvibandnumbers(basename, inrastertype):
+    # This function returns the band numbers of the bands used to calculate vegetation indices
+    if basename[2:3] in ['8', '9'] or inrastertype == 'S2OLI':
+        return {'blue' : 2, 'red' : 4, 'NIR' : 5, 'swir1' : 6, 'swir2' : 7}
+    elif basename.startswith('S2') and inrastertype != 'S2TM':
+        return {'blue' : 2, 'red' : 4, 'NIR' : 8, 'swir1' : 11, 'swir2' : 12}
+    else:
+        return {'blue' : 1, 'red' : 3, 'NIR' : 4, 'swir1' : 5, 'swir2' : 6}
+
+def getviband(src, bandnum):
+    # This function gets a band from either a GDAL dataset, an array with shape (bands, rows, cols), or a dict of 2 dimensional arrays keyed by band number
+    if isinstance(src, dict):
+        return src[bandnum]
+    elif isinstance(src, numpy.ndarray):
+        return src[bandnum - 1]
+    else:
+        return src.GetRasterBand(bandnum).ReadAsArray()
+
 def calcvis(refitm, *args, **kwargs): # This should calculate a masked NDVI.
     # This function creates NDVI and EVI files.
     useqamask = kwargs.get('useqamask', True)
@@ -1287,9 +2004,12 @@ def calcvis(refitm, *args, **kwargs): # This should calculate a masked NDVI.
     CalcNBR = kwargs.get('CalcNBR', True)
     CalcNDTI = kwargs.get('CalcNDTI', True)
     inrastertype = kwargs.get('inrastertype', None)
+    data = kwargs.get('data', None) # reflectance data already in memory, with shape (bands, rows, cols), or a dict of the bands used keyed by band number. If used, refitm is only used for output file names, and geoTrans and acqtime must also be set.
     # usefmask = kwargs.get('usefmask', False)
     # usecfmask = kwargs.get('usecfmask', False)
     dirname, basename = os.path.split(refitm)
+    if basename.endswith('.tif'): # COG tile. Vegetation index tiles are written as ENVI files
+        basename = basename[:-4] + '.dat'
     
     if not sceneid:
         # i = basename.find('.')
@@ -1297,14 +2017,22 @@ def calcvis(refitm, *args, **kwargs): # This should calculate a masked NDVI.
             sceneid = ProductID
         else:
             sceneid = os.path.basename(refitm) # This will now use either the SceneID or ProductID
-    acqtime = envihdracqtime(refitm.replace('.dat', '.hdr'))
     qafile = kwargs.get('qafile', os.path.join(pixelqadir,'{}_QA_PIXEL.dat'.format(sceneid)))
     outdir = kwargs.get('outdir', dirname)
     # fmaskfile = os.path.join(fmaskdir,'{}_cfmask.dat'.format(sceneid))
-    if refitm.endswith('.dat'):
-        parentrasters = envihdrparentrasters(refitm[:-3] + 'hdr')
+    if isinstance(data, (numpy.ndarray, dict)):
+        acqtime = kwargs.get('acqtime', None)
+        if not acqtime and os.path.isfile(refitm.replace('.dat', '.hdr')): # only the small header is read
+            acqtime = envihdracqtime(refitm.replace('.dat', '.hdr'))
+        parentrasters = kwargs.get('parentrasters', [basename])
     else:
-        parentrasters = [os.path.basename(refitm)]
+        acqtime = envihdracqtime(refitm.replace('.dat', '.hdr'))
+        if refitm.endswith('.dat'):
+            parentrasters = envihdrparentrasterslist(refitm[:-3] + 'hdr')
+        elif refitm.endswith('.tif'):
+            parentrasters = envihdrparentrasterslist(refitm)
+        else:
+            parentrasters = [os.path.basename(refitm)]
     # if useqamask:
     #     if not os.path.isfile(qafile):
     #         usefmask = False
@@ -1321,12 +2049,17 @@ def calcvis(refitm, *args, **kwargs): # This should calculate a masked NDVI.
     #             parentrasters.append(os.path.basename(fmaskfile))
 
     
-    refobj = gdal.Open(refitm)
-
-    # Get file geometry
-    geoTrans = refobj.GetGeoTransform()
-    ns = refobj.RasterXSize
-    nl = refobj.RasterYSize
+    if isinstance(data, (numpy.ndarray, dict)):
+        refobj = data
+        geoTrans = kwargs.get('geoTrans', None)
+    else:
+        refobj, geoTrans = None, None
+        if isenvifile(refitm):
+            refobj, geoTrans = openenvi(refitm) # memory mapped, so only the bands used are read
+        if not isinstance(refobj, numpy.ndarray) or not geoTrans:
+            refobj = gdal.Open(refitm)
+            # Get file geometry
+            geoTrans = refobj.GetGeoTransform()
     if useqamask:
         if sceneid[2:3] == '0':
             landsat = int(sceneid[3:4])
@@ -1344,24 +2077,18 @@ def calcvis(refitm, *args, **kwargs): # This should calculate a masked NDVI.
     else:
         print('Warning: No Fmask file found for scene {}.'.format(sceneid))
         fmask = None
-    if basename[2:3] in ['8', '9'] or inrastertype == 'S2OLI':
-        NIR = refobj.GetRasterBand(5).ReadAsArray()
-        red = refobj.GetRasterBand(4).ReadAsArray()
-        if CalcEVI: blue = refobj.GetRasterBand(2).ReadAsArray()
-        if CalcNDTI: swir1 = refobj.GetRasterBand(6).ReadAsArray()
-        if CalcNDTI or CalcNBR: swir2 = refobj.GetRasterBand(7).ReadAsArray()
-    elif basename.startswith('S2') and inrastertype != 'S2TM':
-        NIR = refobj.GetRasterBand(8).ReadAsArray()
-        red = refobj.GetRasterBand(4).ReadAsArray()
-        if CalcEVI: blue = refobj.GetRasterBand(2).ReadAsArray()
-        if CalcNDTI: swir1 = refobj.GetRasterBand(11).ReadAsArray()
-        if CalcNDTI or CalcNBR: swir2 = refobj.GetRasterBand(12).ReadAsArray()        
-    else:
-        NIR = refobj.GetRasterBand(4).ReadAsArray()
-        red = refobj.GetRasterBand(3).ReadAsArray()
-        if CalcEVI: blue = refobj.GetRasterBand(1).ReadAsArray()
-        if CalcNDTI: swir1 = refobj.GetRasterBand(5).ReadAsArray()
-        if CalcNDTI or CalcNBR: swir2 = refobj.GetRasterBand(6).ReadAsArray()
+    bandnums = getvibandnumbers(basename, inrastertype)
+    indices = []
+    for index, calc in [('NDVI', CalcNDVI), ('EVI', CalcEVI), ('NDTI', CalcNDTI), ('NBR', CalcNBR)]:
+        if calc:
+            indices.append(index)
+    bands = {}
+    for index in indices:
+        for band in viformulas[index][0]:
+            if not band in bands:
+                bands[band] = getviband(refobj, bandnums[band])
+    vis = calcindices(bands, indices, fmask = fmask)
+    bands = None
     
     if basename.startswith('L'):
         ndvioutdir = ndvidir
@@ -1377,7 +2104,7 @@ def calcvis(refitm, *args, **kwargs): # This should calculate a masked NDVI.
     # NDVI calculation
     if CalcNDVI:
         print('Calculating NDVI for scene {}.'.format(sceneid))
-        NDVI = NDindex(NIR, red, fmask = fmask)
+        NDVI = vis.pop('NDVI')
         if parentrasters:
             parentrasters = makeparentrastersstring(parentrasters)
         else:
@@ -1391,7 +2118,7 @@ def calcvis(refitm, *args, **kwargs): # This should calculate a masked NDVI.
     # EVI calculation
     if CalcEVI:
         print('Calculating EVI for scene {}.'.format(sceneid))
-        evi = EVI(blue, red, NIR, fmask = fmask)
+        evi = vis.pop('EVI')
         if useTile:
             outfile = os.path.join(evioutdir, basename)
             ENVIfile(evi, 'EVI', geoTrans = geoTrans, SceneID = sceneid, acqtime = acqtime, parentrasters = parentrasters, outfilename = outfile).Save()
@@ -1401,7 +2128,7 @@ def calcvis(refitm, *args, **kwargs): # This should calculate a masked NDVI.
     # NDTI calculation
     if CalcNDTI:
         print('Calculating NDTI for scene {}.'.format(sceneid))
-        NDTI = NDindex(swir1, swir2, fmask = fmask)
+        NDTI = vis.pop('NDTI')
         if useTile:
             outfile = os.path.join(ndtioutdir, basename)
             ENVIfile(NDTI, 'NDTI', geoTrans = geoTrans, SceneID = sceneid, acqtime = acqtime, parentrasters = parentrasters, outfilename = outfile).Save()
@@ -1411,7 +2138,7 @@ def calcvis(refitm, *args, **kwargs): # This should calculate a masked NDVI.
     # NDVI calculation
     if CalcNBR:
         print('Calculating NBR for scene {}.'.format(sceneid))
-        NBR = NDindex(NIR, swir2, fmask = fmask)
+        NBR = vis.pop('NBR')
         if useTile:
             outfile = os.path.join(nbroutdir, basename)
             ENVIfile(NBR, 'NBR', geoTrans = geoTrans, SceneID = sceneid, acqtime = acqtime, parentrasters = parentrasters, outfilename = outfile).Save()
@@ -1419,45 +2146,82 @@ def calcvis(refitm, *args, **kwargs): # This should calculate a masked NDVI.
             ENVIfile(NBR, 'NBR', outdir = outdir, geoTrans = geoTrans, SceneID = sceneid, acqtime = acqtime, parentrasters = parentrasters).Save()
         NBR = None
     
-    NIR = None
-    red = None
-    blue = None
-    swir1 = None
-    swir2 = None
+    vis = None
     refobj = None
     fmask = None
     # fmaskobj = None
 
+# Input bands and numexpr formulas for the spectral indices calculated by calcindices
+viformulas = {
+    'NDVI' : (['NIR', 'red'], '10000 * (NIR - red) / (NIR + red)'),
+    'EVI' : (['blue', 'red', 'NIR'], '10000 * (G * (NIR - red) / (NIR + C1 * red - C2 * blue + L))'),
+    'NDTI' : (['swir1', 'swir2'], '10000 * (swir1 - swir2) / (swir1 + swir2)'),
+    'NBR' : (['NIR', 'swir2'], '10000 * (NIR - swir2) / (NIR + swir2)'),
+    }
+
+viconstants = {'G' : numpy.float32(2.5), 'C1' : numpy.float32(6), 'C2' : numpy.float32(7.5), 'L' : numpy.float32(1)} # EVI coefficients. As float32 scalars, they keep numexpr from evaluating EVI in float64, which Python float literals would do
+
+def calcindices(bands, indices, *args, **kwargs):
+    # This function calculates several spectral indices in a single pass over the input bands, returning a dict of 2 dimensional int16 arrays
+    # bands is a dict of 2 dimensional arrays keyed by band name ('blue', 'red', 'NIR', 'swir1', 'swir2'), indices is a list of keys of viformulas
+    # Each band is read and validated once per block of rows, and each index is evaluated in float32 straight into its int16 output
+    fmask = kwargs.get('fmask', None)
+    blockrows = kwargs.get('blockrows', 512) # number of rows processed per pass
+    usedbands = []
+    for index in indices:
+        for band in viformulas[index][0]:
+            if not band in usedbands:
+                usedbands.append(band)
+    rows, cols = bands[usedbands[0]].shape
+    outputs = {}
+    for index in indices:
+        outputs[index] = numpy.zeros((rows, cols), dtype = numpy.int16)
+    scratch = numpy.empty((min(blockrows, rows), cols), dtype = numpy.float32)
+    for y0 in range(0, rows, blockrows):
+        y1 = min(y0 + blockrows, rows)
+        blockdict = {}
+        validdict = {}
+        for band in usedbands:
+            x = bands[band][y0:y1].astype(numpy.float32)
+            blockdict[band] = x
+            validdict[band] = numexpr.evaluate('(x >= 1) & (x <= 10000)') # valid pixels only
+        if isinstance(fmask, numpy.ndarray):
+            fm = fmask[y0:y1]
+            basevalid = numexpr.evaluate('fm != 0') # shared by all indices
+        else:
+            basevalid = None
+        out = scratch[:y1 - y0]
+        for index in indices:
+            indexbands, formula = viformulas[index]
+            valid = basevalid
+            for band in indexbands:
+                if valid is None:
+                    valid = validdict[band]
+                else:
+                    valid = valid & validdict[band]
+            local_dict = dict(blockdict)
+            local_dict.update(viconstants)
+            local_dict['valid'] = valid
+            if index == 'EVI': # the EVI denominator may be zero for valid pixels
+                expression = 'where(valid & ((NIR + C1 * red - C2 * blue + L) != 0), {}, 0)'.format(formula)
+            else:
+                expression = 'where(valid, {}, 0)'.format(formula)
+            numexpr.evaluate(expression, local_dict = local_dict, out = out)
+            numpy.clip(out, -32768, 32767, out = out) # EVI can be far out of range where the denominator is near zero
+            outputs[index][y0:y1] = out # truncates to int16
+        blockdict = None
+        validdict = None
+    return outputs
+
 def EVI(blue, red, NIR, *args, **kwargs):
     # This calculates a 2 dimensional array consisting of Enhanced Vegetation Index values
     fmask = kwargs.get('fmask', None)
-    if not isinstance(fmask, numpy.ndarray):
-        mask = numexpr.evaluate('(NIR < 1) | (NIR > 10000) | (red < 1) | (red > 10000) | (blue < 1) | (blue > 10000)') # masks exclude invalid pixels
-    else:
-        mask = numexpr.evaluate('(fmask == 0) | ((NIR < 1) | (NIR > 10000) | (red < 1) | (red > 10000) | (blue < 1) | (blue > 10000))') # reevaluate mask for EVI
-    C1 = 6
-    C2 = 7.5
-    G = 2.5
-    L = 1
-    EVI = 10000 * (G * ((NIR - red)/(NIR + C1 * red - C2 * blue + L)))
-    EVI[mask] = 0.0 # replace invalid pixels with zero
-    mask = None
-    return EVI.astype(numpy.int16)
+    return calcindices({'blue' : blue, 'red' : red, 'NIR' : NIR}, ['EVI'], fmask = fmask)['EVI']
 
 def NDindex(A, B, *args, **kwargs):
     # This function calculates a 2 dimensional normalized difference array
     fmask = kwargs.get('fmask', None)
-    if not isinstance(fmask, numpy.ndarray):
-        mask = numexpr.evaluate('(A < 1) | (A > 10000) | (B < 1) | (B > 10000)')  # masks exclude invalid pixels
-    else:
-        mask = numexpr.evaluate('(fmask == 0) | ((A < 1) | (A > 10000) | (B < 1) | (B > 10000))')
-    with numpy.errstate(divide='ignore', invalid='ignore'):
-        data =  10000 * numpy.true_divide((A - B), (A + B))#numpy.divide(numpy.subtract(A, B),numpy.add(A, B))
-        data[data == numpy.inf] = 0
-        data = numpy.nan_to_num(data)
-    data[mask] = 0.0 # replace invalid pixels with zero
-    mask = None
-    return data.astype(numpy.int16)
+    return calcindices({'NIR' : A, 'red' : B}, ['NDVI'], fmask = fmask)['NDVI']
 
 def scaleVSWIR(f, ext, *args, **kwargs):
     # This function scales Landsat VSWIR data so that reflectance is a double integer between 1 - 9999, e.g, refectance * 10000, consistent with Landsat Collection 1
@@ -1520,6 +2284,62 @@ def scaleTIR(f, ext, *args, **kwargs):
     # nodatamask[nodata] = 0
     # nodatamask[nodata2] = 0
 
+def makecalibratedvrt(infiles, outvrt, ratio, offset, *args, **kwargs):
+    # This function writes a VRT which applies a linear calibration, outvalue = ratio * DN + offset, to each input file as it is read, one band per input file
+    # This replaces scaleVSWIR and scaleTIR with gdalbuildvrt, without any subprocesses or intermediate files
+    nodata = kwargs.get('nodata', -9999) # output no data value
+    datatype = kwargs.get('datatype', 'Int16')
+    src_ds = gdal.Open(infiles[0])
+    if not src_ds:
+        print('Error, cannot open {}.'.format(infiles[0]))
+        logerror(infiles[0], 'Cannot open file for calibration.')
+        return None
+    cols, rows = src_ds.RasterXSize, src_ds.RasterYSize
+    geoTrans = src_ds.GetGeoTransform()
+    lines = ['<VRTDataset rasterXSize="{}" rasterYSize="{}">'.format(cols, rows), \
+             '  <SRS>{}</SRS>'.format(src_ds.GetProjection().replace('"', '&quot;')), \
+             '  <GeoTransform>{}</GeoTransform>'.format(', '.join([repr(x) for x in geoTrans]))]
+    src_ds = None
+    for i, f in enumerate(infiles):
+        src_ds = gdal.Open(f)
+        if not src_ds:
+            print('Error, cannot open {}.'.format(f))
+            logerror(f, 'Cannot open file for calibration.')
+            return None
+        if src_ds.RasterXSize != cols or src_ds.RasterYSize != rows:
+            print('Error, {} does not have the same dimensions as {}.'.format(os.path.basename(f), os.path.basename(infiles[0])))
+            logerror(f, 'File dimensions do not match the other bands of the scene.')
+            return None
+        srcnodata = src_ds.GetRasterBand(1).GetNoDataValue()
+        src_ds = None
+        lines.append('  <VRTRasterBand dataType="{}" band="{}">'.format(datatype, i + 1))
+        lines.append('    <NoDataValue>{}</NoDataValue>'.format(nodata))
+        lines.append('    <ComplexSource>')
+        if f.startswith('/vsi'): # os.path.abspath() would collapse e.g. /vsitar//data/x.tar/B1.TIF to /vsitar/data/x.tar/B1.TIF, which GDAL reads relative to the working directory
+            srcfile = f
+        else:
+            srcfile = os.path.abspath(f)
+        lines.append('      <SourceFilename relativeToVRT="0">{}</SourceFilename>'.format(srcfile))
+        lines.append('      <SourceBand>1</SourceBand>')
+        lines.append('      <ScaleOffset>{}</ScaleOffset>'.format(offset))
+        lines.append('      <ScaleRatio>{}</ScaleRatio>'.format(ratio))
+        if srcnodata != None: # source no data pixels are not calibrated, and are left as the output no data value
+            lines.append('      <NODATA>{}</NODATA>'.format(srcnodata))
+        lines.append('    </ComplexSource>')
+        lines.append('  </VRTRasterBand>')
+    lines.append('</VRTDataset>')
+    with open(outvrt, 'w') as output:
+        output.write('\n'.join(lines) + '\n')
+    # Check that every source can be read through the VRT, so that a broken source path fails here rather than in the tiler
+    vrt_ds = gdal.Open(outvrt)
+    if not vrt_ds or any(vrt_ds.GetRasterBand(i + 1).ReadRaster(0, 0, 1, 1) == None for i in range(len(infiles))):
+        print('Error, cannot read the source files of {}.'.format(os.path.basename(outvrt)))
+        logerror(outvrt, 'Cannot read the source files of the calibration VRT.')
+        vrt_ds = None
+        return None
+    vrt_ds = None
+    return outvrt
+
 def importespatotiles(f, *args, **kwargs):
     # This function imports new ESPA-process LEDAPS data
     # Version 1.5: Landsat Collection 2 Level 2 data now supported, AWS S3 
@@ -1538,6 +2358,11 @@ def importespatotiles(f, *args, **kwargs):
     CalcNBR = kwargs.get('CalcNBR', True)
     CalcNDTI = kwargs.get('CalcNDTI', True)
     useS3b = kwargs.get('useS3', useS3)
+    workers = kwargs.get('workers', 1) # Number of processes used by converttotiles() to generate tiles
+    singlepass = kwargs.get('singlepass', False) # Tile all products of the scene in a single pass using convertscenetotiles(). workers is not used in this mode
+    vsitar = kwargs.get('vsitar', False) # Read the needed bands directly from a .tar or .tar.gz file through GDAL's /vsitar/ file system rather than extracting the archive
+    usetransaction = kwargs.get('transaction', True) # Update the catalog in a single transaction. Set to False when other processes are writing to the catalog at the same time, as the transaction holds its write lock
+    products = [] # products to be tiled in single pass mode, in processing order
     btimg = None
     masktype = None
     basename = os.path.basename(f)
@@ -1571,16 +2396,36 @@ def importespatotiles(f, *args, **kwargs):
                 i = f.find('.tar')
             outputdir = f[:i]
             ProductID = os.path.basename(outputdir)
-        try:
-            filelist = untarfile(f, outputdir)
-        except Exception as e:
-            print('An error has occurred extracting tarfile: {}'.format(os.path.basename(f)))
-            print(e)
-            logerror(os.path.basename(f), e)
-            return
+        if vsitar:
+            # Only the working files (VRTs and reprojected scenes) are written to outputdir
+            if not os.path.isdir(outputdir):
+                os.makedirs(outputdir)
+            inputdir = '/vsitar/{}'.format(os.path.abspath(f))
+            print('Reading {} in place.'.format(os.path.basename(f)))
+            filelist = gdal.ReadDirRecursive(inputdir)
+            if filelist == None:
+                print('An error has occurred reading tarfile: {}'.format(os.path.basename(f)))
+                logerror(os.path.basename(f), 'Cannot read tar file through /vsitar/.')
+                return
+            filelist = [os.path.join(inputdir, x) for x in filelist if not x.endswith('/')]
+        else:
+            try:
+                filelist = untarfile(f, outputdir)
+            except Exception as e:
+                print('An error has occurred extracting tarfile: {}'.format(os.path.basename(f)))
+                print(e)
+                logerror(os.path.basename(f), e)
+                return
+            inputdir = outputdir
     else:
         filelist = glob.glob(os.path.join(dirname, '*'))
         outputdir = dirname
+        inputdir = outputdir
+    if vsitar and usegdalcalc and inputdir != outputdir:
+        print('Warning: gdal_calc.py cannot write calibrated files inside a tar file, calibrating through VRTs instead.')
+        gdalcalc = False
+    else:
+        gdalcalc = usegdalcalc
     tdir = os.path.join(outputdir, projacronym)
     if not os.path.isdir(tdir):
         os.mkdir(tdir)
@@ -1621,7 +2466,8 @@ def importespatotiles(f, *args, **kwargs):
     if not 'Tile_filename_base' in schema: # this will add two fields to the s
         tilebasefield = ogr.FieldDefn('Tile_filename_base', ogr.OFTString)
         layer.CreateField(tilebasefield)
-    layer.StartTransaction()
+    if usetransaction:
+        layer.StartTransaction()
     while not sceneid:
         feat = layer.GetNextFeature()
         if feat:
@@ -1661,8 +2507,8 @@ def importespatotiles(f, *args, **kwargs):
 #         qafile = out_raster
 #         feat = converttotiles(out_raster, fmaskdir, 'Fmask', pixelqa = False, feature = feat, overwrite = overwrite, noupdate = noupdate)
     # Pixel QA layer
-    in_raster = os.path.join(outputdir, '{}_QA_PIXEL.{}'.format(ProductID, ext))
-    if os.access(in_raster, os.F_OK):
+    in_raster = os.path.join(inputdir, '{}_QA_PIXEL.{}'.format(ProductID, ext))
+    if isinputfile(in_raster):
         if useProdID:
             out_raster = os.path.join(tdir, '{}_pixel_qa.dat'.format(ProductID))
         else:
@@ -1680,12 +2526,15 @@ def importespatotiles(f, *args, **kwargs):
             feat.SetField('MaskType', masktype)
             layer.SetFeature(feat)
         qafile = out_raster
-        feat = converttotiles(out_raster, pixelqadir, 'pixel_qa', pixelqa = False, feature = feat, overwrite = overwrite, noupdate = noupdate)
-        layer.SetFeature(feat)
+        if singlepass:
+            products.append({'infile' : out_raster, 'outdir' : pixelqadir, 'rastertype' : 'pixel_qa', 'pixelqa' : False})
+        else:
+            feat = converttotiles(out_raster, pixelqadir, 'pixel_qa', pixelqa = False, feature = feat, overwrite = overwrite, noupdate = noupdate, workers = workers)
+            layer.SetFeature(feat)
         
     # Radiometric saturation  QA layer
-    in_raster = os.path.join(outputdir, '{}_QA_RADSAT.{}'.format(ProductID, ext))
-    if os.access(in_raster, os.F_OK):
+    in_raster = os.path.join(inputdir, '{}_QA_RADSAT.{}'.format(ProductID, ext))
+    if isinputfile(in_raster):
         if useProdID:
             out_raster = os.path.join(tdir, '{}_QA_RADSAT.dat'.format(ProductID))
         else:
@@ -1703,12 +2552,15 @@ def importespatotiles(f, *args, **kwargs):
         #     feat.SetField('MaskType', masktype)
             # layer.SetFeature(feat)
         # radsatqafile = out_raster
-        feat = converttotiles(out_raster, radsatqadir, 'QA_RADSAT', pixelqa = False, feature = feat, overwrite = overwrite, noupdate = noupdate)
-        layer.SetFeature(feat)
+        if singlepass:
+            products.append({'infile' : out_raster, 'outdir' : radsatqadir, 'rastertype' : 'QA_RADSAT', 'pixelqa' : False})
+        else:
+            feat = converttotiles(out_raster, radsatqadir, 'QA_RADSAT', pixelqa = False, feature = feat, overwrite = overwrite, noupdate = noupdate, workers = workers)
+            layer.SetFeature(feat)
     
     # SR QA AEROSOL layer
-    in_raster = os.path.join(outputdir, '{}_SR_QA_AEROSOL.{}'.format(ProductID, ext))
-    if os.access(in_raster, os.F_OK):
+    in_raster = os.path.join(inputdir, '{}_SR_QA_AEROSOL.{}'.format(ProductID, ext))
+    if isinputfile(in_raster):
         if useProdID:
             out_raster = os.path.join(tdir, '{}_SR_QA_AEROSOL.dat'.format(ProductID))
         else:
@@ -1726,8 +2578,11 @@ def importespatotiles(f, *args, **kwargs):
         #     feat.SetField('Aerosol_QA_tiles', masktype)
         #     layer.SetFeature(feat)
         # aerosolqafile = out_raster
-        feat = converttotiles(out_raster, aerosolqadir, 'SR_QA_AEROSOL', pixelqa = False, feature = feat, overwrite = overwrite, noupdate = noupdate)
-        layer.SetFeature(feat)
+        if singlepass:
+            products.append({'infile' : out_raster, 'outdir' : aerosolqadir, 'rastertype' : 'SR_QA_AEROSOL', 'pixelqa' : False})
+        else:
+            feat = converttotiles(out_raster, aerosolqadir, 'SR_QA_AEROSOL', pixelqa = False, feature = feat, overwrite = overwrite, noupdate = noupdate, workers = workers)
+            layer.SetFeature(feat)
     
     # Surface reflectance data
     if useProdID:
@@ -1738,7 +2593,21 @@ def importespatotiles(f, *args, **kwargs):
     print('Compositing surface reflectance bands to single file.')
     srlist = []
     out_raster = os.path.join(outputdir, '{}.vrt'.format(sceneid))  # no need to update to ProductID for now- it is a temporary file
-    if not os.path.isfile(out_raster):
+    if not os.path.isfile(out_raster) and not gdalcalc:
+        # Reflectance * 10000 = 10000 * (DN * 0.0000275 - 0.2), applied as the bands are read
+        bandfiles = []
+        for band in bands:
+            fb = os.path.join(inputdir, '{}_SR_B{}.{}'.format(ProductID, band, ext))
+            srlist.append(os.path.basename(fb))
+            if not isinputfile(fb):
+                print('Error, {} is missing. Returning.'.format(os.path.basename(fb)))
+                logerror(fb, '{} band {} file missing.'.format(ProductID, band))
+                return
+            bandfiles.append(fb)
+        print('Calibrating {} to surface reflectance.'.format(sceneid))
+        if not makecalibratedvrt(bandfiles, out_raster, 0.275, -2000):
+            return
+    elif not os.path.isfile(out_raster):
         mergelist = ['gdalbuildvrt', '-separate', out_raster]
         for band in bands:
             fb = os.path.join(outputdir, '{}_SR_B{}.{}'.format(ProductID, band, ext))
@@ -1754,22 +2623,30 @@ def importespatotiles(f, *args, **kwargs):
     print('Reprojecting {} reflectance data to {}.'.format(sceneid, projection))
     reproject(out_raster, out_itm, rastertype = 'ref', sceneid = sceneid, parentrasters = srlist)
 #        feat.SetField('SR_path', out_itm) # Update LEDAPS info in shapefile
-    feat = converttotiles(out_itm, srdir, 'ref', pixelqa = True, overwrite = overwrite, feature = feat, noupdate = noupdate)
-    layer.SetFeature(feat)
+    if singlepass:
+        products.append({'infile' : out_itm, 'outdir' : srdir, 'rastertype' : 'ref', 'pixelqa' : True})
+    else:
+        feat = converttotiles(out_itm, srdir, 'ref', pixelqa = True, overwrite = overwrite, feature = feat, noupdate = noupdate, workers = workers)
+        layer.SetFeature(feat)
 
     # Thermal data
     print('Processing thermal data.')
     if not landsat in ['8', '9']:
 #        outbtdir = btdir
         rastertype = 'Landsat ST'
-        stimg = os.path.join(outputdir,'{}_ST_B6.{}'.format(ProductID, ext))
+        stimg = os.path.join(inputdir,'{}_ST_B6.{}'.format(ProductID, ext))
         
     else:
 #        outbtdir = os.path.join(btdir, 'Landsat8')
         rastertype = 'Landsat ST'
-        stimg = os.path.join(outputdir,'{}_ST_B10.{}'.format(ProductID, ext))
+        stimg = os.path.join(inputdir,'{}_ST_B10.{}'.format(ProductID, ext))
     parentrasters = [os.path.basename(stimg)]
-    btimg = scaleTIR(stimg, ext)
+    if gdalcalc:
+        btimg = scaleTIR(stimg, ext)
+    else:
+        # LST * 10 = 10 * (DN * 0.00341802 + 149), applied as the band is read
+        print('Calibrating {} to land surface temperature.'.format(os.path.basename(stimg)))
+        btimg = makecalibratedvrt([stimg], os.path.join(outputdir, os.path.basename(stimg).replace('.{}'.format(ext), '_cal.vrt')), 0.0341802, 1490)
         # btimg = os.path.join(outputdir,'{}_BT.vrt'.format(sceneid))
         # print('Stacking Landsat 8 TIR bands for scene {}.'.format(sceneid))
         # mergelist = ['gdalbuildvrt', '-separate', btimg]
@@ -1789,9 +2666,17 @@ def importespatotiles(f, *args, **kwargs):
         if not os.path.isfile(BT_ITM):
             print('Reprojecting {} surface temperature data to {}.'.format(sceneid, projection))
             reproject(btimg, BT_ITM, rastertype = rastertype, sceneid = sceneid, parentrasters = parentrasters)
-        feat = converttotiles(BT_ITM, stdir, rastertype, pixelqa = True, feature = feat, overwrite = overwrite, noupdate = noupdate)
+        if singlepass:
+            products.append({'infile' : BT_ITM, 'outdir' : stdir, 'rastertype' : rastertype, 'pixelqa' : True})
+        else:
+            feat = converttotiles(BT_ITM, stdir, rastertype, pixelqa = True, feature = feat, overwrite = overwrite, noupdate = noupdate, workers = workers)
+            layer.SetFeature(feat)
+    if singlepass and len(products) > 0:
+        print('Converting {} products for scene {} to tiles.'.format(len(products), sceneid))
+        feat = convertscenetotiles(products, feat, overwrite = overwrite, noupdate = noupdate)
         layer.SetFeature(feat)
     if useS3b:
+        flushtilecache() # tiles are uploaded from disk after each scene, so the tile cache does not save any writes in S3 mode
         tilebase = feat.GetField('Tile_filename_base')
         year, month, day = tilebase[4:8], tilebase[8:10], tilebase[10:12]
         fieldnamedict = {#'Fmask' : 'Fmask_tiles',
@@ -1832,14 +2717,21 @@ def importespatotiles(f, *args, **kwargs):
                 if tilestr:
                     tiles = tilestr.split(',')
                     for tile in tiles:
-                        for ext in ['hdr', 'dat']:
-                            filename = os.path.join(fieldnamedict[key]['dirname'], f'{tilebase}_{tile}.{ext}')
-                            if os.path.isfile(filename):
+                        datfile = os.path.join(fieldnamedict[key]['dirname'], f'{tilebase}_{tile}.dat')
+                        with TileLock(datfile): # other scenes of the same date may be merging into the tile
+                            tilefiles = [os.path.join(fieldnamedict[key]['dirname'], f'{tilebase}_{tile}.{ext}') for ext in ['hdr', 'dat']]
+                            tilefiles = gettileuploadlist([x for x in tilefiles if os.path.isfile(x)])
+                            for filename in tilefiles:
                                 targetdir = f'{key}/{tile}/{year}/{month}/{day}'
                                 print('Moving {} to S3 object storage bucket: {}'.format(filename, S3tilebucket))
                                 S3.copyfilestobucket(filename = filename, bucket = S3tilebucket, targetdir = targetdir)
-                                if remove:
+                                if remove or filename.endswith('.tif'): # COGs are only used for storage
                                     os.remove(filename)
+                            if remove and tileformat == 'COG':
+                                for ext in ['hdr', 'dat']:
+                                    filename = os.path.join(fieldnamedict[key]['dirname'], f'{tilebase}_{tile}.{ext}')
+                                    if os.path.isfile(filename):
+                                        os.remove(filename)
             else: 
                 print(f'ERROR: field {fieldnamedict[key]["fieldName"]} not in layer {landsatshp} schema.')
                 logerror(ProductID, f'ERROR: field {fieldnamedict[key]["fieldName"]} not in layer {landsatshp} schema.')
@@ -1879,7 +2771,8 @@ def importespatotiles(f, *args, **kwargs):
     # Set feature in shapefile to preserve processed file metadata
     print('Updating information in shapefile.')
 #    layer.SetFeature(feat)
-    layer.CommitTransaction()
+    if usetransaction:
+        layer.CommitTransaction()
     data_source = None # Close the shapefile
 
     # Clean up files.
@@ -1917,6 +2810,36 @@ def importespatotiles(f, *args, **kwargs):
     print('Processing complete for scene {}.'.format(sceneid))
 
 
+def importsceneworker(job):
+    # Process pool worker used by importscenes(). Returns (f, result), where result is False if an error occurred.
+    f, scenekwargs = job
+    gdal.SetConfigOption('OGR_SQLITE_PRAGMA', 'busy_timeout={}'.format(catalogbusytimeout))
+    tilecache.maxbytes = 0 # tiles are shared with other processes, so they must be written to disk straight away
+    try:
+        importespatotiles(f, transaction = False, **scenekwargs)
+        result = True
+    except Exception as e:
+        print('ERROR: {}: {}'.format(os.path.basename(f), e))
+        logerror(f, e)
+        result = False
+    return f, result
+
+def importscenes(filelist, *args, **kwargs):
+    # This function ingests multiple Landsat scenes in parallel using importespatotiles(). Scenes that share tiles only wait for each other
+    # while writing those tiles (see TileLock), and each catalog update is committed on its own so that the catalog is not locked for a whole scene.
+    # Any other keywords are passed to importespatotiles(). Returns a list of (f, result) tuples in the order of filelist.
+    sceneworkers = kwargs.pop('sceneworkers', 2) # Number of scenes processed at the same time
+    kwargs.setdefault('workers', 1) # tile worker processes per scene
+    jobs = [(f, kwargs) for f in filelist]
+    results = []
+    print('Importing {} scenes using {} worker processes.'.format(len(jobs), sceneworkers))
+    with ProcessPoolExecutor(max_workers = sceneworkers) as executor:
+        for f, result in executor.map(importsceneworker, jobs):
+            if result:
+                print('Scene import complete: {}'.format(os.path.basename(f)))
+            results.append((f, result))
+    return results
+
 def ESPAreprocess(SceneID, listfile):
     print('Adding scene {} for ESPA reprocessing to: {}'.format(SceneID, listfile))
     with open(listfile, 'a') as output:
@@ -1932,11 +2855,85 @@ S2dict = {'driver' : 'SENTINEL2',
           'alt' : ['08a'],
           }    
 
+def getS2metadatafile(scene):
+    # Returns the path of the MTD_MSIL2A.xml file of a Sentinel-2 L2A product, which may be either a directory or a zip file read through /vsizip/
+    # Returns None if the file cannot be found
+    if scene.endswith('.zip'):
+        zipdir = '/vsizip/{}'.format(os.path.abspath(scene))
+        filelist = gdal.ReadDirRecursive(zipdir)
+        if filelist:
+            for x in filelist:
+                if os.path.basename(x) == 'MTD_MSIL2A.xml':
+                    return '{}/{}'.format(zipdir, x)
+        return None
+    f = os.path.join(scene, 'MTD_MSIL2A.xml')
+    if os.path.isfile(f):
+        return f
+    return None
+
+def extractS2band(job):
+    # Thread pool worker used by extractS2bands(). Each thread opens its own copy of the subdataset, as GDAL datasets cannot be shared between threads.
+    # GDAL_NUM_THREADS is set for this thread only, so that other threads of the process, e.g. the importSentinel2.py pipeline, are not affected.
+    sdsname, bandnum, outputfile, bandformat, width, height, numthreads = job
+    prevthreads = gdal.GetThreadLocalConfigOption('GDAL_NUM_THREADS', None)
+    gdal.SetThreadLocalConfigOption('GDAL_NUM_THREADS', numthreads)
+    try:
+        ds = gdal.Open(sdsname)
+        gdal.Translate(outputfile, ds, resampleAlg = "bilinear", bandList = [bandnum], format = bandformat, noData = 0, width = width, height = height)
+        ds = None
+    finally:
+        gdal.SetThreadLocalConfigOption('GDAL_NUM_THREADS', prevthreads)
+    return outputfile
+
+def extractS2bands(f, EPSGstr, bandlist, outputdir, ProductID, *args, **kwargs):
+    # This function extracts Sentinel-2 L2A bands from the 10 m, 20 m, and 60 m subdatasets of MTD_MSIL2A.xml file f to files at 10 m spatial resolution, 
+    # using a thread pool with GDAL's JPEG2000 decoder threading enabled. Returns a dict of output files keyed by band name.
+    # Band VRTs (bandformat = 'VRT') only reference the JPEG2000 data, which are decoded later by the tiler, so they are written without the thread pool.
+    workers = kwargs.get('workers', s2bandworkers) # Number of bands extracted concurrently
+    bandformat = kwargs.get('bandformat', 'ENVI')
+    bandext = kwargs.get('bandext', 'dat')
+    verbose = kwargs.get('verbose', True)
+    ds = gdal.Open(f'SENTINEL2_L2A:{f}:10m:{EPSGstr}')
+    width, height = ds.RasterXSize, ds.RasterYSize
+    ds = None
+    if bandformat == 'VRT':
+        workers = 1
+    jobs = []
+    outfiles = {}
+    for sds in ['10m', '20m', '60m']:
+        sdsname = f'SENTINEL2_L2A:{f}:{sds}:{EPSGstr}'
+        for bandname in S2dict[sds]:
+            if bandname in bandlist:
+                outfiles[bandname] = os.path.join(outputdir, f'{ProductID}_B{bandname}.{bandext}')
+    # Share the CPUs between the decoders of the bands being extracted at the same time
+    cpus = os.cpu_count() or 1
+    numthreads = str(max(1, cpus // max(1, min(workers, len(jobs)))))
+    jobs = [job + (numthreads,) for job in jobs]
+    if workers > 1:
+        if verbose:
+            print(f'Extracting {len(jobs)} bands at 10m spatial resolution using {workers} threads.')
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            for outputfile in executor.map(extractS2band, jobs):
+                if verbose:
+                    print(f'Extracted: {os.path.basename(outputfile)}')
+    else:
+        for job in jobs:
+            outputfile = extractS2band(job)
+            if verbose:
+                print(f'Extracted: {os.path.basename(outputfile)}')
+    return outfiles
+
 def WarpMGRS(dirname, datasettype, *args, **kwargs):
     # This function imports new ESPA-process LEDAPS data
     # Version 1.5: Landsat Collection 2 Level 2 data now supported, AWS S3 
     #              object storage
+    # dirname may be either an extracted product directory or the product zip file, which is read in place
+    virtual = kwargs.get('virtual', True) # Resample, stack, and warp the bands as a chain of VRTs, so JP2 data are only decoded and resampled for the pixels that the tiler reads. If False, an ENVI file is written for each band and for the warped scene
+    workers = kwargs.get('workers', s2bandworkers) # Number of threads used to extract bands
     # os.chdir(dirname)
+    f = getS2metadatafile(dirname)
+    if dirname.endswith('.zip'):
+        dirname = dirname[:-4]
     basename = os.path.basename(dirname)
     ProductID = basename
     print(f'Now processing scene: {ProductID} to type {datasettype}.')
@@ -1944,7 +2941,10 @@ def WarpMGRS(dirname, datasettype, *args, **kwargs):
     satellite = parts[0]
     datestr = parts[2][:8]
     EPSGstr = 'EPSG_326{}'.format(parts[5][1:3])
-    f = os.path.join(dirname, 'MTD_MSIL2A.xml')
+    if not f:
+        print(f'ERROR: No MTD_MSIL2A.xml file found for scene {ProductID}.')
+        logerror(ProductID, 'No MTD_MSIL2A.xml file found.')
+        return None
     
     if datasettype == 'Sentinel-2':
         bandlist = ['1', '2', '3', '4', '5', '6', '7', '8', '8a', '9', '11', '12']
@@ -1957,48 +2957,44 @@ def WarpMGRS(dirname, datasettype, *args, **kwargs):
     projdir = os.path.join(outputdir, projacronym)
     if not os.path.isdir(projdir):
         os.makedirs(projdir)
-    for sds in ['10m', '20m', '60m']:
-        sdsname = f'SENTINEL2_L2A:{f}:{sds}:{EPSGstr}'
-        print(f'Opening: {sdsname}')
-        ds = gdal.Open(sdsname)
-        for bandname in S2dict[sds]:
-            
-            if bandname == '4' and sds == '10m':
-                gt = ds.GetGeoTransform()
-                extent = [gt[0], gt[3], gt[0] + gt[1] * ds.RasterXSize, gt[3] + gt[5] * ds.RasterYSize]
-                xRes = gt[0]
-                yRes = -gt[4]
-                width, height = ds.RasterXSize, ds.RasterYSize
-            bandnum = S2dict[sds].index(bandname) + 1
-            if bandname in bandlist:
-                if sds == '10m':
-                    print(f'Now extracting band {bandname}.')
-                else:
-                    print(f'Now extracting band {bandname} at 10m spatial resolution.')
-                outputfile = os.path.join(outputdir, f'{ProductID}_B{bandname}.dat')
-                gdal.Translate(outputfile, ds, xRes = xRes, yRes = yRes, resampleAlg = "bilinear", bandList = [bandnum], format = 'ENVI', noData = 0, width = width, height = height)
+    if virtual:
+        bandext, bandformat = 'vrt', 'VRT'
+    else:
+        bandext, bandformat = 'dat', 'ENVI'
+    extractS2bands(f, EPSGstr, bandlist, outputdir, ProductID, bandformat = bandformat, bandext = bandext, workers = workers)
     # bandlist = ['1', '2', '3', '4', '5', '6', '7', '8', '8a', '9', '11', '12']    
     srlist = []
     out_vrt = os.path.join(outputdir, '{}.vrt'.format(ProductID))  
-    if not os.path.isfile(out_vrt):
-        
-        for band in bandlist:
-            fb = os.path.join(outputdir, f'{ProductID}_B{band}.dat')
-            
-            srlist.append(fb)
+    for band in bandlist:
+        fb = os.path.join(outputdir, f'{ProductID}_B{band}.{bandext}')
+        srlist.append(fb)
     print('Stacking bands in a VRT.')
     gdal.BuildVRT(out_vrt, srlist, separate = True)
         
-    print('Bands stacked. Warping to local projection.')    
     # options = gdal.WarpOptions(format = 'ENVI', dstSRS = prjstr,
                                   # resampleAlg = 'bilinear')
-    outputfile = os.path.join(projdir, f'{ProductID}.dat')
-    gdal.Warp(outputfile, 
-              out_vrt, #)options = options)
-              format = 'ENVI', 
-              dstSRS = prjstr,
-              resampleAlg = 'bilinear')
-    print('Bands warped to local projection.')
+    if virtual:
+        # The warped VRT is on the 10 m tile grid, so converttotiles() can read tiles from it without warping again
+        print('Bands stacked. Creating virtual warp to local projection.')
+        outputfile = os.path.join(projdir, f'{ProductID}.vrt')
+        gdal.Warp(outputfile, 
+                  out_vrt, 
+                  format = 'VRT', 
+                  dstSRS = prjstr,
+                  xRes = 10, 
+                  yRes = 10, 
+                  targetAlignedPixels = True, 
+                  resampleAlg = 'bilinear')
+        print('Virtual warp created.')
+    else:
+        print('Bands stacked. Warping to local projection.')    
+        outputfile = os.path.join(projdir, f'{ProductID}.dat')
+        gdal.Warp(outputfile, 
+                  out_vrt, #)options = options)
+                  format = 'ENVI', 
+                  dstSRS = prjstr,
+                  resampleAlg = 'bilinear')
+        print('Bands warped to local projection.')
     return outputfile, datestr, satellite
 
 def importSentinel2totiles(scene, feature, *args, **kwargs): 
@@ -2015,12 +3011,17 @@ def importSentinel2totiles(scene, feature, *args, **kwargs):
     CalcNBR = kwargs.get('CalcNBR', True)
     CalcNDTI = kwargs.get('CalcNDTI', True)
     outdatasettype = kwargs.get('outdatasettype', 'Sentinel-2')
+    blockrows = kwargs.get('blockrows', None) # Process tiles in strips of this many rows to limit memory use
+    virtual = kwargs.get('virtual', True) # Warp the scene as a chain of VRTs rather than writing intermediate ENVI files
     # projection = prj.GetAttrValue('projcs')
     # tfilelist = []
     # for scene in scenelist:
     sceneID = os.path.basename(scene)
     print(f'Now importing scene: {sceneID}.')#' ({scenelist.index(scene) + 1}/{len(scenelist)})')
-    tfile, datestr, satellite = WarpMGRS(scene, outdatasettype)
+    warped = WarpMGRS(scene, outdatasettype, virtual = virtual)
+    if not warped:
+        return feature
+    tfile, datestr, satellite = warped
     # tfilelist.append(tfile)
     # if len(tfilelist) > 1:
     #     tdir = os.path.join(Sen2ingestdir, datestr)
@@ -2035,19 +3036,31 @@ def importSentinel2totiles(scene, feature, *args, **kwargs):
     tdir, ProductID = os.path.split(tfile)
     ProductID = ProductID[:60]
     print(f'Converting data in scene {ProductID} to tiles.')   
-    feat = converttotiles(tfile, Sen2srdir, outdatasettype, pixelqa = False, \
-                          overwrite = overwrite, feature = feature, \
-                          noupdate = noupdate, ProductID = ProductID, \
-                          datestr = datestr, satellite = satellite, \
-                          CalcVIs = CalcVIs, CalcNDVI = CalcNDVI, \
-                          CalcEVI = CalcEVI, CalcNDTI = CalcNDTI, \
-                          CalcNBR = CalcNBR)
+    # With virtual = True, the JPEG2000 bands are decoded, resampled, and warped while the tiler reads from the VRT chain rather than in 
+    # extractS2bands(), so the JPEG2000 decoder and the warper are allowed to use all CPUs while the tiles are made. This is set for the
+    # calling thread only, as the other threads of the importSentinel2.py pipeline keep running.
+    numthreads = gdal.GetThreadLocalConfigOption('GDAL_NUM_THREADS', None)
+    if virtual:
+        gdal.SetThreadLocalConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+    try:
+        feat = converttotiles(tfile, Sen2srdir, outdatasettype, pixelqa = False, \
+                              overwrite = overwrite, feature = feature, \
+                              noupdate = noupdate, ProductID = ProductID, \
+                              datestr = datestr, satellite = satellite, \
+                              CalcVIs = CalcVIs, CalcNDVI = CalcNDVI, \
+                              CalcEVI = CalcEVI, CalcNDTI = CalcNDTI, \
+                              CalcNBR = CalcNBR, blockrows = blockrows)
+    finally:
+        gdal.SetThreadLocalConfigOption('GDAL_NUM_THREADS', numthreads)
     
     if remove:
         print('Cleaning up files in directory.')
         shutil.rmtree(tdir)
         # for scene in scenelist:
-        shutil.rmtree(scene)
+        if scene.endswith('.zip'): # zip files are left for the calling script to archive
+            scene = scene[:-4]
+        else:
+            shutil.rmtree(scene)
         if os.path.isdir(f'{scene}_ITM'):
             shutil.rmtree(f'{scene}_ITM')
        
@@ -62,9 +62,12 @@ ingestdir = config['DEFAULT']['ingestdir']
 catdir = config['DEFAULT']['catdir']
 archdir = config['DEFAULT']['archdir']
 logdir = config['DEFAULT']['logdir']
+defaulterrorfile = os.path.join(logdir, 'errors.csv')
 # useProductID = config['DEFAULT']['useProductID']
 prjstr = config['Projection']['proj']
 projacronym = config['Projection']['projacronym']
+warpmemorylimit = 512 # Working memory in MB used by gdal.Warp when reprojecting scenes
+warpthreads = 'ALL_CPUS' # Number of threads used by gdal.Warp when reprojecting scenes, as an integer or 'ALL_CPUS'
 ieogpkg = os.path.join(catdir, config['VECTOR']['ieogpkg'])
 # WRS1 = config['VECTOR']['WRS1'] # WRS-1, Landsats 1-3
 # WRS2 = config['VECTOR']['WRS2'] # WRS-2, Landsats 4-8
@@ -100,6 +103,18 @@ S2dict = {'driver' : 'SENTINEL2',
           'alt' : ['08a'],
           }    
 
+def logerror(f, message, *args, **kwargs):
+    # This function logs errors to an error file.
+    errorfile = kwargs.get('errorfile', defaulterrorfile)
+    dirname, basename = os.path.split(errorfile)
+    if not os.path.isdir(dirname):
+        errorfile = os.path.join(logdir, basename)
+    if not os.path.exists(errorfile):
+        with open(errorfile,'w') as output:
+            output.write('Time, File, Error\n')
+    now = datetime.datetime.now()
+    with open(errorfile, 'a') as output:
+        output.write('%s, %s, %s\n'%(now.strftime('%Y-%m-%d %H:%M:%S'), f, message))
 
 def CreateOpenSearchQueryURL(*args, **kwargs):
     startdate = kwargs.get('startdate', '2017-04-01')
@@ -157,17 +172,32 @@ def reproject(in_raster, out_raster, band, *args, **kwargs): # Converts raster t
     outdir = kwargs.get('outdir', None)
     rewriteheader = kwargs.get('rewriteheader', True)
     parentrasters = kwargs.get('parentrasters', None)
+    outformat = kwargs.get('outformat', 'ENVI') # GDAL output format. Any other format, e.g., 'VRT', or 'GTiff' with a /vsimem/ path, returns the open output dataset, which can be passed directly to converttotiles()
+    multithread = kwargs.get('multithread', True) # warp and read data in separate threads
+    warpMemoryLimit = kwargs.get('warpMemoryLimit', warpmemorylimit) # working memory of the warper in MB
+    numthreads = kwargs.get('numthreads', warpthreads) # number of warper threads, as an integer or 'ALL_CPUS'
     if os.access(in_raster, os.F_OK):
         src_ds = gdal.Open(in_raster)
         gt = src_ds.GetGeoTransform()
+        options = gdal.WarpOptions(format = outformat, dstSRS = prjstr, xRes = abs(gt[1]), yRes = abs(gt[5]), \
+                                   multithread = multithread, warpMemoryLimit = warpMemoryLimit, \
+                                   warpOptions = ['NUM_THREADS={}'.format(numthreads)])
+        out_ds = gdal.Warp(out_raster, src_ds, options = options)
         # Close datasets
         src_ds = None
-        p = Popen(['gdalwarp', '-t_srs', prjstr, '-tr', str(abs(gt[1])), str(abs(gt[5])), '-of', 'ENVI', in_raster, out_raster])
-        print(p.communicate())
+        if not out_ds:
+            print('Error, could not reproject {}.'.format(os.path.basename(in_raster)))
+            logerror(in_raster, 'Could not reproject file: {}'.format(gdal.GetLastErrorMsg()))
+            return None
+        if outformat != 'ENVI':
+            out_ds.FlushCache()
+            return out_ds
+        out_ds = None
         if rewriteheader:
             if isinstance(parentrasters, list):
                 parentrasters = makeparentrastersstring(parentrasters)
             ENVIfile(out_raster, rastertype, SceneID = sceneid, outdir = outdir, parentrasters = parentrasters).WriteHeader()
+        return out_raster
 
 def WarpMGRS(dirname, *args, **kwargs):
     # This function imports new ESPA-process LEDAPS data
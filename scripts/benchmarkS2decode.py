@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# By Guy Serbin, EOanalytics Ltd.
+# Talent Garden Dublin, Claremont Ave. Glasnevin, Dublin 11, Ireland
+# email: guyserbin <at> eoanalytics <dot> ie
+
+# version 1.5
+
+# This script benchmarks Sentinel-2 L2A band extraction (JPEG2000 decoding and resampling to 10 m) against the number of extraction threads.
+# Bands are written to ENVI files in a temporary directory, which is deleted afterwards.
+# This is the decoding done by ieo.WarpMGRS(virtual = False). With the default virtual = True, bands are decoded by the tiler, using GDAL_NUM_THREADS = ALL_CPUS.
+
+import os, sys, argparse, shutil, tempfile, time
+
+try: # This is included as the module may not properly install in Anaconda.
+    import ieo
+except:
+    ieodir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    if os.path.isfile(os.path.join(ieodir, 'ieo.py')):
+        sys.path.append(ieodir)
+        import ieo
+    else:
+        print('Error: that is not a valid path for the IEO module. Exiting.')
+        sys.exit()
+
+## main
+parser = argparse.ArgumentParser('This script times the extraction of Sentinel-2 L2A bands for different numbers of extraction threads.')
+parser.add_argument('-i', '--infile', type = str, required = True, help = 'Sentinel-2 L2A product, either a .zip file or an extracted product directory.')
+parser.add_argument('-w', '--workers', type = str, default = None, help = 'Comma-delimited list of thread counts to test, without any spaces. Default = 1, 2, 4, ... up to the number of CPUs.')
+parser.add_argument('--repeats', type = int, default = 1, help = 'Number of runs for each thread count. The fastest run is reported. Default = 1.')
+parser.add_argument('--tempdir', type = str, default = None, help = 'Directory for temporary output files. Default = system temporary directory.')
+parser.add_argument('--S2TM', action = 'store_true', help = 'Extract only equivalent Landsat 4-5/ Landsat 7 ETM+ bands.')
+parser.add_argument('--S2OLI', action = 'store_true', help = 'Extract only equivalent Landsat 8-9 OLI bands (overrides --S2TM).')
+args = parser.parse_args()
+
+if args.S2OLI:
+    bandlist = ['1', '2', '3', '4', '8', '11', '12']
+elif args.S2TM:
+    bandlist = ['2', '3', '4', '8', '11', '12']
+else:
+    bandlist = ['1', '2', '3', '4', '5', '6', '7', '8', '8a', '9', '11', '12']
+
+if args.workers:
+    workerlist = [int(x) for x in args.workers.split(',')]
+else:
+    cpus = os.cpu_count() or 1
+    workerlist = [1]
+    while workerlist[-1] * 2 <= cpus:
+        workerlist.append(workerlist[-1] * 2)
+
+f = ieo.getS2metadatafile(args.infile)
+if not f:
+    print(f'Error: No MTD_MSIL2A.xml file found in {args.infile}. Exiting.')
+    sys.exit()
+basename = os.path.basename(args.infile)
+if basename.endswith('.zip'):
+    basename = basename[:-4]
+parts = basename.split('_')
+EPSGstr = 'EPSG_326{}'.format(parts[5][1:3])
+
+results = []
+for workers in workerlist:
+    times = []
+    for i in range(args.repeats):
+        outputdir = tempfile.mkdtemp(dir = args.tempdir)
+        try:
+            start = time.perf_counter()
+            ieo.extractS2bands(f, EPSGstr, bandlist, outputdir, basename, workers = workers, verbose = False)
+            times.append(time.perf_counter() - start)
+        finally:
+            shutil.rmtree(outputdir)
+    results.append((workers, min(times)))
+    print(f'{workers} threads: {min(times):0.1f} s')
+
+print(f'\nBand extraction times for {basename} ({len(bandlist)} bands):')
+print('Threads  Time (s)  Speedup')
+for workers, t in results:
+    print(f'{workers:7d}  {t:8.1f}  {results[0][1] / t:7.2f}')
@@ -12,8 +12,9 @@
 # 4. Calculates NDVI and EVI values.
 # 5. Saves tiles to S3 bucket
 
-import os, sys, glob, datetime, argparse, shutil#, ieo, pickle
+import os, sys, glob, datetime, argparse, shutil, queue, threading#, ieo, pickle
 from osgeo import ogr
+from contextlib import ExitStack
 
 try: # This is included as the module may not properly install in Anaconda.
     import ieo
@@ -58,6 +59,11 @@ parser.add_argument('--noNDTI', action = 'store_true', help = 'Do not calculate
 parser.add_argument('--noNBR', action = 'store_true', help = 'Do not calculate NBR.')
 parser.add_argument('--reprocess', action = 'store_true', help = 'Reprocess all scenes for selected date period.')
 parser.add_argument('--localingest', action = 'store_true', help = 'Ingest any zip files in default IEO Sentinel2 ingest directory.')
+parser.add_argument('--unzip', action = 'store_true', help = 'Extract zip files before ingest rather than reading them in place.')
+parser.add_argument('--pipeline', action = 'store_true', help = 'Download, tile, and upload products concurrently.')
+parser.add_argument('--downloadqueue', type = int, default = 1, help = 'Maximum number of downloaded products waiting to be tiled in --pipeline mode. Default = 1.')
+parser.add_argument('--uploadqueue', type = int, default = 2, help = 'Maximum number of tiled products waiting to be uploaded in --pipeline mode. Default = 2.')
+parser.add_argument('--tileformat', type = str, choices = ['ENVI', 'COG'], default = ieo.tileformat, help = 'Format of tiles uploaded to S3 object storage: ENVI or COG (compressed cloud-optimised GeoTIFF). Tiles in either format are read. Default = ieo.tileformat.')
 parser.add_argument('--copylater', action = 'store_true', help = 'Do not copy local files to sentinel2 bucket during script execution.')
 parser.add_argument('--MGRS', type = str, default = None, help = 'Comma-delimited list of MGRS tiles to process, without any spaces. Default = 29UPU for now.')#'If missing, all default tiles will be processed for the date range.')
 parser.add_argument('--startdate', type = str, default = '2015-06-23', help = 'Start date for processing in YYYY-mm-dd format. Default is 2015-06-23.')
@@ -67,6 +73,7 @@ parser.add_argument('--verbose', action = 'store_true', help = 'Display more mes
 args = parser.parse_args()
 
 verbose = args.verbose
+ieo.tileformat = args.tileformat
 
 # Get System Process ID
 local_pid = pid = os.getpid()
@@ -221,8 +228,9 @@ def movefile(f, inbucket, outbucket, outf, *args, **kwargs):
                     'Bucket': inbucket,
                     'Key': f
                 }
-    S3ObjectStorage.s3res.meta.client.copy(copy_source, outbucket, outf)
-    S3ObjectStorage.s3res.Object(inbucket, f).delete()
+    s3res = S3ObjectStorage.getthreadresource()
+    s3res.meta.client.copy(copy_source, outbucket, outf)
+    s3res.Object(inbucket, f).delete()
 
 def joinfeatures(ProductIDs, layer):
     multi = ogr.Geometry(ogr.wkbMultiPolygon)
@@ -236,27 +244,23 @@ def joinfeatures(ProductIDs, layer):
     union = multi.UnionCascaded()
     return union
 
-def gettiles(feature, NTSlayer):
+def gettiles(feature, tileindex):
     acqdatestr = feature.GetField('acquisitionDate')
     datestr = acqdatestr[:10].replace('/', '')
-    NTSlayer.StartTransaction()
-    for tile in NTSlayer:
-        tilegeometry = tile.GetGeometryRef()
-        geom = feature.GetGeometryRef()
-        if geom.Intersect(tilegeometry):
-            tilename = tile.GetField('Tile')
-            
-            for d in transferdict.keys():
-                prefix = f'{d}/{tilename}/{datestr[:4]}/{datestr[4:6]}/{datestr[6:8]}'
-                objs = S3ObjectStorage.getbucketobjects('sentinel2', prefix)
-                if isinstance(objs, dict):
-                    if len(objs[prefix]) > 0:
-                        if verbose: print(f'Found {len(objs[prefix])} on sentinel2 bucket to transfer for tile {tilename}.')
-                        for f in objs[prefix]:
-                            if not os.path.isfile(os.path.join(transferdict[d], f)):
-                                s3_object = f'{prefix}/{f}'
-                                S3ObjectStorage.downloadfile(transferdict[d], 'sentinel2', s3_object)
-    NTSlayer.CommitTransaction()
+    geom = feature.GetGeometryRef()
+    for tile in tileindex.intersecting(geom):
+        tilename = tile.name
+        
+        for d in transferdict.keys():
+            prefix = f'{d}/{tilename}/{datestr[:4]}/{datestr[4:6]}/{datestr[6:8]}'
+            objs = S3ObjectStorage.getbucketobjects('sentinel2', prefix)
+            if isinstance(objs, dict):
+                if len(objs[prefix]) > 0:
+                    if verbose: print(f'Found {len(objs[prefix])} on sentinel2 bucket to transfer for tile {tilename}.')
+                    for f in objs[prefix]:
+                        if not os.path.isfile(os.path.join(transferdict[d], f)) and not (f.endswith('.tif') and os.path.isfile(os.path.join(transferdict[d], f[:-4] + '.dat'))):
+                            s3_object = f'{prefix}/{f}'
+                            ieo.downloadtilefile(transferdict[d], 'sentinel2', s3_object) # COG tiles are converted to ENVI
 
     
 # picklefile = os.path.join(ieo.catdir, 'sentinel2.pickle') # contains information on data saved in buckets.
@@ -335,12 +339,10 @@ print('Opening local Sentinel 2 catalog file.\n')
 if not ieo.usePostGIS:
     driver = ogr.GetDriverByName('GPKG')
     data_source = driver.Open(ieo.catgpkg, 1)
-    ds2 = driver.Open(ieo.ieogpkg, 0)
 else:
     data_source = ogr.Open(ieo.catgpkg, 1)
-    ds2 = ogr.Open(ieo.ieogpkg, 0)
 layer = data_source.GetLayer(ieo.Sen2shp)
-NTSlayer = ds2.GetLayer(ieo.NTS)
+tileindex = ieo.gettileindex(ieo.NTS)
 
 corruptedDict = checkLayer(layer, corruptedDict)
 if len(corruptedDict.keys()) > 0:
@@ -348,14 +350,11 @@ if len(corruptedDict.keys()) > 0:
     layer = fixLayer(layer, corruptedDict)
 
 if not args.MGRS:
-    S2layer = ds2.GetLayer(ieo.Sen2tiles)
     MGRStilelist = []
-    for S2feat in S2layer:
-        MGRSname = S2feat.GetField('TILE_ID')
+    for MGRSname in ieo.gettilelist(tiletype = 'sentinel2'):
         if MGRSname:
             if not MGRSname in MGRStilelist:
                 MGRStilelist.append(MGRSname)
-    S2layer = None
 else:
     MGRStilelist = args.MGRS.split(',')
 # layer = data_source.GetLayer(ieo.Sen2shp)
@@ -417,15 +416,11 @@ if layer.GetFeatureCount() > 0:
         numtiles = len(SR_tiles)
         
         geom = feature.GetGeometryRef()
-        # NTSlayer.StartTransaction()
-        NTSlayer.SetSpatialFilter(geom)
-        intersectTiles = NTSlayer.GetFeatureCount()
+        intersectTiles = len(tileindex.intersecting(geom))
         if intersectTiles > 0:
             intersect = True
         if numtiles < intersectTiles or args.reprocess or not SR_tiles: # ignore any MGRS tiles outside of the acceptable list 
             ingestTime = None
-        # NTSlayer.CommitTransaction()
-        # NTSlayer.ResetReading()
         
             # elif MGRS in MGRStilelist and ingestTime:
             #     feature.SetField('ingest_queue_status', 'ingested')
@@ -548,7 +543,6 @@ if args.bucket:
         sys.exit()
                 
 data_source = None
-ds2 = None
 
 print(f'\nCreating processing lists for dates between {args.startdate} and {enddatestr}.\n')
 for ProductID in sorted(ProductDict.keys()):
@@ -640,197 +634,288 @@ for d in [ieo.Sen2srdir, ieo.Sen2ndvidir, ieo.Sen2evidir, ieo.Sen2ndtidir, ieo.S
 # Now process files that are in the list
 if not ieo.usePostGIS:
     data_source = driver.Open(ieo.catgpkg, 1)
-    ds2 = driver.Open(ieo.ieogpkg, 0)
 else:
     data_source = ogr.Open(ieo.catgpkg, 1)
-    ds2 = ogr.Open(ieo.ieogpkg, 0)
 layer = data_source.GetLayer(ieo.Sen2shp)
-NTSlayer = ds2.GetLayer(ieo.NTS)
 # for bucket in sorted(scenedict.keys()):
 #     if bucket != 'lastupdate': 
 #         if not (bucket == 'Direct_download_from_SciHub' and not args.localingest):
 #             print(f'Now processing files in bucket {bucket}.')
-for year in sorted(scenedict.keys()):
-    for month in sorted(scenedict[year].keys()):
-        for day in sorted(scenedict[year][month].keys()):
-            numfiles = len(scenedict[year][month][day]['ProductIDs'].keys())
-            if numfiles > 0:
-                
-                print(f'There are {numfiles} scenes to be processed for date {year}/{month}/{day}.')
-                filenum = 1
-                for ProductID in sorted(scenedict[year][month][day]['ProductIDs'].keys()):
-                    # i = scenedict[year][month][day]['granules'].index(f)
-                    f = scenedict[year][month][day]['ProductIDs'][ProductID]['prefix']
-                    bucket = scenedict[year][month][day]['ProductIDs'][ProductID]['bucket']
-                    # if ProductID in f:
-                    if f:
-                        layer.StartTransaction()                            
-                        if f.endswith('/'):
-                            f = f[:-1]
-                        # ProductID = os.path.basename(f)
-                        # if len(ProductID) > 60:
-                        #     ProductID = ProductID[:60]
-                        satellite = ProductID[:3]
-                        if args.verbose:
-                            print(f'Product filename: {f}')                            
-                    #        try:
-                        proddir = os.path.join(ieo.Sen2ingestdir, ProductID)
-                        # Prodlist.append(proddir)
-                        # try:
-                            #if args.overwrite:# or not os.path.isdir(proddir):
-                        if args.localingest or f.endswith('.zip'):
-                            if not os.path.isfile(f):
-                                print(f'\nDownloading {ProductID} from bucket {bucket} ({filenum}/ {numfiles}).\n')
-                                S3ObjectStorage.downloadfile(ieo.Sen2ingestdir, bucket, f)
-                            zfile = os.path.join(ieo.Sen2ingestdir, os.path.basename(f))
-                            # if not os.path.isdir(proddir):
-                            #     os.mkdir(proddir)
-                            ieo.unzip(zfile, proddir)
-                            
-                        else:
-                            print(f'\nDownloading {ProductID} from bucket {bucket}, file number {filenum} of {numfiles}.\n')
-                            S3ObjectStorage.download_s3_folder(bucket, f, proddir)
-                            filenum += 1
-                        if f.endswith('.zip'):
-                            if not os.path.isfile(os.path.join(proddir, 'MTD_MSIL2A.xml')):
-                                if os.path.isdir(os.path.join(proddir, f'{os.path.basename(proddir)}.SAFE')):
-                                    if os.path.isfile(os.path.join(proddir, f'{os.path.basename(proddir)}.SAFE', 'MTD_MSIL2A.xml')):
-                                        proddir = (os.path.join(proddir, f'{os.path.basename(proddir)}.SAFE'))
-                        # This will be modified soon to process multiple Sentinel-2 tiles from the same day.
-                        if os.path.isfile(os.path.join(proddir, 'MTD_MSIL2A.xml')):
-                            print(f'Now importing scene {ProductID} for date {year}/{month}/{day}.')
-                            # geom = joinfeatures(scenedict[year][month][day]['ProductIDs'], layer)
-                            
-                            layer.SetAttributeFilter(f'"ProductID" = \'{ProductID}\'')
-                            if layer.GetFeatureCount() > 0:
-                                feature = layer.GetNextFeature()
-                                # print(f'\r{feature.GetField("ProductID")}')
-                                # PiD = feature.GetField('ProductID')
-                                # if verbose: print(f'PiD {PiD}: {len(PiD)}, ProductID {ProductID}: {len(ProductID)}.')
-                                # if PiD == ProductID:
-                                if verbose: print(f'Found feature for {ProductID}.')
-                                gettiles(feature, NTSlayer)
-                                feature = ieo.importSentinel2totiles( \
-                                             proddir, feature, \
-                                             remove = args.remove, \
-                                             overwrite = args.overwrite, 
-                                             CalcVIs = args.CalcVIs, \
-                                              CalcNDVI = CalcNDVI, \
-                                              CalcEVI = CalcEVI, CalcNDTI = CalcNDTI, \
-                                              CalcNBR = CalcNBR, \
-                                              outdatasettype = outdatasettype)
-                    # tilelist = []
-                                
-                                        # for feature in layer:
-                                        #     if feature.GetField('ProductID') in scenedict[year][month][day]['ProductIDs']:
-                                        #         outtilelist = []
-                                        #         geometry = feature.geometry
-                                        #         for feat in layer2:
-                                        #             tilegeom = feat.geometry()
-                                        #             tilename = feat.GetField('Tile')
-                                        #             if tilegeom.Intersect(geometry) and tilename in tilelist:
-                                        #                 outtilelist.append(tilename)
-                                        #         if len(outtilelist) > 0:
-                                        #             for tilename in outtilelist:
-                                        #                 if outtilelist.index(tilename) == 0:
-                                        #                     tilestr = tilename
-                                        #                 else:
-                                        #                     tilestr +=  f',{tilename}'
-                                        #             for fieldname in ['Surface_reflectance_tiles', 'NDVI_tiles', 'EVI_tiles', 'NDTI_tiles', 'NBR_tiles']:
-                                        #                 feature.SetField(fieldname, tilestr)
-                                if verbose: print(f'Tile processing for {ProductID} complete, updating feature in geodatabase layer.')
-                                feature.SetField('Tile_filename_base', f'{satellite}_{year}{month}{day}')
-                                if not args.copylater: feature.SetField('S3_tile_bucket', 'sentinel2')
-                                now = datetime.datetime.now()
-                                feature.SetField('Raster_Ingest_Time', now.strftime('%Y-%m-%d %H:%M:%S'))
-                                if not args.copylater: 
-                                    feature.SetField('S3_tile_bucket', 'sentinel2')
-                                layer.SetFeature(feature)
-                                if args.removelocal:
-                                    rmlist = [proddir, proddir + '_ITM']
-                                    if os.path.dirname(proddir).endswith(ProductID):
-                                        rmlist.append(os.path.dirname(proddir))
-                                    for d in rmlist:
-                                        if os.path.isdir(d):
-                                            print(f'Deleting path: {d}')
-                                            shutil.rmtree(d)
-                                # if bucket == 'ingested' and f.endswith('.zip'):
-                                #     print(f'Deleting input file: {f}')
-                                #     os.remove(f)
-                                if not args.copylater: 
-                                    if args.bucket:
-                                        movefile(f'{ProductID}.zip', args.bucket, 'ingested', f'sentinel2/{year}/{month}/{day}/{ProductID}.zip')
-                                    if f.endswith('.zip'):
-                                        try:
-                                            if bucket != 'ingested':
-                                                S3ObjectStorage.copyfilestobucket(bucket = 'ingested', targetdir = f'sentinel2/{year}/{month}/{day}', filename = zfile)
-                                            if args.removelocal:
-                                                print(f'Deleting input file: {zfile}')
-                                                os.remove(zfile)
-                                        except Exception as e:
-                                            print(f'ERROR with file transfer for {ProductID}: ', e)
-                                            ieo.logerror(ProductID, e)
-                                    if verbose: print(f'Feature {ProductID} set. Archiving tiles to bucket: sentinel2')
-                                    tilelist = feature.GetField('Surface_reflectance_tiles')
-                                    if isinstance(tilelist, str):
-                                        tilelist = tilelist.split(',')
-                                    else:
-                                        tilelist = []
-                                        tilefilelist = glob.glob(os.path.join(ieo.Sen2srdir, f'{satellite}_{year}{month}{day}*.dat'))
-                                        if len(tilefilelist) > 0:
-                                            for tfl in tilefilelist:
-                                                if verbose: print(f'Adding tile to list: {tfl[-7:-4]}.')
-                                                tilelist.append(tfl[-7:-4])
-                                    if len(tilelist) > 0:
-                                        for tile in tilelist:
-                                            # scenedict[year][month][day]['tiles'].append(tile)
-                                            
-                                            for d in transferdict.keys():
-                                                dname = ieo.Sen2srdir.replace('SR', d)
-                                                copylist = glob.glob(os.path.join(dname, f'{satellite}_{year}{month}{day}_{tile}.*'))
-                                                # z = transferdict[d]
-                                                if len(copylist) > 0:
-                                                    for item in copylist:
-                                                        if item.endswith('.bak'):
-                                                            if args.removelocal:
-                                                                os.remove(item)
-                                                            copylist.remove(item)
-                                                if len(copylist) > 0:
-                                                    remotedir = f'{d}/{tile}/{year}/{month}/{day}'
-                                                    if verbose: print(f'Copying {len(copylist)} files to bucket/path: sentinel2/{remotedir}.')
-                                                    try:
-                                                        S3ObjectStorage.copyfilestobucket(bucket = 'sentinel2', targetdir = remotedir, filelist = copylist)
-                                                    except Exception as e:
-                                                        print(f'ERROR with file transfer for {ProductID}: ', e)
-                                                        ieo.logerror(ProductID, e)
-                                                    # if args.removelocal:
-                                                    #     for c in copylist:
-                                                    #         print(f'Deleting from disk: {c}')
-                                                    #         os.remove(c)
-                                                      
-                            # except Exception as e:
-                            #     print(f'ERROR: {e}')
-                            #     ieo.logerror(f, e)
-                            #     with open(badscenefile, 'a') as output:
-                            #         output.write(f'{bucket}: {f}\n')
-                            
-                        else:
-                            print(f'ERROR: MTD_MSIL2A.xml missing for scene {ProductID}, skipping and appending to missing scenes list.')
-                            ieo.logerror(ProductID, 'MTD_MSIL2A.xml missing for scene.')
-                            
-                            missinglist.append(ProductID)
-                        layer.CommitTransaction()
-                    filenum += 1
-                if args.removelocal:
-                    if transferdict:
-                        for d in transferdict.keys():
-                            dellist = glob.glob(os.path.join(ieo.Sen2srdir, f'*_{year}{month}{day}*.*'))
-                            if len(dellist) > 0:
-                                for fname in dellist:
-                                    print(f'Deleting from disk: {fname}')
-                                    os.remove(fname)
+def makejobs(scenedict):
+    # Returns the list of products to be processed, in processing order, each followed by a day end marker once all products for that day are listed
+    jobs = []
+    for year in sorted(scenedict.keys()):
+        for month in sorted(scenedict[year].keys()):
+            for day in sorted(scenedict[year][month].keys()):
+                numfiles = len(scenedict[year][month][day]['ProductIDs'].keys())
+                if numfiles > 0:
+                    print(f'There are {numfiles} scenes to be processed for date {year}/{month}/{day}.')
+                    filenum = 1
+                    for ProductID in sorted(scenedict[year][month][day]['ProductIDs'].keys()):
+                        # i = scenedict[year][month][day]['granules'].index(f)
+                        f = scenedict[year][month][day]['ProductIDs'][ProductID]['prefix']
+                        bucket = scenedict[year][month][day]['ProductIDs'][ProductID]['bucket']
+                        # if ProductID in f:
+                        if f:
+                            if f.endswith('/'):
+                                f = f[:-1]
+                            jobs.append({'ProductID' : ProductID, 'f' : f, 'bucket' : bucket, 
+                                         'year' : year, 'month' : month, 'day' : day, 
+                                         'filenum' : filenum, 'numfiles' : numfiles})
+                        filenum += 1
+                    jobs.append({'dayend' : (year, month, day)})
+    return jobs
+
+def downloadproduct(job):
+    # Download stage: copies a product from its bucket to ieo.Sen2ingestdir, and extracts it if --unzip is set
+    ProductID, f, bucket = job['ProductID'], job['f'], job['bucket']
+    # ProductID = os.path.basename(f)
+    # if len(ProductID) > 60:
+    #     ProductID = ProductID[:60]
+    if args.verbose:
+        print(f'Product filename: {f}')                            
+    proddir = os.path.join(ieo.Sen2ingestdir, ProductID)
+    zfile = None
+    # Prodlist.append(proddir)
+    # try:
+        #if args.overwrite:# or not os.path.isdir(proddir):
+    if args.localingest or f.endswith('.zip'):
+        if not os.path.isfile(f):
+            print(f'\nDownloading {ProductID} from bucket {bucket} ({job["filenum"]}/ {job["numfiles"]}).\n')
+            S3ObjectStorage.downloadfile(ieo.Sen2ingestdir, bucket, f)
+        zfile = os.path.join(ieo.Sen2ingestdir, os.path.basename(f))
+        # if not os.path.isdir(proddir):
+        #     os.mkdir(proddir)
+        if args.unzip:
+            ieo.unzip(zfile, proddir)
+        else:
+            proddir = zfile # read in place through /vsizip/
+        
+    else:
+        print(f'\nDownloading {ProductID} from bucket {bucket}, file number {job["filenum"]} of {job["numfiles"]}.\n')
+        S3ObjectStorage.download_s3_folder(bucket, f, proddir)
+    if f.endswith('.zip') and args.unzip:
+        if not os.path.isfile(os.path.join(proddir, 'MTD_MSIL2A.xml')):
+            if os.path.isdir(os.path.join(proddir, f'{os.path.basename(proddir)}.SAFE')):
+                if os.path.isfile(os.path.join(proddir, f'{os.path.basename(proddir)}.SAFE', 'MTD_MSIL2A.xml')):
+                    proddir = (os.path.join(proddir, f'{os.path.basename(proddir)}.SAFE'))
+    job['proddir'] = proddir
+    job['zfile'] = zfile
+    return job
+
+def tileproduct(job):
+    # Tiling stage: converts a downloaded product to tiles and updates its feature. This must run in the main thread, as it uses the catalog layer.
+    ProductID, year, month, day = job['ProductID'], job['year'], job['month'], job['day']
+    proddir = job.get('proddir', None)
+    satellite = ProductID[:3]
+    job['upload'] = False
+    layer.StartTransaction()                            
+    # This will be modified soon to process multiple Sentinel-2 tiles from the same day.
+    if proddir and ieo.getS2metadatafile(proddir):
+        print(f'Now importing scene {ProductID} for date {year}/{month}/{day}.')
+        # geom = joinfeatures(scenedict[year][month][day]['ProductIDs'], layer)
+        
+        layer.SetAttributeFilter(f'"ProductID" = \'{ProductID}\'')
+        if layer.GetFeatureCount() > 0:
+            feature = layer.GetNextFeature()
+            # print(f'\r{feature.GetField("ProductID")}')
+            # PiD = feature.GetField('ProductID')
+            # if verbose: print(f'PiD {PiD}: {len(PiD)}, ProductID {ProductID}: {len(ProductID)}.')
+            # if PiD == ProductID:
+            if verbose: print(f'Found feature for {ProductID}.')
+            gettiles(feature, tileindex)
+            feature = ieo.importSentinel2totiles( \
+                         proddir, feature, \
+                         remove = args.remove, \
+                         overwrite = args.overwrite, 
+                         CalcVIs = args.CalcVIs, \
+                          CalcNDVI = CalcNDVI, \
+                          CalcEVI = CalcEVI, CalcNDTI = CalcNDTI, \
+                          CalcNBR = CalcNBR, \
+                          outdatasettype = outdatasettype)
+            if verbose: print(f'Tile processing for {ProductID} complete, updating feature in geodatabase layer.')
+            feature.SetField('Tile_filename_base', f'{satellite}_{year}{month}{day}')
+            if not args.copylater: feature.SetField('S3_tile_bucket', 'sentinel2')
+            now = datetime.datetime.now()
+            feature.SetField('Raster_Ingest_Time', now.strftime('%Y-%m-%d %H:%M:%S'))
+            if not args.copylater: 
+                feature.SetField('S3_tile_bucket', 'sentinel2')
+            layer.SetFeature(feature)
+            if args.removelocal:
+                if proddir.endswith('.zip'):
+                    rmlist = [proddir[:-4] + '_ITM']
+                else:
+                    rmlist = [proddir, proddir + '_ITM']
+                if os.path.dirname(proddir).endswith(ProductID):
+                    rmlist.append(os.path.dirname(proddir))
+                for d in rmlist:
+                    if os.path.isdir(d):
+                        print(f'Deleting path: {d}')
+                        shutil.rmtree(d)
+            # if bucket == 'ingested' and f.endswith('.zip'):
+            #     print(f'Deleting input file: {f}')
+            #     os.remove(f)
+            if not args.copylater: 
+                # The tile list is read here, as the upload stage may run in another thread
+                tilelist = feature.GetField('Surface_reflectance_tiles')
+                if isinstance(tilelist, str):
+                    tilelist = tilelist.split(',')
+                else:
+                    tilelist = []
+                    tilefilelist = glob.glob(os.path.join(ieo.Sen2srdir, f'{satellite}_{year}{month}{day}*.dat'))
+                    if len(tilefilelist) > 0:
+                        for tfl in tilefilelist:
+                            if verbose: print(f'Adding tile to list: {tfl[-7:-4]}.')
+                            tilelist.append(tfl[-7:-4])
+                job['tilelist'] = tilelist
+                job['upload'] = True
+        # except Exception as e:
+        #     print(f'ERROR: {e}')
+        #     ieo.logerror(f, e)
+        #     with open(badscenefile, 'a') as output:
+        #         output.write(f'{bucket}: {f}\n')
+        
+    else:
+        print(f'ERROR: MTD_MSIL2A.xml missing for scene {ProductID}, skipping and appending to missing scenes list.')
+        ieo.logerror(ProductID, 'MTD_MSIL2A.xml missing for scene.')
+        
+        missinglist.append(ProductID)
+    layer.CommitTransaction()
+    return job
+
+def uploadproduct(job):
+    # Upload stage: archives the input file and copies the product's tiles to the sentinel2 bucket
+    if not job['upload']:
+        return
+    ProductID, f, bucket, year, month, day = job['ProductID'], job['f'], job['bucket'], job['year'], job['month'], job['day']
+    zfile = job['zfile']
+    satellite = ProductID[:3]
+    if args.bucket:
+        movefile(f'{ProductID}.zip', args.bucket, 'ingested', f'sentinel2/{year}/{month}/{day}/{ProductID}.zip')
+    if f.endswith('.zip'):
+        try:
+            if bucket != 'ingested':
+                S3ObjectStorage.copyfilestobucket(bucket = 'ingested', targetdir = f'sentinel2/{year}/{month}/{day}', filename = zfile)
+            if args.removelocal:
+                print(f'Deleting input file: {zfile}')
+                os.remove(zfile)
+        except Exception as e:
+            print(f'ERROR with file transfer for {ProductID}: ', e)
+            ieo.logerror(ProductID, e)
+    if verbose: print(f'Feature {ProductID} set. Archiving tiles to bucket: sentinel2')
+    tilelist = job['tilelist']
+    if len(tilelist) > 0:
+        for tile in tilelist:
+            # scenedict[year][month][day]['tiles'].append(tile)
+            # The main thread may already be merging the next product into the same tiles, so each tile is locked while its files are
+            # converted and uploaded. Vegetation index tiles may be written under the lock of the reflectance tile by CalcVIs.
+            with ieo.TileLock(os.path.join(ieo.Sen2srdir, f'{satellite}_{year}{month}{day}_{tile}.dat')):
+                for d in transferdict.keys():
+                    dname = ieo.Sen2srdir.replace('SR', d)
+                    with ExitStack() as locks:
+                        if d != 'SR':
+                            locks.enter_context(ieo.TileLock(os.path.join(dname, f'{satellite}_{year}{month}{day}_{tile}.dat')))
+                        copylist = glob.glob(os.path.join(dname, f'{satellite}_{year}{month}{day}_{tile}.*'))
+                        # z = transferdict[d]
+                        if len(copylist) > 0:
+                            for item in copylist:
+                                if item.endswith('.bak'):
+                                    if args.removelocal:
+                                        os.remove(item)
+                                    copylist.remove(item)
+                        if len(copylist) > 0:
+                            copylist = ieo.gettileuploadlist(copylist) # converts tiles to COGs if ieo.tileformat = 'COG'
+                            remotedir = f'{d}/{tile}/{year}/{month}/{day}'
+                            if verbose: print(f'Copying {len(copylist)} files to bucket/path: sentinel2/{remotedir}.')
+                            try:
+                                S3ObjectStorage.copyfilestobucket(bucket = 'sentinel2', targetdir = remotedir, filelist = copylist)
+                            except Exception as e:
+                                print(f'ERROR with file transfer for {ProductID}: ', e)
+                                ieo.logerror(ProductID, e)
+                            for c in copylist:
+                                if c.endswith('.tif'): # COGs are only used for storage
+                                    os.remove(c)
+                            # if args.removelocal:
+                            #     for c in copylist:
+                            #         print(f'Deleting from disk: {c}')
+                            #         os.remove(c)
+
+def cleanupday(year, month, day):
+    # Deletes local tiles for a day once all of its products have been uploaded
+    if args.removelocal:
+        if transferdict:
+            for d in transferdict.keys():
+                dellist = glob.glob(os.path.join(ieo.Sen2srdir, f'*_{year}{month}{day}*.*'))
+                if len(dellist) > 0:
+                    for fname in dellist:
+                        print(f'Deleting from disk: {fname}')
+                        os.remove(fname)
+
+def runpipeline(jobs, downloadqueue, uploadqueue):
+    # Runs the download, tiling, and upload stages concurrently, so that while product N is being tiled in the main thread, product N + 1 is downloading
+    # and the tiles of product N - 1 are uploading. The queue sizes limit the number of products waiting between stages, and hence the disk space used in ieo.Sen2ingestdir.
+    tileq = queue.Queue(maxsize = downloadqueue)
+    uploadq = queue.Queue(maxsize = uploadqueue)
+    
+    def downloader():
+        for job in jobs:
+            if not 'dayend' in job:
+                try:
+                    job = downloadproduct(job)
+                except Exception as e:
+                    print(f'ERROR downloading {job["ProductID"]}: ', e)
+                    ieo.logerror(job['ProductID'], e)
+            tileq.put(job)
+        tileq.put(None)
+    
+    def uploader():
+        while True:
+            job = uploadq.get()
+            if job == None:
+                break
+            try:
+                if 'dayend' in job:
+                    cleanupday(*job['dayend'])
+                else:
+                    uploadproduct(job)
+            except Exception as e:
+                print('ERROR during upload: ', e)
+                ieo.logerror(job.get('ProductID', 'upload'), e)
+    
+    downloadthread = threading.Thread(target = downloader, daemon = True)
+    uploadthread = threading.Thread(target = uploader, daemon = True)
+    downloadthread.start()
+    uploadthread.start()
+    try:
+        while True:
+            job = tileq.get()
+            if job == None:
+                break
+            if not 'dayend' in job:
+                try:
+                    job = tileproduct(job)
+                except Exception as e:
+                    print(f'ERROR tiling {job["ProductID"]}: ', e)
+                    ieo.logerror(job['ProductID'], e)
+                    layer.RollbackTransaction() # tileproduct() commits its transaction only on success
+                    job['upload'] = False
+            uploadq.put(job)
+    finally: # lets the uploader finish the products already tiled, even if the main thread is interrupted
+        uploadq.put(None)
+        uploadthread.join()
+    downloadthread.join()
+
+jobs = makejobs(scenedict)
+if args.pipeline:
+    print(f'Processing {len([job for job in jobs if not "dayend" in job])} scenes in a pipeline.')
+    runpipeline(jobs, args.downloadqueue, args.uploadqueue)
+else:
+    for job in jobs:
+        if 'dayend' in job:
+            cleanupday(*job['dayend'])
+        else:
+            uploadproduct(tileproduct(downloadproduct(job)))
 data_source = None
-ds2 = None
 layer = None
 
 if len(missinglist) > 0:
@@ -53,8 +53,15 @@ parser.add_argument('--noNDTI', action = 'store_true', help = 'Do not calculate
 parser.add_argument('--noNBR', action = 'store_true', help = 'Do not calculate NBR.')
 parser.add_argument('-r', '--remove', type = bool, default = True, help = 'Remove temporary files after ingest.')
 parser.add_argument('--useS3', action = 'store_true', help = 'If set, copy outputs to S3 storage. Otherwise defaults to ieo.useS3')
+parser.add_argument('--tileworkers', type = int, default = 1, help = 'Number of processes used to generate tiles for each scene. Default = 1.')
+parser.add_argument('--singlepass', action = 'store_true', help = 'Tile all products of each scene in a single pass.')
+parser.add_argument('--vsitar', action = 'store_true', help = 'Read bands directly from tar files rather than extracting them.')
+parser.add_argument('--sceneworkers', type = int, default = 1, help = 'Number of scenes imported at the same time in separate processes. Default = 1.')
+parser.add_argument('--tilecachemb', type = int, default = ieo.tilecachemb, help = 'Size in MB of the in-memory cache of tiles shared by scenes in this run. Tiles are written to disk when evicted or at the end of the run. Not used with --sceneworkers, --tileworkers, or S3 storage. Default = ieo.tilecachemb.')
+parser.add_argument('--tileformat', type = str, choices = ['ENVI', 'COG'], default = ieo.tileformat, help = 'Format of tiles uploaded to S3 object storage: ENVI or COG (compressed cloud-optimised GeoTIFF). Tiles in either format are read. Default = ieo.tileformat.')
 args = parser.parse_args()
 
+ieo.tileformat = args.tileformat
 if args.delay > 0: # if we want to delay execution for whatever reason
     from time import sleep
     print('Delaying execution {} seconds.'.format(args.delay))
@@ -64,6 +71,16 @@ if not args.useS3:
     useS3 = ieo.useS3
 else:
     useS3 = args.useS3
+
+if args.tilecachemb > 0:
+    if args.sceneworkers > 1:
+        print('Warning: the tile cache cannot be shared between scene workers and will not be used.')
+    elif args.tileworkers > 1:
+        print('Warning: tiles are made by tile worker processes, so the tile cache will not be used.')
+    elif useS3:
+        print('Warning: tiles are uploaded to S3 after each scene, so the tile cache will not be used.')
+    else:
+        ieo.settilecache(args.tilecachemb)
     
 # Setting a few variables
 archdir = args.archdir
@@ -149,13 +166,25 @@ else: # find and process what's in the ingest directory
 numfiles = len(filelist)
 print('There are {} reflectance files and {} scenes to be processed.'.format(len(reflist), numfiles))
 filenum = 1
+if args.sceneworkers > 1:
+    scenelist = [f for f in filelist if args.overwrite or not any(os.path.basename(f)[:16] in x for x in reflist)]
+    results = ieo.importscenes(scenelist, sceneworkers = args.sceneworkers, remove = args.remove, useS3 = useS3, overwrite = args.overwrite, workers = args.tileworkers, singlepass = args.singlepass, vsitar = args.vsitar)
+    for f, result in results:
+        if args.removelocal:
+            localdirs = glob.glob(f'{f[:-4]}*')
+            if len(localdirs) > 0:
+                for d in localdirs:
+                    if os.path.isdir(d):
+                        print(f'Deleting temporary directory: {d}')
+                        shutil.rmtree(d)
+    filelist = [] # already processed
 for f in filelist:
     basename = os.path.basename(f)
     scene = basename[:16]
     if args.overwrite or not any(scene in x for x in reflist):
 #        try:
         print('\nProcessing archive {}, file number {} of {}.\n'.format(f, filenum, numfiles))
-        ieo.importespatotiles(f, remove = args.remove, useS3 = useS3, overwrite = args.overwrite)
+        ieo.importespatotiles(f, remove = args.remove, useS3 = useS3, overwrite = args.overwrite, workers = args.tileworkers, singlepass = args.singlepass, vsitar = args.vsitar)
         if args.removelocal:
             localdirs = glob.glob(f'{f[:-4]}*')
             if len(localdirs) > 0:
@@ -174,4 +203,5 @@ for f in filelist:
         print('Scene {} has already been processed, skipping file number {} of {}.'.format(scene, filenum, numfiles))
     filenum += 1
 
+ieo.flushtilecache()
 print('Processing complete.')
\ No newline at end of file
@@ -215,6 +215,8 @@ def getFile(ProductID, layer, year, month, day):
                     writeMissingScene(ProductID)
                     return None
     if os.path.isfile(localfile) and not os.path.isdir(proddir):
+        if ieo.getS2metadatafile(localfile): # read in place through /vsizip/
+            return localfile
         ieo.unzip(localfile, proddir)
     if localfile.endswith('.zip'):
         if not os.path.isfile(os.path.join(proddir, 'MTD_MSIL2A.xml')):
@@ -233,18 +235,14 @@ def checkMissingData(dat, layer, tilelayer, tiles, prodstr, *args, **kwargs):
     minzerofrac = kwargs.get('minzerofrac', 0.05)
     excesszeroes = False
     print(f'Opening file: {f}')
-    src_ds = gdal.Open(dat)
-    nb = src_ds.RasterCount
-    # if nb < 6:
-    #     continue
-    ns = src_ds.RasterXSize
-    nl = src_ds.RasterYSize
-    numpixels = ns * nl
-    minpixels = numpixels - int(np.ceil(numpixels * minzerofrac))
-    srcband = src_ds.GetRasterBand(4)
-    stats = srcband.GetStatistics( True, True )
-    if stats[0] == 0:
-        srcarr = srcband.ReadAsArray(0, 0 , ns, nl).astype(np.uint)
+    src_data, gt = ieo.openenvi(dat) # memory mapped, so only band 4 is read from disk
+    if isinstance(src_data, np.ndarray):
+        nb, nl, ns = src_data.shape
+        # if nb < 6:
+        #     continue
+        numpixels = ns * nl
+        minpixels = numpixels - int(np.ceil(numpixels * minzerofrac))
+        srcarr = src_data[3]
         nonzeropixels = np.count_nonzero(srcarr)
         if nonzeropixels <= minpixels:
             zeropct = (1 - (nonzeropixels / numpixels)) * 100
@@ -281,8 +279,7 @@ def checkMissingData(dat, layer, tilelayer, tiles, prodstr, *args, **kwargs):
             # dst_layer = None
             # dst_ds = None
     srcarr = None
-    srcband = None
-    src_ds = None
+    src_data = None
     return outlist
 
 missingscenefile = '/data/temp/sentinel2/missing-S2_scenes.txt'
@@ -328,8 +325,13 @@ if not args.noscan:
                                 dat = os.path.join(ieo.Sen2srdir, os.path.basename(f))
                             elif f.endswith('.hdr'):
                                 hdr = os.path.join(ieo.Sen2srdir, os.path.basename(f))
+                            elif f.endswith('.tif'): # COG tile, converted to ENVI when downloaded
+                                dat = os.path.join(ieo.Sen2srdir, os.path.basename(f)[:-4] + '.dat')
+                                hdr = dat[:-4] + '.hdr'
+                                if os.path.isfile(dat):
+                                    continue
                             if not os.path.isfile(os.path.join(ieo.Sen2srdir, os.path.basename(f))):
-                                s3.downloadfile(ieo.Sen2srdir, 'sentinel2', f)
+                                ieo.downloadtilefile(ieo.Sen2srdir, 'sentinel2', f)
                         if not hdr:
                             dat = None
                         outlist = checkMissingData(dat, layer, tilelayer, tiles, prodstr)
@@ -366,10 +368,10 @@ for prodstr in sorted(reprocdict.keys()):
             print(f'Downloading any existing tiles for {year}/{month}/{day}.')
             for tile in tiles:
                 flist = s3.getbucketfoldercontents('sentinel2', 'SR/{tile}/{year}/{month}/{day}/', '')
-                if len(flist) >= 2:
+                if len(flist) >= 2 or any(f.endswith('.tif') for f in flist):
                     for f in flist:
                         print(f'Downloading file: {f}')
-                        s3.downloadfile(ieo.Sen2srdir, 'sentinel2', f)
+                        ieo.downloadtilefile(ieo.Sen2srdir, 'sentinel2', f) # COG tiles are converted to ENVI
                         if f.endswith.dat:
                             ITMfiles.append(os.path.join(ieo.Sen2shp, os.path.basename(f)))
             print(f'Now processing {len(reprocdict[prodstr]["tiles"])} tiles and {len(reprocdict[prodstr]["scenes"])} scenes for {year}/{month}/{day}.')